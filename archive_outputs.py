@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+import argparse
+import fnmatch
+import io
+import json
+import logging
+import lzma
+import os
+import tarfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Files (relative to the subject directory) that are kept after pruning
+DEFAULT_KEEP_PATTERNS = [
+    'stats/*',
+    'mri/aparc+aseg.mgz',
+    'mri/brainmask.mgz',
+    'mri/T1.mgz',
+    'surf/lh.white', 'surf/rh.white',
+    'surf/lh.pial', 'surf/rh.pial',
+    'surf/lh.thickness', 'surf/rh.thickness',
+    'surf/lh.sphere.reg', 'surf/rh.sphere.reg',
+    'label/lh.aparc.annot', 'label/rh.aparc.annot',
+    'scripts/recon-all.done',
+    'scripts/recon-all.log',
+    'scripts/recon-all-status.log',
+]
+
+# Files that are already compressed are stored as-is instead of being compressed again
+PRECOMPRESSED_SUFFIXES = ('.mgz', '.gz')
+
+INDEX_SUFFIX = '.idx.json'
+
+# Suffix added to compressed members so a plain `tar -x` yields self-describing files
+CODEC_SUFFIXES = {'zstd': '.zst', 'xz': '.xz', 'none': ''}
+
+
+def load_keep_patterns(path):
+    """
+    Read keep-list patterns from a file, one glob per line
+
+    :param path: Path to the keep-list file (blank lines and # comments are ignored)
+    :return: List of glob patterns relative to the subject directory
+    """
+    with open(path, 'r') as f:
+        return [line.strip() for line in f if line.strip() and not line.lstrip().startswith('#')]
+
+
+def select_kept_files(subject_dir, patterns):
+    """
+    List files in a subject directory that match the keep-list
+
+    :param subject_dir: FreeSurfer subject directory
+    :param patterns: Glob patterns relative to the subject directory
+    :return: Tuple of (kept, pruned) lists of relative POSIX paths
+    """
+    kept, pruned = [], []
+    for root, dirs, files in os.walk(subject_dir):
+        dirs.sort()
+        for file in sorted(files):
+            rel_path = os.path.relpath(os.path.join(root, file), subject_dir).replace(os.sep, '/')
+            if any(fnmatch.fnmatchcase(rel_path, pattern) for pattern in patterns):
+                kept.append(rel_path)
+            else:
+                pruned.append(rel_path)
+    return kept, pruned
+
+
+def prune_subject(subject_dir, patterns):
+    """
+    Delete every file that is not on the keep-list, then remove empty directories
+
+    :param subject_dir: FreeSurfer subject directory
+    :param patterns: Glob patterns relative to the subject directory
+    :return: Tuple of (files removed, bytes freed)
+    """
+    _, pruned = select_kept_files(subject_dir, patterns)
+    freed = 0
+    for rel_path in pruned:
+        path = os.path.join(subject_dir, rel_path)
+        freed += os.path.getsize(path)
+        os.remove(path)
+
+    for root, dirs, files in os.walk(subject_dir, topdown=False):
+        if root != subject_dir and not os.listdir(root):
+            os.rmdir(root)
+    return len(pruned), freed
+
+
+def get_codec(method, level=None):
+    """
+    Return a compress function for the requested method
+
+    :param method: 'zstd' or 'xz'
+    :param level: Compression level (default: 10 for zstd, 6 for xz)
+    :return: Function taking bytes and returning compressed bytes
+    """
+    if method == 'zstd':
+        if zstandard is None:
+            raise ImportError("zstandard is not installed. Run `pip install zstandard` or use --method xz")
+        compressor = zstandard.ZstdCompressor(level=level if level is not None else 10)
+        return compressor.compress
+    if method == 'xz':
+        preset = level if level is not None else 6
+        return lambda data: lzma.compress(data, preset=preset)
+    raise ValueError(f"Unknown compression method: {method}")
+
+
+def decompress(codec, data):
+    """Decompress a member stored with the given codec ('zstd', 'xz' or 'none')."""
+    if codec == 'none':
+        return data
+    if codec == 'zstd':
+        if zstandard is None:
+            raise ImportError("zstandard is not installed. Run `pip install zstandard`")
+        return zstandard.ZstdDecompressor().decompress(data)
+    if codec == 'xz':
+        return lzma.decompress(data)
+    raise ValueError(f"Unknown codec: {codec}")
+
+
+def archive_subject(subject_dir, output_dir, patterns, method='zstd', level=None):
+    """
+    Pack the kept files of one subject into <output_dir>/<subject>.tar with an offset index.
+
+    Every member is compressed on its own so a single file can later be extracted with one
+    seek and one read instead of decompressing the whole archive.
+
+    :param subject_dir: FreeSurfer subject directory
+    :param output_dir: Folder receiving the archive and its index
+    :param patterns: Glob patterns relative to the subject directory
+    :param method: 'zstd' or 'xz'
+    :param level: Compression level
+    :return: Dictionary summarizing the archive
+    """
+    subject_id = os.path.basename(os.path.normpath(subject_dir))
+    compress = get_codec(method, level)
+    kept, _ = select_kept_files(subject_dir, patterns)
+
+    archive_path = os.path.join(output_dir, f"{subject_id}.tar")
+    tmp_path = archive_path + '.tmp'
+    codecs = {}
+    member_names = {}
+    original_bytes = 0
+
+    with tarfile.open(tmp_path, 'w', format=tarfile.PAX_FORMAT) as tar:
+        for rel_path in kept:
+            path = os.path.join(subject_dir, rel_path)
+            with open(path, 'rb') as f:
+                data = f.read()
+            original_bytes += len(data)
+
+            if rel_path.endswith(PRECOMPRESSED_SUFFIXES):
+                codec, payload = 'none', data
+            else:
+                codec, payload = method, compress(data)
+            codecs[rel_path] = (codec, len(data))
+
+            name = f"{subject_id}/{rel_path}{CODEC_SUFFIXES[codec]}"
+            member_names[name] = rel_path
+            info = tarfile.TarInfo(name=name)
+            info.size = len(payload)
+            info.mtime = int(os.path.getmtime(path))
+            tar.addfile(info, io.BytesIO(payload))
+
+    # Record where each member's data starts so extract_file can seek straight to it
+    members = {}
+    with tarfile.open(tmp_path, 'r:') as tar:
+        for info in tar:
+            rel_path = member_names[info.name]
+            codec, original_size = codecs[rel_path]
+            members[rel_path] = {
+                'offset': info.offset_data,
+                'size': info.size,
+                'original_size': original_size,
+                'codec': codec,
+            }
+
+    os.replace(tmp_path, archive_path)
+    with open(archive_path + INDEX_SUFFIX, 'w') as f:
+        json.dump({'subject_id': subject_id, 'method': method, 'members': members}, f)
+
+    return {
+        'subject_id': subject_id,
+        'archive': archive_path,
+        'files': len(kept),
+        'original_bytes': original_bytes,
+        'archive_bytes': os.path.getsize(archive_path),
+    }
+
+
+def archive_subjects(subjects_dir, output_dir, subjects=None, patterns=None, method='zstd', level=None,
+                     workers=None, prune=False):
+    """
+    Archive finished subjects in parallel using a process pool
+
+    :param subjects_dir: FreeSurfer SUBJECTS_DIR
+    :param output_dir: Folder receiving the archives
+    :param subjects: List of subject IDs (default: every subject with scripts/recon-all.done)
+    :param patterns: Keep-list glob patterns (default: DEFAULT_KEEP_PATTERNS)
+    :param method: 'zstd' or 'xz'
+    :param level: Compression level
+    :param workers: Number of worker processes (default: CPU count)
+    :param prune: Also delete files not on the keep-list from the subject directory
+    :return: List of archive summaries
+    """
+    patterns = patterns or DEFAULT_KEEP_PATTERNS
+    if subjects is None:
+        subjects = sorted(
+            s for s in os.listdir(subjects_dir)
+            if os.path.isfile(os.path.join(subjects_dir, s, 'scripts', 'recon-all.done'))
+        )
+
+    os.makedirs(output_dir, exist_ok=True)
+    # Fail early if the codec is unavailable instead of once per worker
+    get_codec(method, level)
+
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(archive_subject, os.path.join(subjects_dir, s), output_dir, patterns, method, level): s
+            for s in subjects
+        }
+        for future in as_completed(futures):
+            subject_id = futures[future]
+            try:
+                summary = future.result()
+            except Exception as e:
+                logging.error(f"Failed to archive {subject_id}: {e}")
+                continue
+
+            ratio = summary['original_bytes'] / summary['archive_bytes'] if summary['archive_bytes'] else 0
+            logging.info(f"Archived {subject_id}: {summary['files']} files, "
+                         f"{summary['original_bytes'] / 1e6:.1f} MB -> {summary['archive_bytes'] / 1e6:.1f} MB "
+                         f"({ratio:.1f}x)")
+            results.append(summary)
+
+            if prune:
+                removed, freed = prune_subject(os.path.join(subjects_dir, subject_id), patterns)
+                logging.info(f"Pruned {subject_id}: removed {removed} files ({freed / 1e6:.1f} MB)")
+
+    return sorted(results, key=lambda r: r['subject_id'])
+
+
+def extract_file(archive_path, member, dest=None):
+    """
+    Extract a single file from a subject archive without reading the rest of it
+
+    :param archive_path: Path to <subject>.tar
+    :param member: File path relative to the subject directory (e.g. stats/aseg.stats)
+    :param dest: Optional output path; if omitted the bytes are only returned
+    :return: The decompressed file contents
+    """
+    with open(archive_path + INDEX_SUFFIX, 'r') as f:
+        index = json.load(f)
+
+    entry = index['members'].get(member)
+    if entry is None:
+        raise KeyError(f"{member} not found in {archive_path}")
+
+    with open(archive_path, 'rb') as f:
+        f.seek(entry['offset'])
+        data = decompress(entry['codec'], f.read(entry['size']))
+
+    if dest:
+        dest_dir = os.path.dirname(dest)
+        if dest_dir:
+            os.makedirs(dest_dir, exist_ok=True)
+        with open(dest, 'wb') as f:
+            f.write(data)
+    return data
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Prune and archive FreeSurfer subject directories')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    pack_parser = subparsers.add_parser('pack', help='Archive finished subjects')
+    pack_parser.add_argument('--subjects-dir', required=True, help='FreeSurfer SUBJECTS_DIR')
+    pack_parser.add_argument('--output-dir', required=True, help='Folder receiving the archives')
+    pack_parser.add_argument('--subjects', default=None,
+                             help='File with subject IDs to archive (default: all finished subjects)')
+    pack_parser.add_argument('--keep-list', default=None,
+                             help='File with glob patterns of files to keep (default: built-in list)')
+    pack_parser.add_argument('--method', choices=['zstd', 'xz'], default='zstd',
+                             help='Compression method (default: zstd)')
+    pack_parser.add_argument('--level', type=int, default=None, help='Compression level')
+    pack_parser.add_argument('-p', '--parallel', type=int, default=None,
+                             help='Number of compression processes (default: CPU count)')
+    pack_parser.add_argument('--prune', action='store_true',
+                             help='Delete files not on the keep-list from the subject directories')
+
+    extract_parser = subparsers.add_parser('extract', help='Extract a single file from an archive')
+    extract_parser.add_argument('archive', help='Path to <subject>.tar')
+    extract_parser.add_argument('member', help='File path inside the subject directory, e.g. stats/aseg.stats')
+    extract_parser.add_argument('--output', default=None, help='Output path (default: print to stdout)')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    if args.command == 'pack':
+        subject_ids = None
+        if args.subjects:
+            with open(args.subjects, 'r') as f:
+                subject_ids = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+        keep_patterns = load_keep_patterns(args.keep_list) if args.keep_list else DEFAULT_KEEP_PATTERNS
+
+        summaries = archive_subjects(args.subjects_dir, args.output_dir, subject_ids, keep_patterns,
+                                     args.method, args.level, args.parallel, args.prune)
+        total_original = sum(s['original_bytes'] for s in summaries)
+        total_archived = sum(s['archive_bytes'] for s in summaries)
+        logging.info(f"Archived {len(summaries)} subjects: "
+                     f"{total_original / 1e6:.1f} MB -> {total_archived / 1e6:.1f} MB")
+    else:
+        contents = extract_file(args.archive, args.member, args.output)
+        if not args.output:
+            os.write(1, contents)
@@ -0,0 +1,859 @@
+#!/usr/bin/env python3
+# Benchmark every pipeline stage on synthetic data.
+# No ADHD-200 data, AWS credentials or FreeSurfer installation is needed: the generators below
+# create multi-site BIDS trees, tiny NIfTI files, fake S3 manifests and a stub recon-all.
+import argparse
+import contextlib
+import csv
+import datetime
+import gzip
+import io
+import json
+import logging
+import os
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+SITES = ['KKI', 'NeuroIMAGE', 'NYU', 'OHSU', 'Peking_1', 'Peking_2', 'Peking_3', 'Pittsburgh', 'WashU']
+
+DEFAULT_SCALES = [100, 1000, 10000]
+
+RESULT_FIELDS = ['timestamp', 'commit', 'stage', 'n_subjects', 'seconds', 'ms_per_subject', 'status']
+
+# Subcortical structures written to the fake aseg.stats
+ASEG_STRUCTURES = [
+    'Left-Lateral-Ventricle', 'Left-Inf-Lat-Vent', 'Left-Cerebellum-White-Matter', 'Left-Cerebellum-Cortex',
+    'Left-Thalamus', 'Left-Caudate', 'Left-Putamen', 'Left-Pallidum', '3rd-Ventricle', '4th-Ventricle',
+    'Brain-Stem', 'Left-Hippocampus', 'Left-Amygdala', 'CSF', 'Left-Accumbens-area', 'Left-VentralDC',
+    'Right-Lateral-Ventricle', 'Right-Inf-Lat-Vent', 'Right-Cerebellum-White-Matter', 'Right-Cerebellum-Cortex',
+    'Right-Thalamus', 'Right-Caudate', 'Right-Putamen', 'Right-Pallidum', 'Right-Hippocampus', 'Right-Amygdala',
+    'Right-Accumbens-area', 'Right-VentralDC', 'WM-hypointensities', 'CC_Posterior', 'CC_Mid_Posterior',
+    'CC_Central', 'CC_Mid_Anterior', 'CC_Anterior',
+]
+
+# Desikan-Killiany regions written to the fake ?h.aparc.stats
+APARC_REGIONS = [
+    'bankssts', 'caudalanteriorcingulate', 'caudalmiddlefrontal', 'cuneus', 'entorhinal', 'fusiform',
+    'inferiorparietal', 'inferiortemporal', 'isthmuscingulate', 'lateraloccipital', 'lateralorbitofrontal',
+    'lingual', 'medialorbitofrontal', 'middletemporal', 'parahippocampal', 'paracentral', 'parsopercularis',
+    'parsorbitalis', 'parstriangularis', 'pericalcarine', 'postcentral', 'posteriorcingulate', 'precentral',
+    'precuneus', 'rostralanteriorcingulate', 'rostralmiddlefrontal', 'superiorfrontal', 'superiorparietal',
+    'superiortemporal', 'supramarginal', 'frontalpole', 'temporalpole', 'transversetemporal', 'insula',
+]
+
+# recon-all -all steps with typical wall-clock minutes, used for the fake logs
+RECON_STEPS = [
+    ('MotionCor', 1), ('Talairach', 2), ('Talairach Failure Detection', 0.2), ('Nu Intensity Correction', 2),
+    ('Intensity Normalization', 1), ('Skull Stripping', 5), ('EM Registration', 10), ('CA Normalize', 1),
+    ('CA Reg', 60), ('SubCort Seg', 20), ('Merge ASeg', 0.5), ('Intensity Normalization2', 2),
+    ('Mask BFS', 0.2), ('WM Segmentation', 1), ('Fill', 1), ('Tessellate lh', 1), ('Smooth1 lh', 0.2),
+    ('Inflation1 lh', 1), ('QSphere lh', 5), ('Fix Topology lh', 15), ('White Surf lh', 5),
+    ('Smooth2 lh', 0.2), ('Inflation2 lh', 1), ('Sphere lh', 20), ('Surf Reg lh', 30),
+    ('Cortical Parc lh', 1), ('Pial Surf lh', 10), ('Cortical ribbon mask', 5), ('Parcellation Stats lh', 1),
+    ('AParc-to-ASeg aparc', 5), ('ASeg Stats', 2), ('BA_exvivo Labels lh', 10),
+]
+
+
+def write_tiny_nifti(path, shape=(4, 4, 4), voxel_size=(1.0, 1.0, 1.0)):
+    """
+    Write a minimal valid NIfTI-1 file (int16 zeros). Gzipped if the path ends with .gz.
+
+    :param path: Output path
+    :param shape: Image dimensions (3D or 4D)
+    :param voxel_size: Voxel size in mm for the spatial dimensions
+    """
+    header = bytearray(348)
+    struct.pack_into('<i', header, 0, 348)
+    dims = [len(shape)] + list(shape) + [1] * (7 - len(shape))
+    struct.pack_into('<8h', header, 40, *dims)
+    struct.pack_into('<2h', header, 70, 4, 16)
+    pixdim = [1.0] + list(voxel_size) + [1.0] * (7 - len(voxel_size))
+    struct.pack_into('<8f', header, 76, *pixdim)
+    struct.pack_into('<f', header, 108, 352.0)
+    header[344:348] = b'n+1\x00'
+
+    n_voxels = 1
+    for d in shape:
+        n_voxels *= d
+    data = bytes(header) + b'\x00' * 4 + b'\x00' * (2 * n_voxels)
+
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'wb') as f:
+        f.write(data)
+
+
+def make_bids_tree(root, n_subjects, session_fraction=0.2, func_fraction=0.5, seed=42):
+    """
+    Create a multi-site ADHD-200 style BIDS tree with a participants.tsv per site
+
+    :param root: Output directory (one folder per site)
+    :param n_subjects: Total number of subjects, spread over SITES
+    :param session_fraction: Fraction of subjects stored under a ses-1 folder
+    :param func_fraction: Fraction of subjects that also get a functional run
+    :param seed: Random seed
+    :return: List of numeric participant IDs
+    """
+    rng = random.Random(seed)
+    participants = {site: [] for site in SITES}
+    ids = []
+
+    for i in range(n_subjects):
+        site = SITES[i % len(SITES)]
+        participant_id = 10001 + i
+        ids.append(participant_id)
+        participants[site].append(participant_id)
+
+        subject_dir = os.path.join(root, site, f"sub-{participant_id}")
+        if rng.random() < session_fraction:
+            subject_dir = os.path.join(subject_dir, 'ses-1')
+
+        anat_dir = os.path.join(subject_dir, 'anat')
+        os.makedirs(anat_dir, exist_ok=True)
+        write_tiny_nifti(os.path.join(anat_dir, f"sub-{participant_id}_T1w.nii.gz"))
+
+        if rng.random() < func_fraction:
+            func_dir = os.path.join(subject_dir, 'func')
+            os.makedirs(func_dir, exist_ok=True)
+            write_tiny_nifti(os.path.join(func_dir, f"sub-{participant_id}_task-rest_bold.nii.gz"),
+                             shape=(4, 4, 4, 5))
+
+    for site, site_ids in participants.items():
+        if not site_ids:
+            continue
+        with open(os.path.join(root, site, 'participants.tsv'), 'w') as f:
+            f.write('participant_id\tgender\tage\thandedness\tverbal_iq\tdx\tadhd_index\tadhd_measure\n')
+            for participant_id in site_ids:
+                dx = rng.choice(['ADHD', 'TDC'])
+                f.write(f"{participant_id}\t{rng.choice(['M', 'F'])}\t{rng.uniform(7, 21):.2f}\tRight\t"
+                        f"{rng.randint(80, 130)}\t{dx}\t{rng.randint(40, 90)}\tADHD-RS\n")
+    return ids
+
+
+def make_s3_manifest(n_objects, bucket_name='biomedin260', region='us-east-1', bucket_root=None):
+    """
+    Build an s3_objects.json style manifest, optionally backed by local files
+
+    :param n_objects: Number of objects
+    :param bucket_name: Bucket name used in the URIs
+    :param region: Region used in the URLs
+    :param bucket_root: If set, a tiny NIfTI is written at <bucket_root>/<key> for every object
+    :return: List of manifest entries
+    """
+    objects = []
+    for i in range(n_objects):
+        participant_id = 10001 + i
+        key = f"data/anat/sub-{participant_id:07d}/sub-{participant_id}_T1w.nii.gz"
+        if bucket_root:
+            path = os.path.join(bucket_root, key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            write_tiny_nifti(path)
+        objects.append({
+            "key": key,
+            "url": f"https://{bucket_name}.s3.{region}.amazonaws.com/{key}",
+            "s3_uri": f"s3://{bucket_name}/{key}",
+            "aws_cli_download": f"aws s3 cp s3://{bucket_name}/{key} .",
+        })
+    return objects
+
+
+def make_stub_aws(bin_dir):
+    """
+    Write an `aws` stub whose `aws s3 cp s3://bucket/key dest` copies $BENCH_S3_ROOT/key to dest
+
+    :param bin_dir: Folder to put the stub in (prepend it to PATH)
+    """
+    path = os.path.join(bin_dir, 'aws')
+    with open(path, 'w') as f:
+        f.write('#!/bin/sh\ncp "$BENCH_S3_ROOT/${3#s3://*/}" "$4"\n')
+    os.chmod(path, 0o755)
+    return path
+
+
+def write_fake_volumes(subjects_dir, subject_id, func_dir=None, size=64, n_frames=120, seed=None):
+    """
+    Write a blocky aparc+aseg.mgz with matching T1.mgz and brainmask.mgz and, if func_dir is
+    given, a 2 mm BOLD run covering the same field of view
+
+    :param subjects_dir: SUBJECTS_DIR to write <subject_id>/mri into
+    :param subject_id: Subject ID
+    :param func_dir: func/ folder for <subject_id>/<subject_id>_task-rest_bold.nii.gz, or None
+    :param size: Edge length of the 1 mm anatomical volumes
+    :param n_frames: Number of BOLD frames
+    :param seed: Random seed
+    """
+    import numpy as np
+    from volume_io import aparc_aseg_rois, write_mgh
+
+    rng = np.random.default_rng(seed)
+    mri_dir = os.path.join(subjects_dir, subject_id, 'mri')
+    os.makedirs(mri_dir, exist_ok=True)
+
+    # FreeSurfer conformed (LIA) orientation centred on the origin
+    half = size / 2.0
+    anat_affine = np.array([[-1.0, 0, 0, half], [0, 0, 1.0, -half], [0, -1.0, 0, half], [0, 0, 0, 1.0]])
+    block = max(1, size // 8)
+    choices = sorted(aparc_aseg_rois()) + [0, 2, 41]
+    blocks = rng.choice(choices, size=(size // block,) * 3)
+    labels = np.kron(blocks, np.ones((block,) * 3, dtype=np.int32)).astype(np.int32)
+    write_mgh(os.path.join(mri_dir, 'aparc+aseg.mgz'), labels, anat_affine)
+
+    t1 = np.clip(rng.normal(80, 20, size=labels.shape) + (labels > 0) * 30, 0, 255).astype(np.uint8)
+    write_mgh(os.path.join(mri_dir, 'T1.mgz'), t1, anat_affine)
+    write_mgh(os.path.join(mri_dir, 'brainmask.mgz'), np.where(labels > 0, t1, 0).astype(np.uint8), anat_affine)
+
+    if func_dir:
+        bold_size = size // 2
+        bold_affine = np.diag([2.0, 2.0, 2.0, 1.0])
+        bold_affine[:3, 3] = -half
+        bold = rng.normal(1000, 50, size=(bold_size,) * 3 + (n_frames,)).astype('<i2')
+
+        header = bytearray(348)
+        struct.pack_into('<i', header, 0, 348)
+        struct.pack_into('<8h', header, 40, 4, bold_size, bold_size, bold_size, n_frames, 1, 1, 1)
+        struct.pack_into('<2h', header, 70, 4, 16)
+        struct.pack_into('<8f', header, 76, 1.0, 2.0, 2.0, 2.0, 2.0, 1.0, 1.0, 1.0)
+        struct.pack_into('<f', header, 108, 352.0)
+        struct.pack_into('<h', header, 254, 1)
+        struct.pack_into('<12f', header, 280, *bold_affine[:3].ravel())
+        header[344:348] = b'n+1\x00'
+
+        subject_func_dir = os.path.join(func_dir, subject_id)
+        os.makedirs(subject_func_dir, exist_ok=True)
+        with gzip.open(os.path.join(subject_func_dir, f"{subject_id}_task-rest_bold.nii.gz"), 'wb',
+                       compresslevel=1) as f:
+            f.write(bytes(header) + b'\x00' * 4 + bold.tobytes(order='F'))
+
+
+def write_fake_subject(subjects_dir, subject_id, seed=None):
+    """
+    Write what recon-all leaves behind for a subject: stats files, logs and recon-all.done
+
+    :param subjects_dir: FreeSurfer SUBJECTS_DIR
+    :param subject_id: Subject ID
+    :param seed: Random seed (default: derived from the subject ID)
+    """
+    rng = random.Random(seed if seed is not None else subject_id)
+    subject_dir = os.path.join(subjects_dir, subject_id)
+    for folder in ('stats', 'scripts', 'mri', 'surf', 'label'):
+        os.makedirs(os.path.join(subject_dir, folder), exist_ok=True)
+
+    with open(os.path.join(subject_dir, 'stats', 'aseg.stats'), 'w') as f:
+        f.write(f"# Title Segmentation Statistics\n# subjectname {subject_id}\n")
+        f.write(f"# Measure BrainSeg, BrainSegVol, Brain Segmentation Volume, {rng.uniform(1.0e6, 1.4e6):.1f}, mm^3\n")
+        f.write(f"# Measure EstimatedTotalIntraCranialVol, eTIV, Estimated Total Intracranial Volume, "
+                f"{rng.uniform(1.3e6, 1.7e6):.1f}, mm^3\n")
+        f.write("# ColHeaders  Index SegId NVoxels Volume_mm3 StructName normMean normStdDev normMin normMax normRange\n")
+        for index, name in enumerate(ASEG_STRUCTURES, start=1):
+            volume = rng.uniform(200, 15000)
+            f.write(f"{index:3d} {index + 3:4d} {int(volume):6d} {volume:8.1f} {name:<30s} "
+                    f"{rng.uniform(60, 110):.4f} {rng.uniform(5, 15):.4f} 20.0000 140.0000 120.0000\n")
+
+    for hemi in ('lh', 'rh'):
+        with open(os.path.join(subject_dir, 'stats', f'{hemi}.aparc.stats'), 'w') as f:
+            f.write(f"# Table of FreeSurfer cortical parcellation anatomical statistics\n# hemi {hemi}\n")
+            f.write(f"# Measure Cortex, MeanThickness, Mean Thickness, {rng.uniform(2.3, 2.9):.5f}, mm\n")
+            f.write("# ColHeaders StructName NumVert SurfArea GrayVol ThickAvg ThickStd MeanCurv GausCurv "
+                    "FoldInd CurvInd\n")
+            for name in APARC_REGIONS:
+                f.write(f"{name:<25s} {rng.randint(500, 12000):6d} {rng.randint(300, 8000):6d} "
+                        f"{rng.randint(1000, 25000):6d} {rng.uniform(1.8, 3.5):.3f} {rng.uniform(0.4, 0.9):.3f} "
+                        f"{rng.uniform(0.08, 0.16):.3f} {rng.uniform(0.01, 0.04):.3f} {rng.randint(5, 200):3d} "
+                        f"{rng.uniform(0.5, 9):.1f}\n")
+
+    timestamp = datetime.datetime(2025, 1, 1, 8, 0, 0) + datetime.timedelta(minutes=rng.uniform(0, 60 * 24))
+    log_lines = []
+    status_lines = []
+    for step, minutes in RECON_STEPS:
+        marker = f"#@# {step} {timestamp.strftime('%a %b %d %H:%M:%S')} UTC {timestamp.year}"
+        log_lines.append(marker)
+        status_lines.append(marker)
+        duration = minutes * 60 * rng.uniform(0.7, 1.5)
+        log_lines.append(f"@#@FSTIME  {timestamp.strftime('%Y:%m:%d:%H:%M:%S')} mri_step N 1 e {duration:.2f} "
+                         f"S {duration * 0.02:.2f} U {duration * 0.95:.2f} P 97% M {rng.randint(200000, 2500000)} "
+                         f"F 0 R 1000 W 0 c 10 w 50 I 0 O 100 L 1.0 1.0 1.0")
+        timestamp += datetime.timedelta(seconds=duration)
+    log_lines.append(f"recon-all -s {subject_id} finished without error at "
+                     f"{timestamp.strftime('%a %b %d %H:%M:%S')} UTC {timestamp.year}")
+    status_lines.append("#@#%# recon-all done")
+
+    with open(os.path.join(subject_dir, 'scripts', 'recon-all.log'), 'w') as f:
+        f.write('\n'.join(log_lines) + '\n')
+    with open(os.path.join(subject_dir, 'scripts', 'recon-all-status.log'), 'w') as f:
+        f.write('\n'.join(status_lines) + '\n')
+    for name in ('mri/aparc+aseg.mgz', 'mri/brainmask.mgz', 'surf/lh.white', 'surf/rh.white'):
+        with open(os.path.join(subject_dir, name), 'wb') as f:
+            f.write(os.urandom(1024))
+    with open(os.path.join(subject_dir, 'scripts', 'recon-all.done'), 'w') as f:
+        f.write(f"END_TIME {timestamp.isoformat()}\n")
+
+
+def make_stub_recon_all(bin_dir):
+    """
+    Write a `recon-all` stub that calls write_fake_subject for the folder recon-all would create:
+    the -subject argument, the -base template or <timepoint>.long.<template> for -long
+
+    :param bin_dir: Folder to put the stub in
+    :return: Path to the stub
+    """
+    path = os.path.join(bin_dir, 'recon-all')
+    with open(path, 'w') as f:
+        f.write(f"#!{sys.executable}\n"
+                "import os\nimport sys\n"
+                f"sys.path.insert(0, {REPO_DIR!r})\n"
+                "from benchmark import write_fake_subject\n"
+                "args = sys.argv[1:]\n"
+                "if '-subject' in args:\n"
+                "    subject_id = args[args.index('-subject') + 1]\n"
+                "elif '-base' in args:\n"
+                "    subject_id = args[args.index('-base') + 1]\n"
+                "else:\n"
+                "    subject_id = '.long.'.join(args[args.index('-long') + 1:args.index('-long') + 3])\n"
+                "print(f'Stub recon-all for {subject_id}')\n"
+                "write_fake_subject(os.environ['SUBJECTS_DIR'], subject_id)\n")
+    os.chmod(path, 0o755)
+    return path
+
+
+# ---------------------------------------------------------------------------
+# Stages. Each takes (workdir, n_subjects), prepares its inputs and returns a zero-argument
+# function; only that function is timed.
+# ---------------------------------------------------------------------------
+
+def stage_s3_listing(workdir, n_subjects):
+    import boto3
+    from moto import mock_aws
+    from get_s3_object_list import get_s3_object_references
+
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    mock = mock_aws()
+    mock.start()
+    client = boto3.client('s3')
+    client.create_bucket(Bucket='biomedin260')
+    for obj in make_s3_manifest(n_subjects):
+        client.put_object(Bucket='biomedin260', Key=obj['key'], Body=b'')
+
+    def run():
+        try:
+            get_s3_object_references('biomedin260')
+        finally:
+            mock.stop()
+    return run
+
+
+def stage_remote_headers(workdir, n_subjects):
+    import boto3
+    from moto import mock_aws
+    from remote_headers import inspect_objects
+
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    mock = mock_aws()
+    mock.start()
+    client = boto3.client('s3')
+    client.create_bucket(Bucket='biomedin260')
+    nifti_path = os.path.join(workdir, 'T1w.nii.gz')
+    write_tiny_nifti(nifti_path, shape=(64, 64, 64))
+    with open(nifti_path, 'rb') as f:
+        body = f.read()
+    objects = make_s3_manifest(n_subjects)
+    for obj in objects:
+        client.put_object(Bucket='biomedin260', Key=obj['key'], Body=body)
+
+    def run():
+        try:
+            inspect_objects(objects, client)
+        finally:
+            mock.stop()
+    return run
+
+
+def stage_download(workdir, n_subjects):
+    from download_s3 import download_s3_objects
+
+    bucket_root = os.path.join(workdir, 'bucket')
+    bin_dir = os.path.join(workdir, 'bin')
+    os.makedirs(bin_dir)
+    manifest_path = os.path.join(workdir, 's3_objects.json')
+    with open(manifest_path, 'w') as f:
+        json.dump(make_s3_manifest(n_subjects, bucket_root=bucket_root), f)
+    make_stub_aws(bin_dir)
+    os.environ['BENCH_S3_ROOT'] = bucket_root
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+
+    return lambda: download_s3_objects(manifest_path, os.path.join(workdir, 'anat'))
+
+
+def stage_organize(workdir, n_subjects):
+    from data_organizer import organize_mri_data
+
+    raw_root = os.path.join(workdir, 'raw_data')
+    make_bids_tree(raw_root, n_subjects)
+    return lambda: [organize_mri_data(os.path.join(raw_root, site), workdir) for site in SITES]
+
+
+def stage_phenotype(workdir, n_subjects):
+    from phenotype_data import aggregate_phenotypes
+
+    raw_root = os.path.join(workdir, 'raw_data')
+    make_bids_tree(raw_root, n_subjects, func_fraction=0)
+    return lambda: aggregate_phenotypes(raw_root)
+
+
+def stage_dataset(workdir, n_subjects):
+    from data_organizer import organize_mri_data
+    from dataset_generator import generate_dataset
+    from phenotype_data import aggregate_phenotypes
+
+    raw_root = os.path.join(workdir, 'raw_data')
+    make_bids_tree(raw_root, n_subjects, func_fraction=0)
+    with contextlib.redirect_stdout(io.StringIO()):
+        for site in SITES:
+            organize_mri_data(os.path.join(raw_root, site), workdir)
+        aggregate_phenotypes(raw_root)
+
+    return lambda: generate_dataset(raw_root, os.path.join(workdir, 'dataset'), os.path.join(workdir, 'anat'))
+
+
+def stage_features(workdir, n_subjects):
+    from freesurfer_stats import extract_subject_features, write_feature_table
+
+    subjects_dir = os.path.join(workdir, 'subjects')
+    subject_ids = [f"sub-{10001 + i:07d}" for i in range(n_subjects)]
+    for subject_id in subject_ids:
+        write_fake_subject(subjects_dir, subject_id)
+
+    def run():
+        rows = [extract_subject_features(os.path.join(subjects_dir, s)) for s in subject_ids]
+        write_feature_table(rows, os.path.join(workdir, 'features.csv'))
+    return run
+
+
+def stage_functional(workdir, n_subjects):
+    from functional_features import extract_functional_features
+
+    subjects_dir = os.path.join(workdir, 'subjects')
+    func_dir = os.path.join(workdir, 'func')
+    subject_ids = [f"sub-{10001 + i:07d}" for i in range(n_subjects)]
+    for i, subject_id in enumerate(subject_ids):
+        write_fake_volumes(subjects_dir, subject_id, func_dir, size=32, n_frames=60, seed=i)
+
+    return lambda: extract_functional_features(subject_ids, func_dir, subjects_dir, os.path.join(workdir, 'store'),
+                                               workers=os.cpu_count() or 4)
+
+
+def stage_regional(workdir, n_subjects):
+    from regional_features import extract_regional_features
+
+    subjects_dir = os.path.join(workdir, 'subjects')
+    subject_ids = [f"sub-{10001 + i:07d}" for i in range(n_subjects)]
+    for i, subject_id in enumerate(subject_ids):
+        write_fake_volumes(subjects_dir, subject_id, seed=i)
+
+    return lambda: extract_regional_features([os.path.join(subjects_dir, s) for s in subject_ids],
+                                             workers=os.cpu_count() or 4)
+
+
+def stage_volume_cache(workdir, n_subjects):
+    import volume_cache
+    from regional_features import extract_regional_features
+
+    subjects_dir = os.path.join(workdir, 'subjects')
+    subject_dirs = [os.path.join(subjects_dir, f"sub-{10001 + i:07d}") for i in range(n_subjects)]
+    for i, subject_dir in enumerate(subject_dirs):
+        write_fake_volumes(subjects_dir, os.path.basename(subject_dir), seed=i)
+
+    # Fill the cache first, so the timed run is the warm path of a second feature pass
+    cache = volume_cache.VolumeCache(os.path.join(workdir, 'volume_cache'), 1024 ** 3)
+    for subject_dir in subject_dirs:
+        for volume_name in ('aparc+aseg', 'T1', 'brainmask'):
+            cache.path(os.path.join(subject_dir, 'mri', f"{volume_name}.mgz"))
+
+    def run():
+        volume_cache.configure(cache.cache_dir, cache.budget_bytes / 1024 ** 3)
+        try:
+            extract_regional_features(subject_dirs, workers=os.cpu_count() or 4)
+        finally:
+            del os.environ[volume_cache.CACHE_DIR_ENV]
+    return run
+
+
+def stage_shards(workdir, n_subjects):
+    from volume_shards import ShardReader, build_shards
+
+    subjects_dir = os.path.join(workdir, 'subjects')
+    data_dir = os.path.join(workdir, 'data')
+    os.makedirs(data_dir)
+    subject_ids = [f"sub-{10001 + i:07d}" for i in range(n_subjects)]
+    for i, subject_id in enumerate(subject_ids):
+        write_fake_volumes(subjects_dir, subject_id, seed=i)
+    n_train = max(1, int(n_subjects * 0.6))
+    n_validation = max(1, int(n_subjects * 0.2))
+    splits = {'train': subject_ids[:n_train], 'validation': subject_ids[n_train:n_train + n_validation],
+              'test': subject_ids[n_train + n_validation:]}
+    for split, ids in splits.items():
+        with open(os.path.join(data_dir, f"{split}_participant_ids.txt"), 'w') as f:
+            f.write(''.join(f"{subject_id}\n" for subject_id in ids))
+
+    def run():
+        cache_dir = os.path.join(workdir, 'cache')
+        build_shards(data_dir, subjects_dir, cache_dir, crop=(48, 48, 48), shape=(32, 32, 32),
+                     workers=os.cpu_count() or 4)
+        for _ in ShardReader(cache_dir, 'train', batch_size=8):
+            pass
+    return run
+
+
+def write_fake_splits(data_dir, subject_ids, seed=42):
+    """
+    Write train/validation/test_data.csv (60/20/20) in the format of dataset_generator.py
+
+    :return: Dictionary mapping subject ID to 1 (ADHD) or 0 (Typical Development)
+    """
+    rng = random.Random(seed)
+    os.makedirs(data_dir, exist_ok=True)
+    labels = {}
+    n_train = int(len(subject_ids) * 0.6)
+    n_validation = int(len(subject_ids) * 0.2)
+    splits = {'train': subject_ids[:n_train], 'validation': subject_ids[n_train:n_train + n_validation],
+              'test': subject_ids[n_train + n_validation:]}
+    for split, ids in splits.items():
+        with open(os.path.join(data_dir, f"{split}_data.csv"), 'w') as f:
+            f.write('participant_id,gender_std,age,age_group,diagnosis_status,source_folder\n')
+            for subject_id in ids:
+                labels[subject_id] = rng.randint(0, 1)
+                age = rng.uniform(7, 21)
+                age_group = 'child' if age <= 12 else 'adolescent' if age <= 17 else 'adult'
+                dx = 'ADHD' if labels[subject_id] else 'Typical Development'
+                f.write(f"{int(subject_id[4:])},{rng.choice(['male', 'female'])},{age:.2f},{age_group},{dx},"
+                        f"{rng.choice(SITES)}\n")
+    return labels
+
+
+def stage_classify(workdir, n_subjects):
+    import pandas  # noqa: F401 - keep import time out of the measurement
+    from classify import load_cohort, run_grid
+
+    subject_ids = [f"sub-{10001 + i:07d}" for i in range(max(n_subjects, 50))]
+    labels = write_fake_splits(os.path.join(workdir, 'data'), subject_ids)
+    rng = random.Random(0)
+    with open(os.path.join(workdir, 'features.csv'), 'w') as f:
+        f.write('subject_id,' + ','.join(f"feature{j}" for j in range(50)) + '\n')
+        for subject_id in subject_ids:
+            shift = 0.5 * labels[subject_id]
+            f.write(subject_id + ',' + ','.join(f"{rng.gauss(shift if j < 5 else 0, 1):.4f}" for j in range(50)) + '\n')
+
+    def run():
+        cohort, columns = load_cohort(os.path.join(workdir, 'data'), [os.path.join(workdir, 'features.csv')])
+        run_grid(cohort, columns, os.path.join(workdir, 'cache'), models=['logistic', 'svm'],
+                 workers=os.cpu_count() or 4)
+    return run
+
+
+def stage_harmonize(workdir, n_subjects):
+    import pandas  # noqa: F401 - keep import time out of the measurement
+    from classify import load_cohort
+    from harmonize import harmonize_cohort
+
+    subject_ids = [f"sub-{10001 + i:07d}" for i in range(max(n_subjects, 100))]
+    write_fake_splits(os.path.join(workdir, 'data'), subject_ids)
+    rng = random.Random(0)
+    # Vertex-level scale: a per-site offset on every feature
+    site_offsets = {site: rng.gauss(0, 1) for site in SITES}
+    sites = {}
+    for split in ('train', 'validation', 'test'):
+        with open(os.path.join(workdir, 'data', f"{split}_data.csv"), 'r', newline='') as f:
+            sites.update((f"sub-{int(row['participant_id']):07d}", row['source_folder']) for row in csv.DictReader(f))
+    with open(os.path.join(workdir, 'features.csv'), 'w') as f:
+        f.write('subject_id,' + ','.join(f"vertex{j}" for j in range(5000)) + '\n')
+        for subject_id in subject_ids:
+            offset = site_offsets[sites[subject_id]]
+            f.write(subject_id + ',' + ','.join(f"{rng.gauss(offset, 1):.3f}" for _ in range(5000)) + '\n')
+
+    def run():
+        cohort_df, columns = load_cohort(os.path.join(workdir, 'data'), [os.path.join(workdir, 'features.csv')])
+        harmonize_cohort(cohort_df, columns)
+    return run
+
+
+def stage_group_stats(workdir, n_subjects):
+    import pandas  # noqa: F401 - keep import time out of the measurement
+    from classify import load_cohort
+    from group_stats import group_comparison
+
+    subject_ids = [f"sub-{10001 + i:07d}" for i in range(max(n_subjects, 100))]
+    write_fake_splits(os.path.join(workdir, 'data'), subject_ids)
+    rng = random.Random(0)
+    with open(os.path.join(workdir, 'features.csv'), 'w') as f:
+        f.write('subject_id,' + ','.join(f"vertex{j}" for j in range(5000)) + '\n')
+        for subject_id in subject_ids:
+            f.write(subject_id + ',' + ','.join(f"{rng.gauss(0, 1):.3f}" for _ in range(5000)) + '\n')
+
+    def run():
+        cohort_df, columns = load_cohort(os.path.join(workdir, 'data'), [os.path.join(workdir, 'features.csv')])
+        group_comparison(cohort_df, columns, n_permutations=500, workers=os.cpu_count() or 4)
+    return run
+
+
+def stage_metrics(workdir, n_subjects):
+    from recon_metrics import MetricsStore
+
+    subjects_dir = os.path.join(workdir, 'subjects')
+    for i in range(n_subjects):
+        write_fake_subject(subjects_dir, f"sub-{10001 + i:07d}")
+
+    def run():
+        store = MetricsStore(os.path.join(workdir, 'metrics.db'))
+        store.ingest_subjects_dir(subjects_dir)
+        store.export_site_summary(os.path.join(workdir, 'summary.csv'))
+        store.close()
+    return run
+
+
+def stage_progress(workdir, n_subjects):
+    from recon_progress import ProgressMonitor
+
+    subjects_dir = os.path.join(workdir, 'subjects')
+    for i in range(n_subjects):
+        write_fake_subject(subjects_dir, f"sub-{10001 + i:07d}")
+
+    def run():
+        monitor = ProgressMonitor(subjects_dir, jobs=os.cpu_count() or 4)
+        # The second poll only checks the log sizes
+        for _ in range(2):
+            monitor.poll()
+            monitor.status()
+    return run
+
+
+def stage_capacity(workdir, n_subjects):
+    from capacity_planner import plan
+
+    rng = random.Random(0)
+    costs = [rng.uniform(5, 12) * 3600 for _ in range(n_subjects)]
+    return lambda: plan(costs, nodes=4, cores=16, memory_gb=64, deadline_hours=72, max_nodes=64)
+
+
+def stage_manifest(workdir, n_subjects):
+    from pipeline import find_subject_objects
+    from s3_manifest import Manifest
+
+    manifest_path = os.path.join(workdir, 's3_objects.db')
+    manifest = Manifest(manifest_path)
+    manifest.add_objects(make_s3_manifest(n_subjects))
+    subject_ids = [f"sub-{10001 + i:07d}" for i in range(n_subjects)]
+
+    def lookup_all():
+        for subject_id in subject_ids:
+            find_subject_objects(manifest, subject_id)
+        manifest.by_prefix('data/anat/')
+
+    return lookup_all
+
+
+def stage_pipeline(workdir, n_subjects):
+    from pipeline import StreamingPipeline
+
+    bucket_root = os.path.join(workdir, 'bucket')
+    bin_dir = os.path.join(workdir, 'bin')
+    os.makedirs(bin_dir)
+    objects = make_s3_manifest(n_subjects, bucket_root=bucket_root)
+    make_stub_aws(bin_dir)
+    recon_all = make_stub_recon_all(bin_dir)
+    os.environ['BENCH_S3_ROOT'] = bucket_root
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+
+    pipeline = StreamingPipeline(objects, os.path.join(workdir, 'anat'), os.path.join(workdir, 'subjects'),
+                                 jobs=os.cpu_count() or 4, recon_all=recon_all)
+    subject_ids = [f"sub-{10001 + i:07d}" for i in range(n_subjects)]
+    return lambda: pipeline.run(subject_ids)
+
+
+def stage_longitudinal(workdir, n_subjects):
+    from longitudinal import build_dag, run_dag, select_session_scans
+
+    bin_dir = os.path.join(workdir, 'bin')
+    os.makedirs(bin_dir)
+    recon_all = make_stub_recon_all(bin_dir)
+    # Every other subject has two sessions
+    session_scans = {}
+    for i in range(n_subjects):
+        subject_id = f"sub-{10001 + i:07d}"
+        subject_dir = os.path.join(workdir, 'anat', subject_id)
+        os.makedirs(subject_dir)
+        paths = []
+        for session in (('1', '2') if i % 2 == 0 else ('1',)):
+            paths.append(os.path.join(subject_dir, f"{subject_id}_ses-{session}_run-1_T1w.nii.gz"))
+            write_tiny_nifti(paths[-1])
+        session_scans[subject_id] = select_session_scans(paths)
+
+    nodes = build_dag(session_scans)
+    return lambda: run_dag(nodes, os.path.join(workdir, 'subjects'), jobs=os.cpu_count() or 4, recon_all=recon_all)
+
+
+def stage_matching(workdir, n_subjects):
+    import pandas as pd
+    from control_matching import match_controls
+
+    # Phenotype-table scale independent of n_subjects: 5000 ADHD participants among 25000
+    rng = random.Random(0)
+    n_participants = 25000
+    participants = pd.DataFrame({
+        'participant_id': range(10001, 10001 + n_participants),
+        'diagnosis_status': ['ADHD' if i % 5 == 0 else 'Typical Development' for i in range(n_participants)],
+        'gender_std': [rng.choice(('male', 'female')) for _ in range(n_participants)],
+        'source_folder': [rng.choice(SITES) for _ in range(n_participants)],
+        'age': [rng.uniform(7, 21) for _ in range(n_participants)],
+    })
+    return lambda: match_controls(participants, ratio=2)
+
+
+STAGES = {
+    's3_listing': stage_s3_listing,
+    'remote_headers': stage_remote_headers,
+    'download': stage_download,
+    'organize': stage_organize,
+    'phenotype': stage_phenotype,
+    'dataset': stage_dataset,
+    'matching': stage_matching,
+    'features': stage_features,
+    'functional': stage_functional,
+    'regional': stage_regional,
+    'volume_cache': stage_volume_cache,
+    'shards': stage_shards,
+    'classify': stage_classify,
+    'harmonize': stage_harmonize,
+    'group_stats': stage_group_stats,
+    'metrics': stage_metrics,
+    'progress': stage_progress,
+    'capacity': stage_capacity,
+    'manifest': stage_manifest,
+    'pipeline': stage_pipeline,
+    'longitudinal': stage_longitudinal,
+}
+
+
+def get_commit():
+    """Return the short git commit of the repository, or an empty string."""
+    try:
+        result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                                capture_output=True, text=True)
+        return result.stdout.strip()
+    except OSError:
+        return ''
+
+
+def load_previous_results(results_path):
+    """Return the most recent successful result per (stage, n_subjects)."""
+    previous = {}
+    if not os.path.exists(results_path):
+        return previous
+    with open(results_path, 'r', newline='') as f:
+        for row in csv.DictReader(f):
+            if row['status'] == 'ok':
+                previous[(row['stage'], int(row['n_subjects']))] = float(row['seconds'])
+    return previous
+
+
+def run_benchmark(stage, n_subjects, keep_workdir=False):
+    """
+    Time one stage at one scale in a fresh temporary directory
+
+    :return: Tuple of (seconds or None, status)
+    """
+    workdir = tempfile.mkdtemp(prefix=f"bench_{stage}_{n_subjects}_")
+    saved_env = dict(os.environ)
+    cwd = os.getcwd()
+    # Stages log per file/subject; keep the benchmark output readable
+    logging.disable(logging.INFO)
+    try:
+        os.chdir(workdir)
+        with contextlib.redirect_stdout(io.StringIO()):
+            run = STAGES[stage](workdir, n_subjects)
+            start = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - start
+        return elapsed, 'ok'
+    except ImportError as e:
+        return None, f"skipped ({e.name or e} not installed)"
+    except Exception as e:
+        return None, f"error ({e})"
+    finally:
+        logging.disable(logging.NOTSET)
+        os.chdir(cwd)
+        os.environ.clear()
+        os.environ.update(saved_env)
+        if not keep_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark pipeline stages on synthetic data')
+    parser.add_argument('--stages', nargs='+', choices=list(STAGES), default=list(STAGES),
+                        help='Stages to run (default: all)')
+    parser.add_argument('--scales', nargs='+', type=int, default=DEFAULT_SCALES,
+                        help='Numbers of subjects to benchmark (default: 100 1000 10000)')
+    parser.add_argument('--results', default='./data/benchmark_results.csv',
+                        help='CSV that results are appended to (default: data/benchmark_results.csv)')
+    parser.add_argument('--regression-threshold', type=float, default=1.2,
+                        help='Flag a stage as regressed when it is this many times slower than last run (default: 1.2)')
+    parser.add_argument('--keep-workdir', action='store_true', help='Do not delete the synthetic data')
+
+    args = parser.parse_args()
+
+    # Make the repository modules importable regardless of the working directory
+    sys.path.insert(0, REPO_DIR)
+
+    previous_results = load_previous_results(args.results)
+    new_file = not os.path.exists(args.results)
+    results_dir = os.path.dirname(os.path.abspath(args.results))
+    os.makedirs(results_dir, exist_ok=True)
+    commit = get_commit()
+    regressions = 0
+
+    with open(args.results, 'a', newline='') as results_file:
+        writer = csv.DictWriter(results_file, fieldnames=RESULT_FIELDS)
+        if new_file:
+            writer.writeheader()
+
+        for stage_name in args.stages:
+            for scale in args.scales:
+                seconds, status = run_benchmark(stage_name, scale, args.keep_workdir)
+                writer.writerow({
+                    'timestamp': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                    'commit': commit,
+                    'stage': stage_name,
+                    'n_subjects': scale,
+                    'seconds': f"{seconds:.4f}" if seconds is not None else '',
+                    'ms_per_subject': f"{seconds * 1000 / scale:.3f}" if seconds is not None else '',
+                    'status': status,
+                })
+                results_file.flush()
+
+                if seconds is None:
+                    print(f"{stage_name:<12s} {scale:>6d} subjects: {status}")
+                    continue
+
+                line = f"{stage_name:<12s} {scale:>6d} subjects: {seconds:9.3f} s ({seconds * 1000 / scale:.3f} ms/subject)"
+                baseline = previous_results.get((stage_name, scale))
+                if baseline:
+                    ratio = seconds / baseline
+                    line += f"  {ratio:.2f}x vs previous"
+                    if ratio > args.regression_threshold:
+                        line += "  <-- REGRESSION"
+                        regressions += 1
+                print(line)
+
+    print(f"\nResults appended to {args.results}")
+    if regressions:
+        print(f"{regressions} stage(s) slower than the previous run by more than {args.regression_threshold}x")
+        sys.exit(1)
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+import argparse
+import csv
+import heapq
+import logging
+import math
+import os
+
+import numpy as np
+
+from data_organizer import format_participant_id
+from recon_metrics import MetricsStore
+
+# Single-threaded recon-all -all hours assumed when there are no past runs to learn from
+DEFAULT_SUBJECT_HOURS = 8.0
+
+# Share of recon-all CPU time that speeds up with -openmp threads (Amdahl's law)
+DEFAULT_PARALLEL_FRACTION = 0.6
+
+# Peak memory of one recon-all run when the metrics database has none
+DEFAULT_JOB_MEMORY_GB = 4.0
+
+POLICIES = ('fifo', 'longest-first')
+
+RESULT_FIELDS = ['policy', 'jobs', 'threads', 'nodes', 'makespan_hours', 'slot_utilization', 'core_utilization',
+                 'nodes_for_deadline']
+
+
+def read_subject_ids(path):
+    """Read one subject ID per line, skipping blanks and comments."""
+    with open(path, 'r') as f:
+        return [format_participant_id(line.strip()) for line in f if line.strip() and not line.startswith('#')]
+
+
+def load_voxel_counts(phenotype_csv):
+    """
+    Map subject ID to the number of voxels of its T1, from the scan_nx/ny/nz columns that
+    remote_headers.py adds to a phenotype table
+    """
+    counts = {}
+    with open(phenotype_csv, 'r', newline='') as f:
+        for row in csv.DictReader(f):
+            try:
+                counts[format_participant_id(row['participant_id'])] = (
+                    int(row['scan_nx']) * int(row['scan_ny']) * int(row['scan_nz']))
+            except (KeyError, TypeError, ValueError):
+                continue
+    return counts
+
+
+def load_past_runs(db_path):
+    """
+    Return past recon-all runs from a recon_metrics.py database
+
+    :return: Tuple of ({subject_id: single-threaded seconds}, peak memory in GB or None). CPU time
+             is used as the single-threaded cost; wall time when the log had no CPU lines.
+    """
+    store = MetricsStore(db_path)
+    totals = store.subject_totals()
+    # Peaks sampled by resource_sampler.py cover the whole process tree, unlike the @#@FSTIME lines
+    job_peaks = store.job_peaks()
+    store.close()
+    costs = {subject_id: (cpu if cpu else wall) for subject_id, _, wall, cpu, _ in totals}
+    peaks = job_peaks or [max_rss for *_, max_rss in totals if max_rss]
+    peak_gb = float(np.percentile(peaks, 95)) / 1024 ** 2 if peaks else None
+    return costs, peak_gb
+
+
+def estimate_costs(subject_ids, voxel_counts=None, past_costs=None, default_hours=DEFAULT_SUBJECT_HOURS):
+    """
+    Estimate the single-threaded recon-all seconds of every subject
+
+    Subjects with a past run keep its cost. The others are predicted with a linear fit of cost
+    on voxel count over past runs with known image sizes, or get the median past cost (or
+    default_hours) scaled by their size relative to the median image.
+
+    :return: numpy array of seconds in subject_ids order
+    """
+    voxel_counts = voxel_counts or {}
+    past_costs = past_costs or {}
+
+    known = [s for s in past_costs if s in voxel_counts]
+    fit = None
+    if len(known) >= 3 and len({voxel_counts[s] for s in known}) > 1:
+        slope, intercept = np.polyfit([voxel_counts[s] for s in known], [past_costs[s] for s in known], 1)
+        if slope > 0:
+            fit = (slope, intercept)
+    base = float(np.median(list(past_costs.values()))) if past_costs else default_hours * 3600
+    median_voxels = float(np.median(list(voxel_counts.values()))) if voxel_counts else None
+
+    costs = np.empty(len(subject_ids))
+    for i, subject_id in enumerate(subject_ids):
+        if subject_id in past_costs:
+            costs[i] = past_costs[subject_id]
+        elif subject_id in voxel_counts and fit is not None:
+            costs[i] = max(fit[0] * voxel_counts[subject_id] + fit[1], 0.1 * base)
+        elif subject_id in voxel_counts and median_voxels:
+            costs[i] = base * voxel_counts[subject_id] / median_voxels
+        else:
+            costs[i] = base
+    return costs
+
+
+def speedup(threads, parallel_fraction=DEFAULT_PARALLEL_FRACTION):
+    """Amdahl speedup of one recon-all run with the given number of OpenMP threads."""
+    return 1.0 / ((1.0 - parallel_fraction) + parallel_fraction / threads)
+
+
+def simulate(costs, nodes, jobs, threads, policy='fifo', cores=None, parallel_fraction=DEFAULT_PARALLEL_FRACTION,
+             dispatch_seconds=0.0, poll_seconds=0.0):
+    """
+    Replay list scheduling of subjects on nodes x jobs identical slots
+
+    :param costs: Single-threaded seconds per subject, in queue order
+    :param nodes: Number of nodes
+    :param jobs: Concurrent recon-all runs per node (-p)
+    :param threads: OpenMP threads per run
+    :param policy: 'fifo' (queue order) or 'longest-first'
+    :param cores: Cores per node, for the core utilization (default: jobs x threads)
+    :param parallel_fraction: See speedup
+    :param dispatch_seconds: Delay before a freed slot starts the next subject (preprocess.py sleeps 5 s)
+    :param poll_seconds: Completion is only noticed on multiples of this (preprocess.py checks every 60 s)
+    :return: Dictionary with makespan in seconds, slot utilization and core utilization
+    """
+    if policy not in POLICIES:
+        raise ValueError(f"Unknown policy: {policy}")
+    costs = np.asarray(costs, dtype=np.float64)
+    if policy == 'longest-first':
+        costs = np.sort(costs)[::-1]
+    durations = (costs / speedup(threads, parallel_fraction)).tolist()
+
+    n_slots = nodes * jobs
+    slots = [0.0] * n_slots
+    for duration in durations:
+        free = heapq.heappop(slots)
+        if free > 0:
+            if poll_seconds:
+                free = math.ceil(free / poll_seconds) * poll_seconds
+            free += dispatch_seconds
+        heapq.heappush(slots, free + duration)
+    makespan = max(slots) if durations else 0.0
+
+    if not makespan:
+        return {'makespan': 0.0, 'slot_utilization': 0.0, 'core_utilization': 0.0}
+    return {
+        'makespan': makespan,
+        'slot_utilization': sum(durations) / (n_slots * makespan),
+        # Useful CPU time over all cores of the nodes
+        'core_utilization': float(costs.sum()) / (nodes * (cores or jobs * threads) * makespan),
+    }
+
+
+def packings(cores, memory_gb=None, job_memory_gb=DEFAULT_JOB_MEMORY_GB, jobs=None, threads=None):
+    """
+    List the (jobs, threads) splits of a node worth simulating
+
+    Each number of concurrent jobs gets all the cores it can use as threads; jobs that would
+    not fit in memory are left out. jobs or threads pin that value.
+    """
+    max_jobs = cores
+    if memory_gb:
+        max_jobs = min(max_jobs, int(memory_gb // job_memory_gb))
+    if max_jobs < 1:
+        raise ValueError(f"A node with {memory_gb} GB cannot run a {job_memory_gb} GB job")
+    candidates = [jobs] if jobs else range(1, max_jobs + 1)
+    result = []
+    for n_jobs in candidates:
+        n_threads = threads or max(cores // n_jobs, 1)
+        if (n_jobs, n_threads) not in result:
+            result.append((n_jobs, n_threads))
+    return result
+
+
+def nodes_for_deadline(costs, deadline_seconds, jobs, threads, policy, max_nodes, **options):
+    """
+    Smallest number of nodes (up to max_nodes) whose makespan meets the deadline, or None
+
+    Binary search, as the makespan does not grow when nodes are added.
+    """
+    if simulate(costs, max_nodes, jobs, threads, policy, **options)['makespan'] > deadline_seconds:
+        return None
+    low, high = 1, max_nodes
+    while low < high:
+        middle = (low + high) // 2
+        if simulate(costs, middle, jobs, threads, policy, **options)['makespan'] <= deadline_seconds:
+            high = middle
+        else:
+            low = middle + 1
+    return low
+
+
+def plan(costs, nodes, cores, memory_gb=None, job_memory_gb=DEFAULT_JOB_MEMORY_GB, deadline_hours=None,
+         max_nodes=None, policies=POLICIES, jobs=None, threads=None, parallel_fraction=DEFAULT_PARALLEL_FRACTION,
+         dispatch_seconds=0.0, poll_seconds=0.0):
+    """
+    Simulate every policy and packing of the cluster
+
+    :param costs: Single-threaded seconds per subject, in queue order
+    :param nodes: Number of nodes of the cluster
+    :param cores: Cores per node
+    :param memory_gb: Memory per node (default: unlimited)
+    :param job_memory_gb: Peak memory of one recon-all run
+    :param deadline_hours: Optional deadline; adds the smallest node count that meets it
+    :param max_nodes: Largest node count considered for the deadline (default: nodes)
+    :return: Result rows (RESULT_FIELDS) sorted by makespan
+    """
+    options = {'cores': cores, 'parallel_fraction': parallel_fraction, 'dispatch_seconds': dispatch_seconds,
+               'poll_seconds': poll_seconds}
+    rows = []
+    for policy in policies:
+        for n_jobs, n_threads in packings(cores, memory_gb, job_memory_gb, jobs, threads):
+            result = simulate(costs, nodes, n_jobs, n_threads, policy, **options)
+            row = {
+                'policy': policy,
+                'jobs': n_jobs,
+                'threads': n_threads,
+                'nodes': nodes,
+                'makespan_hours': round(result['makespan'] / 3600, 2),
+                'slot_utilization': round(result['slot_utilization'], 3),
+                'core_utilization': round(result['core_utilization'], 3),
+                'nodes_for_deadline': None,
+            }
+            if deadline_hours:
+                row['nodes_for_deadline'] = nodes_for_deadline(costs, deadline_hours * 3600, n_jobs, n_threads,
+                                                               policy, max_nodes or nodes, **options)
+            rows.append(row)
+    rows.sort(key=lambda row: (row['makespan_hours'], row['threads']))
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Simulate the makespan of a cohort on a cluster and plan capacity')
+    parser.add_argument('--subjects', required=True, help='File with the subject IDs to process, in queue order')
+    parser.add_argument('--phenotype', default=None,
+                        help='Phenotype CSV with the scan_nx/ny/nz columns of remote_headers.py, for size-based '
+                             'cost estimates')
+    parser.add_argument('--db', default=None, help='recon_metrics.py database with past runs')
+    parser.add_argument('--default-hours', type=float, default=DEFAULT_SUBJECT_HOURS,
+                        help=f'Single-threaded hours per subject without past runs (default: {DEFAULT_SUBJECT_HOURS})')
+    parser.add_argument('--nodes', type=int, default=1, help='Nodes of the cluster (default: 1)')
+    parser.add_argument('--cores', type=int, default=os.cpu_count() or 4,
+                        help='Cores per node (default: cores of this machine)')
+    parser.add_argument('--memory-gb', type=float, default=None, help='Memory per node (default: unlimited)')
+    parser.add_argument('--job-memory-gb', type=float, default=None,
+                        help=f'Peak memory per recon-all run (default: from --db, else {DEFAULT_JOB_MEMORY_GB})')
+    parser.add_argument('-p', '--jobs', type=int, default=None, help='Only simulate this many jobs per node')
+    parser.add_argument('--threads', type=int, default=None, help='Only simulate this many threads per job')
+    parser.add_argument('--policies', nargs='+', choices=POLICIES, default=list(POLICIES),
+                        help='Scheduling policies (default: all)')
+    parser.add_argument('--parallel-fraction', type=float, default=DEFAULT_PARALLEL_FRACTION,
+                        help=f'Share of recon-all that speeds up with threads (default: {DEFAULT_PARALLEL_FRACTION})')
+    parser.add_argument('--dispatch-seconds', type=float, default=0,
+                        help='Delay before a freed slot starts the next subject (preprocess.py: 5)')
+    parser.add_argument('--poll-seconds', type=float, default=0,
+                        help='Interval at which finished runs are noticed (preprocess.py: 60)')
+    parser.add_argument('--deadline-hours', type=float, default=None,
+                        help='Also report the smallest number of nodes that meets this deadline')
+    parser.add_argument('--max-nodes', type=int, default=64,
+                        help='Largest number of nodes considered for the deadline (default: 64)')
+    parser.add_argument('--output', default=None, help='Write all simulated configurations to this CSV')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    subject_list = read_subject_ids(args.subjects)
+    past, past_peak_gb = load_past_runs(args.db) if args.db else ({}, None)
+    voxels = load_voxel_counts(args.phenotype) if args.phenotype else {}
+    subject_costs = estimate_costs(subject_list, voxels, past, args.default_hours)
+    logging.info(f"{len(subject_list)} subjects, {len(past)} past runs, {len(voxels)} image sizes; "
+                 f"{subject_costs.sum() / 3600:.0f} single-threaded hours in total")
+
+    results = plan(subject_costs, args.nodes, args.cores, args.memory_gb,
+                   args.job_memory_gb or past_peak_gb or DEFAULT_JOB_MEMORY_GB, args.deadline_hours,
+                   max(args.max_nodes, args.nodes), args.policies, args.jobs, args.threads, args.parallel_fraction,
+                   args.dispatch_seconds, args.poll_seconds)
+
+    if args.output:
+        with open(args.output, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+            writer.writeheader()
+            writer.writerows(results)
+
+    print(f"{'policy':<14} {'jobs':>4} {'threads':>7} {'nodes':>5} {'makespan h':>10} {'slots':>6} {'cores':>6}"
+          + (f" {'nodes for deadline':>18}" if args.deadline_hours else ''))
+    for result in results[:15]:
+        line = (f"{result['policy']:<14} {result['jobs']:>4} {result['threads']:>7} {result['nodes']:>5} "
+                f"{result['makespan_hours']:>10.2f} {result['slot_utilization']:>6.1%} "
+                f"{result['core_utilization']:>6.1%}")
+        if args.deadline_hours:
+            line += f" {result['nodes_for_deadline'] or '-':>18}"
+        print(line)
+    if args.output:
+        print(f"\nAll configurations saved to {args.output}")
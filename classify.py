@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+import argparse
+import hashlib
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.linear_model import LogisticRegression
+from sklearn.metrics import accuracy_score, balanced_accuracy_score, f1_score, roc_auc_score
+from sklearn.model_selection import ParameterGrid, StratifiedKFold
+from sklearn.svm import SVC
+
+from data_organizer import format_participant_id
+from harmonize import apply_combat, fit_combat
+
+SPLITS = ('train', 'validation', 'test')
+
+# Model name -> (estimator class, hyperparameter grid)
+MODEL_GRIDS = {
+    'logistic': (LogisticRegression, {'C': [0.01, 0.1, 1.0, 10.0], 'max_iter': [5000]}),
+    'svm': (SVC, {'C': [0.1, 1.0, 10.0], 'kernel': ['linear', 'rbf']}),
+    'random_forest': (RandomForestClassifier, {'n_estimators': [300], 'max_depth': [None, 5, 10],
+                                               'random_state': [42]}),
+}
+
+RESULT_FIELDS = ['model', 'params', 'fold', 'n_train', 'n_test', 'accuracy', 'balanced_accuracy', 'roc_auc', 'f1',
+                 'fit_seconds']
+
+
+def load_cohort(data_dir, feature_paths):
+    """
+    Join the train/validation/test split CSVs of dataset_generator.py with feature tables
+
+    :param data_dir: Folder with <split>_data.csv
+    :param feature_paths: Feature CSVs keyed by subject_id (e.g. freesurfer_features.csv)
+    :return: DataFrame with subject_id, split, label (1 = ADHD), site, age, gender and feature columns,
+             and the list of feature columns
+    """
+    splits = []
+    for split in SPLITS:
+        df = pd.read_csv(os.path.join(data_dir, f"{split}_data.csv"))
+        df['split'] = split
+        splits.append(df)
+    cohort = pd.concat(splits, ignore_index=True)
+    cohort['subject_id'] = cohort['participant_id'].apply(format_participant_id)
+    cohort['label'] = (cohort['diagnosis_status'] == 'ADHD').astype(int)
+    cohort['site'] = cohort['source_folder'].astype(str)
+    cohort['gender'] = (cohort['gender_std'] == 'male').astype(float)
+
+    feature_columns = []
+    for path in feature_paths:
+        features = pd.read_csv(path)
+        features = features.drop(columns=[c for c in features.columns if c in cohort.columns and c != 'subject_id'])
+        numeric = [c for c in features.columns if c != 'subject_id' and pd.api.types.is_numeric_dtype(features[c])]
+        feature_columns.extend(numeric)
+        cohort = cohort.merge(features[['subject_id'] + numeric], on='subject_id', how='left')
+
+    missing = cohort[feature_columns].isna().all(axis=1)
+    if missing.any():
+        logging.warning(f"{missing.sum()} participants have no features and are dropped")
+        cohort = cohort[~missing].reset_index(drop=True)
+    return cohort, feature_columns
+
+
+def make_folds(cohort, n_folds=5, seed=42):
+    """
+    Build the evaluation folds as (name, train indices, test indices)
+
+    cv0..cvN-1 are stratified folds within the training split; 'validation' trains on the
+    training split and tests on the validation split.
+    """
+    train = np.flatnonzero(cohort['split'] == 'train')
+    validation = np.flatnonzero(cohort['split'] == 'validation')
+    labels = cohort['label'].to_numpy()
+
+    folds = []
+    splitter = StratifiedKFold(n_splits=n_folds, shuffle=True, random_state=seed)
+    for k, (fold_train, fold_test) in enumerate(splitter.split(train, labels[train])):
+        folds.append((f"cv{k}", train[fold_train], train[fold_test]))
+    if len(validation):
+        folds.append(('validation', train, validation))
+    return folds
+
+
+def site_residualize(X, sites, train):
+    """
+    Remove site means estimated on the training rows; sites unseen in training keep the grand mean
+    """
+    codes, site_index = np.unique(sites, return_inverse=True)
+    counts = np.bincount(site_index[train], minlength=len(codes)).astype(float)
+    grand_mean = X[train].mean(axis=0)
+
+    site_means = np.tile(grand_mean, (len(codes), 1))
+    seen = counts > 0
+    sums = np.zeros((len(codes), X.shape[1]))
+    np.add.at(sums, site_index[train], X[train])
+    site_means[seen] = sums[seen] / counts[seen, None]
+    return X - site_means[site_index] + grand_mean
+
+
+def _impute_medians(values, train):
+    """Replace missing values with the column medians of the training rows (0 for all-missing columns)."""
+    medians = np.nanmedian(values[train], axis=0)
+    medians = np.where(np.isnan(medians), 0.0, medians)
+    return np.where(np.isnan(values), medians, values)
+
+
+def preprocess_fold(X, sites, covariates, train, test, site_correction='residualize'):
+    """
+    Fit imputation, site correction and scaling on the training rows of a fold and apply them to both
+
+    :param X: Feature matrix of the whole cohort
+    :param sites: Site of every row
+    :param covariates: Matrix of covariates appended after scaling (age, gender), may have missing values
+    :param train: Training row indices
+    :param test: Test row indices
+    :param site_correction: 'none', 'residualize' or 'combat' (preserving the covariate effects)
+    :return: Tuple of (X_train, X_test)
+    """
+    # Median imputation from the training rows
+    X = _impute_medians(X, train)
+    covariates = _impute_medians(covariates, train)
+
+    if site_correction == 'residualize':
+        X = site_residualize(X, sites, train)
+    elif site_correction == 'combat':
+        X = apply_combat(fit_combat(X[train], sites[train], covariates[train]), X, sites, covariates)
+    elif site_correction != 'none':
+        raise ValueError(f"Unknown site correction: {site_correction}")
+
+    full = np.hstack([X, covariates])
+    mean = full[train].mean(axis=0)
+    std = full[train].std(axis=0)
+    std[std == 0] = 1.0
+    full = (full - mean) / std
+    return full[train], full[test]
+
+
+def fold_cache_path(cache_dir, X, sites, covariates, labels, fold, site_correction):
+    """Path of the memoized preprocessing of a fold, keyed by its inputs."""
+    name, train, test = fold
+    digest = hashlib.sha1()
+    for part in (X.tobytes(), np.asarray(sites).astype(str).tobytes(), covariates.tobytes(), labels.tobytes(),
+                 train.tobytes(), test.tobytes(), site_correction.encode()):
+        digest.update(part)
+    return os.path.join(cache_dir, f"fold-{name}-{digest.hexdigest()[:16]}.npz")
+
+
+def prepare_fold(cache_path, X, sites, covariates, labels, fold, site_correction):
+    """Preprocess one fold and save it to cache_path unless it is already there."""
+    if os.path.isfile(cache_path):
+        return cache_path
+    _, train, test = fold
+    X_train, X_test = preprocess_fold(X, sites, covariates, train, test, site_correction)
+    tmp_path = cache_path + '.tmp.npz'
+    np.savez(tmp_path, X_train=X_train, X_test=X_test, y_train=labels[train], y_test=labels[test])
+    os.replace(tmp_path, cache_path)
+    return cache_path
+
+
+def evaluate(model_name, params, fold_name, cache_path):
+    """
+    Fit one model configuration on one preprocessed fold and score it
+
+    :return: Result row
+    """
+    data = np.load(cache_path)
+    estimator_class = MODEL_GRIDS[model_name][0]
+    model = estimator_class(**params)
+
+    start = time.time()
+    model.fit(data['X_train'], data['y_train'])
+    fit_seconds = time.time() - start
+
+    y_test = data['y_test']
+    predicted = model.predict(data['X_test'])
+    if hasattr(model, 'predict_proba'):
+        scores = model.predict_proba(data['X_test'])[:, 1]
+    else:
+        scores = model.decision_function(data['X_test'])
+    roc_auc = roc_auc_score(y_test, scores) if len(np.unique(y_test)) == 2 else float('nan')
+
+    return {
+        'model': model_name,
+        'params': json.dumps(params, sort_keys=True),
+        'fold': fold_name,
+        'n_train': len(data['y_train']),
+        'n_test': len(y_test),
+        'accuracy': round(accuracy_score(y_test, predicted), 4),
+        'balanced_accuracy': round(balanced_accuracy_score(y_test, predicted), 4),
+        'roc_auc': round(roc_auc, 4),
+        'f1': round(f1_score(y_test, predicted, zero_division=0), 4),
+        'fit_seconds': round(fit_seconds, 3),
+    }
+
+
+def run_grid(cohort, feature_columns, cache_dir, models=None, n_folds=5, workers=4, site_correction='residualize',
+             evaluate_test=True):
+    """
+    Evaluate every model x hyperparameter x fold combination in a process pool
+
+    Each fold is preprocessed once and memoized in cache_dir, shared by all configurations
+    and reused by later runs on the same data. The configuration with the best mean
+    balanced accuracy over the CV folds is refit on train + validation and scored on test.
+
+    :return: DataFrame of results, one row per (model, params, fold)
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    models = models or list(MODEL_GRIDS)
+
+    X = cohort[feature_columns].to_numpy(dtype=np.float64)
+    sites = cohort['site'].to_numpy()
+    # Missing covariates are imputed per fold from its training rows
+    covariates = cohort[['age', 'gender']].to_numpy(dtype=np.float64)
+    labels = cohort['label'].to_numpy()
+
+    folds = make_folds(cohort, n_folds)
+    if evaluate_test:
+        train_validation = np.flatnonzero(cohort['split'].isin(['train', 'validation']))
+        test = np.flatnonzero(cohort['split'] == 'test')
+        test_fold = ('test', train_validation, test)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        cache_paths = {}
+        prepare = {}
+        for fold in folds + ([test_fold] if evaluate_test else []):
+            path = fold_cache_path(cache_dir, X, sites, covariates, labels, fold, site_correction)
+            prepare[fold[0]] = executor.submit(prepare_fold, path, X, sites, covariates, labels, fold,
+                                               site_correction)
+        for name, future in prepare.items():
+            cache_paths[name] = future.result()
+
+        tasks = [(model_name, params, fold[0])
+                 for model_name in models
+                 for params in ParameterGrid(MODEL_GRIDS[model_name][1])
+                 for fold in folds]
+        futures = [executor.submit(evaluate, model_name, params, fold_name, cache_paths[fold_name])
+                   for model_name, params, fold_name in tasks]
+        rows = [future.result() for future in futures]
+        logging.info(f"Evaluated {len(tasks)} model x hyperparameter x fold combinations")
+
+        results = pd.DataFrame(rows, columns=RESULT_FIELDS)
+        if evaluate_test:
+            cv = results[results['fold'].str.startswith('cv')]
+            best = cv.groupby(['model', 'params'])['balanced_accuracy'].mean().idxmax()
+            logging.info(f"Best configuration by CV balanced accuracy: {best[0]} {best[1]}")
+            row = executor.submit(evaluate, best[0], json.loads(best[1]), 'test', cache_paths['test']).result()
+            results = pd.concat([results, pd.DataFrame([row], columns=RESULT_FIELDS)], ignore_index=True)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Cross-validated ADHD vs TD classification on extracted features')
+    parser.add_argument('--data-dir', default='./data',
+                        help='Folder with train/validation/test_data.csv (default: data)')
+    parser.add_argument('--features', nargs='+', default=['./data/freesurfer_features.csv'],
+                        help='Feature CSVs keyed by subject_id (default: data/freesurfer_features.csv)')
+    parser.add_argument('--models', nargs='+', choices=list(MODEL_GRIDS), default=None,
+                        help='Models to evaluate (default: all)')
+    parser.add_argument('--folds', type=int, default=5, help='Cross-validation folds (default: 5)')
+    parser.add_argument('--site-correction', choices=['none', 'residualize', 'combat'], default='residualize',
+                        help='Site effect removal fitted on each training fold (default: residualize)')
+    parser.add_argument('--cache-dir', default='./data/classify_cache',
+                        help='Memoized per-fold preprocessing (default: data/classify_cache)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 4,
+                        help='Processes (default: number of CPUs)')
+    parser.add_argument('--no-test', action='store_true', help='Do not score the best configuration on test')
+    parser.add_argument('--output', default='./data/classification_results.csv',
+                        help='Results table (default: data/classification_results.csv)')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    cohort_df, columns = load_cohort(args.data_dir, args.features)
+    logging.info(f"{len(cohort_df)} participants with {len(columns)} features")
+    results_df = run_grid(cohort_df, columns, args.cache_dir, args.models, args.folds, args.workers,
+                          args.site_correction, not args.no_test)
+    results_df.to_csv(args.output, index=False)
+
+    summary = (results_df[results_df['fold'].str.startswith('cv')]
+               .groupby(['model', 'params'])[['balanced_accuracy', 'roc_auc']].mean()
+               .sort_values('balanced_accuracy', ascending=False))
+    print(summary.head(10).to_string())
+    print(f"\nResults saved to {args.output}")
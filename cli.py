@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# Single entry point for every pipeline stage: python cli.py <stage> [options]
+# Only the module of the requested stage is imported, so `--help` and light stages do not pay
+# for pandas, scikit-learn or boto3.
+import os
+import runpy
+import sys
+
+# Subcommand -> (module, description)
+COMMANDS = {
+    'list-s3': ('get_s3_object_list', 'List all objects in the S3 bucket into a JSON manifest'),
+    'manifest': ('s3_manifest', 'Build, convert and query the compact SQLite S3 manifest'),
+    'headers': ('remote_headers', 'Read NIfTI headers of S3 objects with ranged GETs'),
+    'download': ('download_s3', 'Download the objects of a manifest with the AWS CLI'),
+    'organize': ('data_organizer', 'Organize raw BIDS site folders into anat/ and func/ subject folders'),
+    'dedup': ('dedup_scans', 'Remove duplicate scans and select the best T1 per subject'),
+    'phenotype': ('phenotype_data', 'Combine participants.tsv files from all sites'),
+    'dataset': ('dataset_generator', 'Select a cohort and write train/validation/test splits'),
+    'match': ('control_matching', 'Match age-, gender- and site-matched controls to ADHD participants'),
+    'pipeline': ('pipeline', 'Stream subjects through download, recon-all, feature extraction and eviction'),
+    'longitudinal': ('longitudinal', 'Run recon-all as a dependency graph with the longitudinal stream per subject'),
+    'features': ('freesurfer_stats', 'Extract aseg/aparc features of processed subjects'),
+    'regional': ('regional_features', 'Extract per-label voxel and intensity features from aparc+aseg'),
+    'shards': ('volume_shards', 'Build float16 memory-mapped volume shards for CNN training'),
+    'functional': ('functional_features', 'Extract ROI timeseries and connectivity from BOLD runs'),
+    'harmonize': ('harmonize', 'ComBat site harmonization of extracted features'),
+    'classify': ('classify', 'Cross-validated ADHD vs TD classification on extracted features'),
+    'stats': ('group_stats', 'ADHD vs TD GLM of every feature with FDR and permutation tests'),
+    'retry': ('recon_retry', 'Classify failed recon-all runs and show their planned retries'),
+    'metrics': ('recon_metrics', 'Collect per-step timing metrics from recon-all logs'),
+    'resources': ('resource_sampler', 'Sample CPU, memory and I/O of recon-all jobs and predict their memory'),
+    'progress': ('recon_progress', 'Live progress and ETA of recon-all runs'),
+    'plan': ('capacity_planner', 'Simulate the makespan of a cohort on a cluster and plan capacity'),
+    'archive': ('archive_outputs', 'Prune and archive processed subjects'),
+    'upload': ('upload_s3', 'Upload processed subjects or archives to S3'),
+    'cache': ('volume_cache', 'Inspect, prune or warm the shared cache of decompressed volumes'),
+    'trace': ('tracing', 'Summarize a pipeline trace: stage totals, critical path, slowest subjects'),
+    'benchmark': ('benchmark', 'Benchmark pipeline stages on synthetic data'),
+}
+
+
+def print_help(prog):
+    print(f"usage: {prog} <command> [options]\n")
+    print("ADHD200 preprocessing pipeline\n")
+    print("commands:")
+    width = max(len(name) for name in COMMANDS)
+    for name, (_, description) in COMMANDS.items():
+        print(f"  {name:<{width}}  {description}")
+    print("\noptions before the command:")
+    print("  --trace FILE    Append spans of the stage and its per-subject work to FILE (see tracing.py)")
+    print("  --profile DIR   Write a cProfile dump of the stage to DIR")
+    print(f"\nRun '{prog} <command> --help' for the options of a command.")
+
+
+def main(argv=None):
+    """
+    Dispatch to the stage module, running its command line interface with the remaining arguments
+
+    :param argv: Arguments without the program name (default: sys.argv[1:])
+    :return: Exit code
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    prog = os.path.basename(sys.argv[0]) or 'cli.py'
+
+    # Options before the command apply to every stage
+    options = {}
+    while argv and argv[0] in ('--trace', '--profile'):
+        if len(argv) < 2:
+            print(f"{prog}: {argv[0]} needs a path", file=sys.stderr)
+            return 2
+        options[argv[0]] = argv[1]
+        argv = argv[2:]
+
+    if not argv or argv[0] in ('-h', '--help'):
+        print_help(prog)
+        return 0
+
+    command, args = argv[0], argv[1:]
+    if command not in COMMANDS:
+        print(f"{prog}: unknown command '{command}'\n", file=sys.stderr)
+        print_help(prog)
+        return 2
+
+    module_name = COMMANDS[command][0]
+    # Make the stage modules importable regardless of the working directory
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    sys.argv = [f"{prog} {command}"] + args
+
+    import tracing
+    if options:
+        tracing.configure(options.get('--trace'), options.get('--profile'))
+    with tracing.span(command, profile=True):
+        runpy.run_module(module_name, run_name='__main__', alter_sys=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
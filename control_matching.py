@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# Selects age-, gender- and site-matched Typical Development controls for every ADHD participant.
+# Participants are matched exactly on the categorical columns (gender and site) and by distance on
+# the numeric covariates, standardized with the pooled standard deviation so a caliper is in SD
+# units. Within every exact-match stratum the controls go into a KD-tree and each case queries its
+# nearest candidates inside the caliper. Greedy assignment hands out controls round by round, the
+# cases whose nearest control is furthest away first; optimal assignment solves the minimum total
+# distance problem of the stratum instead.
+import argparse
+import math
+
+import numpy as np
+import pandas as pd
+from scipy.optimize import linear_sum_assignment
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import cdist
+
+EXACT_COLUMNS = ('gender_std', 'source_folder')
+COVARIATES = ('age',)
+# Largest distance of a match in pooled standard deviations of the covariates
+DEFAULT_CALIPER = 0.2
+METHODS = ('greedy', 'optimal')
+
+# Cost of pairs outside the caliper in the optimal assignment; any feasible pair is cheaper
+_INFEASIBLE = 1e9
+
+
+def standardize(df, covariates):
+    """Covariates of df divided by their pooled standard deviation (numpy array, one row per participant)."""
+    values = df[list(covariates)].to_numpy(dtype=float)
+    scale = values.std(axis=0)
+    scale[scale == 0] = 1.0
+    return (values - values.mean(axis=0)) / scale
+
+
+def _greedy(case_points, control_points, ratio, caliper):
+    """
+    Greedy 1:ratio matching without replacement
+
+    :return: List of (case row, control row, distance)
+    """
+    tree = cKDTree(control_points)
+    n_controls = len(control_points)
+    bound = caliper if caliper is not None else np.inf
+    k = min(n_controls, 8 * ratio)
+    distances, neighbours = tree.query(case_points, k=k, distance_upper_bound=bound)
+    distances = distances.reshape(len(case_points), -1)
+    neighbours = neighbours.reshape(len(case_points), -1)
+
+    # Hardest cases first: the ones whose nearest control is furthest away
+    order = np.argsort(-distances[:, 0], kind='stable').tolist()
+    # Plain lists: the loop below touches single elements, which is slow on numpy arrays
+    distances, neighbours = distances.tolist(), neighbours.tolist()
+    used = [False] * n_controls
+    position = [0] * len(case_points)
+    pairs = []
+    for _ in range(ratio):
+        for case in order:
+            while True:
+                case_distances, case_neighbours = distances[case], neighbours[case]
+                if position[case] == len(case_neighbours):
+                    if len(case_neighbours) >= n_controls or not math.isfinite(case_distances[-1]):
+                        break
+                    # All candidates were taken by other cases, look further out
+                    wider_distances, wider_neighbours = tree.query(
+                        case_points[case], k=min(n_controls, 2 * len(case_neighbours)), distance_upper_bound=bound)
+                    distances[case], neighbours[case] = wider_distances.tolist(), wider_neighbours.tolist()
+                    continue
+                control = case_neighbours[position[case]]
+                if control == n_controls:
+                    # No more controls inside the caliper
+                    position[case] = len(case_neighbours)
+                    break
+                position[case] += 1
+                if not used[control]:
+                    used[control] = True
+                    pairs.append((case, control, case_distances[position[case] - 1]))
+                    break
+    return pairs
+
+
+def _optimal(case_points, control_points, ratio, caliper):
+    """
+    1:ratio matching minimizing the total distance, as an assignment of ratio copies of every case
+
+    :return: List of (case row, control row, distance)
+    """
+    distances = cdist(np.repeat(case_points, ratio, axis=0), control_points)
+    cost = distances if caliper is None else np.where(distances <= caliper, distances, _INFEASIBLE)
+    rows, columns = linear_sum_assignment(cost)
+    return [(row // ratio, column, distances[row, column]) for row, column in zip(rows, columns)
+            if cost[row, column] < _INFEASIBLE]
+
+
+def match_controls(df, group_column='diagnosis_status', case_value='ADHD', control_value='Typical Development',
+                   exact=EXACT_COLUMNS, covariates=COVARIATES, ratio=1, caliper=DEFAULT_CALIPER, method='greedy'):
+    """
+    Match every case to up to ratio controls without replacement
+
+    Columns of exact or covariates that df does not have are left out. Participants with a
+    missing value in the columns used are not matched.
+
+    :param df: Participants, e.g. from dataset_generator.filter_participants
+    :param exact: Columns a case and its controls must share
+    :param covariates: Numeric columns to match on by distance
+    :param ratio: Controls per case
+    :param caliper: Largest distance in pooled SDs, or None for no limit
+    :param method: 'greedy' or 'optimal'
+    :return: DataFrame with one row per pair: case and control (index labels of df), distance and
+             rank (1 for the first control of a case)
+    """
+    if method not in METHODS:
+        raise ValueError(f"Unknown matching method {method!r}, expected one of {', '.join(METHODS)}")
+    exact = [c for c in exact if c in df.columns]
+    covariates = [c for c in covariates if c in df.columns]
+    if not covariates and not exact:
+        raise ValueError("None of the matching columns are in the participants table")
+
+    eligible = df[df[group_column].isin([case_value, control_value])].dropna(subset=exact + covariates)
+    points = standardize(eligible, covariates) if covariates else np.zeros((len(eligible), 1))
+    is_case = (eligible[group_column] == case_value).to_numpy()
+    labels = eligible.index.to_numpy()
+    assign = _greedy if method == 'greedy' else _optimal
+
+    pairs = []
+    strata = eligible.groupby(exact, sort=False, observed=True).indices if exact else {(): np.arange(len(eligible))}
+    for rows in strata.values():
+        cases = rows[is_case[rows]]
+        controls = rows[~is_case[rows]]
+        if len(cases) == 0 or len(controls) == 0:
+            continue
+        for case, control, distance in assign(points[cases], points[controls], ratio, caliper):
+            pairs.append((labels[cases[case]], labels[controls[control]], distance))
+
+    matches = pd.DataFrame(pairs, columns=['case', 'control', 'distance'])
+    matches = matches.sort_values(['case', 'distance'], kind='stable').reset_index(drop=True)
+    matches['rank'] = matches.groupby('case').cumcount() + 1
+    return matches
+
+
+def balance_table(df, groups, covariates=COVARIATES):
+    """
+    Standardized mean difference of every numeric covariate between two groups
+
+    :param df: Participants
+    :param groups: Boolean Series, True for cases
+    :return: Dictionary mapping covariate to SMD (case mean - control mean over the pooled SD)
+    """
+    smd = {}
+    for column in covariates:
+        if column not in df.columns:
+            continue
+        cases, controls = df.loc[groups, column].astype(float), df.loc[~groups, column].astype(float)
+        pooled = np.sqrt((cases.var() + controls.var()) / 2)
+        smd[column] = float((cases.mean() - controls.mean()) / pooled) if pooled > 0 else 0.0
+    return smd
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Match Typical Development controls to ADHD participants')
+    parser.add_argument('--root-dir', required=True,
+                        help='Folder containing combined_participants_with_diagnosis.csv (output of phenotype_data.py)')
+    parser.add_argument('--output', default='./data/matched_controls.csv', help='Output CSV of matched pairs')
+    parser.add_argument('--ratio', type=int, default=1, help='Controls per ADHD participant (default: 1)')
+    parser.add_argument('--caliper', type=float, default=DEFAULT_CALIPER,
+                        help=f'Largest covariate distance in pooled SDs (default: {DEFAULT_CALIPER})')
+    parser.add_argument('--method', choices=METHODS, default='greedy', help='Assignment method (default: greedy)')
+    parser.add_argument('--exact', nargs='*', default=list(EXACT_COLUMNS),
+                        help=f"Columns matched exactly (default: {' '.join(EXACT_COLUMNS)})")
+    parser.add_argument('--covariates', nargs='*', default=list(COVARIATES),
+                        help=f"Numeric columns matched by distance (default: {' '.join(COVARIATES)})")
+
+    args = parser.parse_args()
+
+    from dataset_generator import load_participants
+
+    participants = load_participants(args.root_dir)
+    participants = participants[participants['diagnosis_status'].isin(['ADHD', 'Typical Development'])]
+    matched = match_controls(participants, exact=args.exact, covariates=args.covariates, ratio=args.ratio,
+                             caliper=args.caliper, method=args.method)
+    matched['case_id'] = participants.loc[matched['case'], 'participant_id'].to_numpy()
+    matched['control_id'] = participants.loc[matched['control'], 'participant_id'].to_numpy()
+    matched['distance'] = matched['distance'].round(4)
+    matched[['case_id', 'control_id', 'distance', 'rank']].to_csv(args.output, index=False)
+
+    n_cases = (participants['diagnosis_status'] == 'ADHD').sum()
+    print(f"Matched {matched['case'].nunique()} of {n_cases} ADHD participants to {len(matched)} controls")
+    selected = participants.loc[np.concatenate([matched['case'].unique(), matched['control']])]
+    print("Standardized mean differences (before -> after):")
+    before = balance_table(participants, participants['diagnosis_status'] == 'ADHD', args.covariates)
+    after = balance_table(selected, selected['diagnosis_status'] == 'ADHD', args.covariates)
+    for covariate, value in before.items():
+        print(f"  {covariate}: {value:+.3f} -> {after[covariate]:+.3f}")
+    print(f"Pairs saved to {args.output}")
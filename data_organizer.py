@@ -1,7 +1,10 @@
+import argparse
 import os
 import shutil
 import re
 
+import tracing
+
 
 def create_directory(path):
     """Create a directory if it doesn't exist."""
@@ -23,6 +26,23 @@ def zero_pad_subject_id(subject_id):
     return subject_id
 
 
+def format_participant_id(participant_id):
+    """Return the participant ID with 'sub-' prefix and zero-padded to 7 digits."""
+    # Convert to string, strip any existing prefixes
+    pid_str = str(participant_id)
+    if pid_str.startswith('sub-'):
+        pid_str = pid_str[4:]
+
+    # Zero-pad to 7 digits and add 'sub-' prefix
+    try:
+        # For numeric IDs
+        numeric_id = int(pid_str)
+        return f"sub-{numeric_id:07d}"
+    except ValueError:
+        # For non-numeric IDs, just add the prefix
+        return f"sub-{pid_str}"
+
+
 def organize_mri_data(source_root, dest_root):
     """Organize MRI data into the specified structure, handling both direct and session-based structures."""
     # Create destination directories
@@ -88,7 +108,9 @@ def organize_mri_data(source_root, dest_root):
 
                         try:
                             # Copy the file (use shutil.move if you want to move instead)
-                            shutil.copy2(source_file, dest_file)
+                            with tracing.span('organize', padded_subject_id, data_type=data_type) as span:
+                                shutil.copy2(source_file, dest_file)
+                                span.add_bytes(os.path.getsize(dest_file))
                             print(f"Copied: {source_file} -> {dest_file}")
 
                             # Update statistics
@@ -109,20 +131,12 @@ def organize_mri_data(source_root, dest_root):
 
 
 if __name__ == "__main__":
-    # Define source and destination roots
-    # Change these paths to match your system
-    source_root = [
-        "/Users/stevenang/Downloads/dataset/ADHD200/raw_data/KII",
-        "/Users/stevenang/Downloads/dataset/ADHD200/raw_data/NeuroIMAGE",
-        "/Users/stevenang/Downloads/dataset/ADHD200/raw_data/NYU",
-        "/Users/stevenang/Downloads/dataset/ADHD200/raw_data/OHSU",
-        "/Users/stevenang/Downloads/dataset/ADHD200/raw_data/Peking_1",
-        "/Users/stevenang/Downloads/dataset/ADHD200/raw_data/Peking_2",
-        "/Users/stevenang/Downloads/dataset/ADHD200/raw_data/Peking_3",
-        "/Users/stevenang/Downloads/dataset/ADHD200/raw_data/Pittsburgh",
-        "/Users/stevenang/Downloads/dataset/ADHD200/raw_data/WashU"
-    ]
-    dest_root = os.path.expanduser("/Users/stevenang/Downloads/dataset")
-
-    for source in source_root:
-        organize_mri_data(source, dest_root)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Organize ADHD200 BIDS folders into anat/ and func/ subject folders')
+    parser.add_argument('--source', nargs='+', required=True,
+                        help='One or more raw site folders, e.g. raw_data/NYU raw_data/OHSU')
+    parser.add_argument('--dest', required=True, help='Destination root for the anat/ and func/ folders')
+
+    args = parser.parse_args()
+
+    for source in args.source:
+        organize_mri_data(source, os.path.expanduser(args.dest))
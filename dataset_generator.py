@@ -1,80 +1,92 @@
 #!/usr/bin/env python3
+import argparse
 import os
 import pandas as pd
 import numpy as np
 from sklearn.model_selection import train_test_split
 
-# Define paths
-root_dir = "/Users/stevenang/Downloads/dataset/ADHD200/raw_data"
-input_file = os.path.join(root_dir, "combined_participants_with_diagnosis.csv")
-output_dir = "/Users/stevenang/PycharmProjects/adhd/data"
-anat_dir = "/Users/stevenang/Downloads/dataset/anat"  # Directory containing anatomical images
-
-# Create output directory if it doesn't exist
-os.makedirs(output_dir, exist_ok=True)
-
-# Load the combined data
-print(f"Loading data from {input_file}")
-try:
-    df = pd.read_csv(input_file)
-    print(f"Loaded dataset with {len(df)} participants and {len(df.columns)} columns")
-except FileNotFoundError:
-    # Try the regular combined file if the one with diagnosis doesn't exist
-    input_file = os.path.join(root_dir, "combined_participants.csv")
-    df = pd.read_csv(input_file)
-    print(f"Using alternative file. Loaded {len(df)} participants")
-
-    # Create diagnosis column if it doesn't exist
-    if 'diagnosis_status' not in df.columns and 'dx' in df.columns:
-        df['diagnosis_status'] = 'Unknown'
-
-        # Common indicators
-        adhd_indicators = ['adhd', 'ADHD', '1', 'yes', 'positive', 'patient']
-        td_indicators = ['td', 'TD', 'TDC', 'control', '0', 'no', 'negative', 'typical', 'healthy']
-
-        # Standardize diagnosis
-        for idx, row in df.iterrows():
-            dx_value = str(row.get('dx', '')).strip().lower()
-            if any(indicator.lower() in dx_value for indicator in adhd_indicators):
-                df.at[idx, 'diagnosis_status'] = 'ADHD'
-            elif any(indicator.lower() in dx_value for indicator in td_indicators):
-                df.at[idx, 'diagnosis_status'] = 'Typical Development'
-
-# Standardize gender
-if 'gender' in df.columns:
-    df['gender_std'] = df['gender'].astype(str).str.lower()
-    df.loc[df['gender_std'].str.contains('f', na=False), 'gender_std'] = 'female'
-    df.loc[df['gender_std'].str.contains('m', na=False), 'gender_std'] = 'male'
-else:
-    print("Warning: 'gender' column not found")
-    df['gender_std'] = 'unknown'
-
-# Create age groups if age column exists
-if 'age' in df.columns:
-    # Create buckets for age: child (<=12), adolescent (13-17), adult (>=18)
-    df['age_group'] = pd.cut(
-        df['age'],
-        bins=[0, 12, 17, 100],
-        labels=['child', 'adolescent', 'adult'],
-        right=True
-    )
-else:
-    print("Warning: 'age' column not found")
-    df['age_group'] = 'unknown'
+from control_matching import DEFAULT_CALIPER, balance_table, match_controls
+from data_organizer import format_participant_id
+from phenotype_data import standardize_diagnosis
+
+# Priority columns + diagnosis + standardized columns + key clinical measures
+PRIORITY_COLUMNS = ['participant_id', 'gender_std', 'age', 'age_group', 'diagnosis_status', 'source_folder']
+
+# Add important clinical measures if they exist
+POTENTIAL_CLINICAL_COLUMNS = [
+    'adhd_index', 'adhd_measure', 'iq', 'verbal_iq', 'performance_iq',
+    'full_iq', 'handedness', 'scanned', 'site', 'scan_key'
+]
+
+# Written by matched_sample: the case every participant was matched to and the distance to it
+MATCH_COLUMNS = ['match_group', 'match_distance']
+
+SPLITS = ('train', 'validation', 'test')
+
 
+def load_participants(root_dir):
+    """
+    Load the combined participants table and add standardized gender and age group columns
 
-# Function to check if anatomical image exists for a participant
-def has_anat_image(participant_id):
+    :param root_dir: Folder containing combined_participants_with_diagnosis.csv (or combined_participants.csv)
+    :return: DataFrame with diagnosis_status, gender_std and age_group columns
+    """
+    input_file = os.path.join(root_dir, "combined_participants_with_diagnosis.csv")
+
+    # Load the combined data
+    print(f"Loading data from {input_file}")
+    try:
+        df = pd.read_csv(input_file)
+        print(f"Loaded dataset with {len(df)} participants and {len(df.columns)} columns")
+    except FileNotFoundError:
+        # Try the regular combined file if the one with diagnosis doesn't exist
+        input_file = os.path.join(root_dir, "combined_participants.csv")
+        df = pd.read_csv(input_file)
+        print(f"Using alternative file. Loaded {len(df)} participants")
+
+        # Create diagnosis column if it doesn't exist
+        if 'diagnosis_status' not in df.columns and 'dx' in df.columns:
+            df['diagnosis_status'] = standardize_diagnosis(df['dx'])
+
+    # Standardize gender
+    if 'gender' in df.columns:
+        df['gender_std'] = df['gender'].astype(str).str.lower()
+        df.loc[df['gender_std'].str.contains('f', na=False), 'gender_std'] = 'female'
+        df.loc[df['gender_std'].str.contains('m', na=False), 'gender_std'] = 'male'
+    else:
+        print("Warning: 'gender' column not found")
+        df['gender_std'] = 'unknown'
+
+    # Create age groups if age column exists
+    if 'age' in df.columns:
+        # Create buckets for age: child (<=12), adolescent (13-17), adult (>=18)
+        df['age_group'] = pd.cut(
+            df['age'],
+            bins=[0, 12, 17, 100],
+            labels=['child', 'adolescent', 'adult'],
+            right=True
+        )
+    else:
+        print("Warning: 'age' column not found")
+        df['age_group'] = 'unknown'
+
+    # A participant listed more than once (e.g. by two site files) could otherwise be sampled
+    # twice and end up in two splits; keep the first row
+    duplicated = df['participant_id'].apply(format_participant_id).duplicated()
+    if duplicated.any():
+        print(f"Warning: dropping {duplicated.sum()} duplicate rows of participants listed more than once")
+        df = df[~duplicated].reset_index(drop=True)
+    return df
+
+
+def has_anat_image(participant_id, anat_dir):
+    """Check if an anatomical image exists for a participant in anat_dir."""
     # Format participant ID with 'sub-' prefix and zero-padding
     pid_str = str(participant_id)
     if pid_str.startswith('sub-'):
         pid_str = pid_str[4:]
 
-    try:
-        numeric_id = int(pid_str)
-        formatted_id = f"sub-{numeric_id:07d}"
-    except ValueError:
-        formatted_id = f"sub-{pid_str}"
+    formatted_id = format_participant_id(pid_str)
 
     # Check if directory exists in anat folder
     participant_dir = os.path.join(anat_dir, formatted_id)
@@ -96,422 +108,532 @@ def has_anat_image(participant_id):
     return False
 
 
-# Filter participants based on image availability
-print(f"Checking anatomical image availability in {anat_dir}...")
-df['has_image'] = df['participant_id'].apply(has_anat_image)
-image_available_df = df[df['has_image'] == True].copy()
-
-print(f"Found {len(image_available_df)} participants with available anatomical images")
-if len(image_available_df) < 10:
-    print("WARNING: Very few participants with images found. Check your directory paths.")
-
-# Filter to only keep rows with valid diagnosis, gender, and age group
-filtered_df = image_available_df[
-    (image_available_df['diagnosis_status'].isin(['ADHD', 'Typical Development'])) &
-    (image_available_df['gender_std'].isin(['male', 'female'])) &
-    (image_available_df['age_group'].notna())
-    ].copy()
-
-print(f"After filtering for valid demographics, {len(filtered_df)} participants remain")
-
-# If we have fewer than 100 valid participants, we'll need to be less strict
-if len(filtered_df) < 100:
-    print(f"Warning: Not enough participants with complete data (only {len(filtered_df)} available)")
-    required_count = min(100, len(image_available_df))
-    if len(filtered_df) < required_count:
-        print("Using relaxed filtering criteria...")
-        filtered_df = image_available_df[
-            image_available_df['diagnosis_status'].isin(['ADHD', 'Typical Development'])].copy()
-        print(f"After relaxed filtering, {len(filtered_df)} participants remain")
-
-# Check distribution
-print("\nDiagnosis distribution:")
-print(filtered_df['diagnosis_status'].value_counts())
-
-print("\nGender distribution:")
-print(filtered_df['gender_std'].value_counts())
-
-if 'age_group' in filtered_df.columns:
-    print("\nAge group distribution:")
-    print(filtered_df['age_group'].value_counts())
-
-# Create a stratified sample of up to 100 participants (or all available if fewer than 100)
-# We'll stratify by diagnosis, gender, and age group if possible
-try:
-    # Determine stratification columns based on available data
-    strat_columns = ['diagnosis_status', 'gender_std']
-    if 'age_group' in filtered_df.columns and not filtered_df['age_group'].isna().any():
-        strat_columns.append('age_group')
-
-    # Create a combined stratification column
-    filtered_df['strat'] = filtered_df[strat_columns].astype(str).agg('_'.join, axis=1)
-
-    # Check if we have enough data for stratification
-    strat_counts = filtered_df['strat'].value_counts()
-    min_count = strat_counts.min()
-
-    if min_count == 0:
-        # Handle empty strata by removing problematic categories
-        print("\nWarning: Some stratification categories are empty. Using simplified stratification.")
-        strat_columns = ['diagnosis_status']
-        filtered_df['strat'] = filtered_df[strat_columns].astype(str)
-
-    # For the final stratified sample
-    n_samples = min(100, len(filtered_df))
-
-    # Try stratified sampling, falling back to random if needed
+def filter_scan_properties(df, max_voxel_size=None, min_slices=None, datatypes=None):
+    """
+    Keep participants whose T1 header (scan_* columns added by remote_headers.py) meets the criteria
+
+    :param df: DataFrame with scan_* columns
+    :param max_voxel_size: Largest allowed voxel edge in mm
+    :param min_slices: Smallest allowed number of voxels along each axis
+    :param datatypes: Allowed datatypes, e.g. ['int16', 'uint8']
+    :return: Filtered DataFrame
+    """
+    keep = df['scan_key'].notna() & (df['scan_ndim'] >= 3) & (df['scan_nt'] <= 1)
+    if max_voxel_size is not None:
+        keep &= df[['scan_vx', 'scan_vy', 'scan_vz']].max(axis=1) <= max_voxel_size
+    if min_slices is not None:
+        keep &= df[['scan_nx', 'scan_ny', 'scan_nz']].min(axis=1) >= min_slices
+    if datatypes:
+        keep &= df['scan_datatype'].isin(datatypes)
+
+    print(f"{keep.sum()} of {len(df)} participants have a T1 scan meeting the scan criteria")
+    return df[keep].copy()
+
+
+def filter_participants(df, anat_dir, n_samples=100):
+    """
+    Keep participants with an anatomical image and valid diagnosis, gender and age group
+
+    :param df: DataFrame returned by load_participants
+    :param anat_dir: Directory containing one sub-XXXXXXX folder per participant, or None to rely
+        on the scan_* columns added by remote_headers.py instead of downloaded images
+    :param n_samples: Target sample size; filtering is relaxed when fewer participants qualify
+    :return: Filtered DataFrame
+    """
+    # Filter participants based on image availability
+    if anat_dir is None:
+        if 'scan_key' not in df.columns:
+            raise ValueError("No anat_dir given and the phenotype table has no scan headers")
+        print("Checking anatomical image availability from remote scan headers...")
+        df['has_image'] = df['scan_key'].notna()
+    else:
+        print(f"Checking anatomical image availability in {anat_dir}...")
+        df['has_image'] = df['participant_id'].apply(has_anat_image, anat_dir=anat_dir)
+    image_available_df = df[df['has_image'] == True].copy()
+
+    print(f"Found {len(image_available_df)} participants with available anatomical images")
+    if len(image_available_df) < 10:
+        print("WARNING: Very few participants with images found. Check your directory paths.")
+
+    # Filter to only keep rows with valid diagnosis, gender, and age group
+    filtered_df = image_available_df[
+        (image_available_df['diagnosis_status'].isin(['ADHD', 'Typical Development'])) &
+        (image_available_df['gender_std'].isin(['male', 'female'])) &
+        (image_available_df['age_group'].notna())
+        ].copy()
+
+    print(f"After filtering for valid demographics, {len(filtered_df)} participants remain")
+
+    # If we have fewer than n_samples valid participants, we'll need to be less strict
+    if len(filtered_df) < n_samples:
+        print(f"Warning: Not enough participants with complete data (only {len(filtered_df)} available)")
+        required_count = min(n_samples, len(image_available_df))
+        if len(filtered_df) < required_count:
+            print("Using relaxed filtering criteria...")
+            filtered_df = image_available_df[
+                image_available_df['diagnosis_status'].isin(['ADHD', 'Typical Development'])].copy()
+            print(f"After relaxed filtering, {len(filtered_df)} participants remain")
+
+    # Check distribution
+    print("\nDiagnosis distribution:")
+    print(filtered_df['diagnosis_status'].value_counts())
+
+    print("\nGender distribution:")
+    print(filtered_df['gender_std'].value_counts())
+
+    if 'age_group' in filtered_df.columns:
+        print("\nAge group distribution:")
+        print(filtered_df['age_group'].value_counts())
+    return filtered_df
+
+
+def stratified_sample(filtered_df, n_samples=100):
+    """
+    Create a stratified sample of up to n_samples participants (or all available if fewer)
+
+    We'll stratify by diagnosis, gender, and age group if possible.
+
+    :param filtered_df: DataFrame returned by filter_participants
+    :param n_samples: Number of participants to select
+    :return: Selected DataFrame
+    """
     try:
-        selected_df = filtered_df.groupby('strat', group_keys=False).apply(
-            lambda x: x.sample(min(len(x), int(np.ceil(n_samples * len(x) / len(filtered_df)))))
-        )
-
-        # If we have more than desired, randomly select to get exactly n_samples
-        if len(selected_df) > n_samples:
-            selected_df = selected_df.sample(n_samples, random_state=42)
-        # If we have less than desired, add more random samples
-        elif len(selected_df) < n_samples and len(filtered_df) >= n_samples:
-            remaining = filtered_df[~filtered_df.index.isin(selected_df.index)]
-            additional = remaining.sample(n_samples - len(selected_df), random_state=42)
-            selected_df = pd.concat([selected_df, additional])
-    except ValueError as e:
-        print(f"Error in stratified sampling: {e}")
+        # Determine stratification columns based on available data
+        strat_columns = ['diagnosis_status', 'gender_std']
+        if 'age_group' in filtered_df.columns and not filtered_df['age_group'].isna().any():
+            strat_columns.append('age_group')
+
+        # Create a combined stratification column
+        filtered_df['strat'] = filtered_df[strat_columns].astype(str).agg('_'.join, axis=1)
+
+        # Check if we have enough data for stratification
+        strat_counts = filtered_df['strat'].value_counts()
+        min_count = strat_counts.min()
+
+        if min_count == 0:
+            # Handle empty strata by removing problematic categories
+            print("\nWarning: Some stratification categories are empty. Using simplified stratification.")
+            strat_columns = ['diagnosis_status']
+            filtered_df['strat'] = filtered_df[strat_columns].astype(str)
+
+        # For the final stratified sample
+        n_samples = min(n_samples, len(filtered_df))
+
+        # Try stratified sampling, falling back to random if needed
+        try:
+            selected_df = filtered_df.groupby('strat', group_keys=False).apply(
+                lambda x: x.sample(min(len(x), int(np.ceil(n_samples * len(x) / len(filtered_df)))))
+            )
+
+            # If we have more than desired, randomly select to get exactly n_samples
+            if len(selected_df) > n_samples:
+                selected_df = selected_df.sample(n_samples, random_state=42)
+            # If we have less than desired, add more random samples
+            elif len(selected_df) < n_samples and len(filtered_df) >= n_samples:
+                remaining = filtered_df[~filtered_df.index.isin(selected_df.index)]
+                additional = remaining.sample(n_samples - len(selected_df), random_state=42)
+                selected_df = pd.concat([selected_df, additional])
+        except ValueError as e:
+            print(f"Error in stratified sampling: {e}")
+            print("Falling back to random sampling")
+            selected_df = filtered_df.sample(n_samples, random_state=42)
+    except Exception as e:
+        print(f"Error in creating stratified sample: {e}")
         print("Falling back to random sampling")
+        n_samples = min(n_samples, len(filtered_df))
         selected_df = filtered_df.sample(n_samples, random_state=42)
-except Exception as e:
-    print(f"Error in creating stratified sample: {e}")
-    print("Falling back to random sampling")
-    n_samples = min(100, len(filtered_df))
-    selected_df = filtered_df.sample(n_samples, random_state=42)
 
-print(f"\nSelected {len(selected_df)} participants for the ML dataset")
+    print(f"\nSelected {len(selected_df)} participants for the ML dataset")
 
-# Check final distribution
-print("\nFinal diagnosis distribution:")
-print(selected_df['diagnosis_status'].value_counts())
+    # Check final distribution
+    print("\nFinal diagnosis distribution:")
+    print(selected_df['diagnosis_status'].value_counts())
 
-print("\nFinal gender distribution:")
-print(selected_df['gender_std'].value_counts())
-
-if 'age_group' in selected_df.columns:
-    print("\nFinal age group distribution:")
-    print(selected_df['age_group'].value_counts())
-
-# Split into train (60%), validation (20%), test (20%)
-train_df, temp_df = train_test_split(
-    selected_df, test_size=0.4, random_state=42,
-    stratify=selected_df['diagnosis_status'] if 'diagnosis_status' in selected_df.columns else None
-)
-
-val_df, test_df = train_test_split(
-    temp_df, test_size=0.5, random_state=42,
-    stratify=temp_df['diagnosis_status'] if 'diagnosis_status' in temp_df.columns else None
-)
-
-print(f"\nSplit results: Training={len(train_df)}, Validation={len(val_df)}, Test={len(test_df)}")
-
-# Choose columns for the final dataset
-# Priority columns + diagnosis + standardized columns + key clinical measures
-priority_columns = ['participant_id', 'gender_std', 'age', 'age_group', 'diagnosis_status', 'source_folder']
-
-# Add important clinical measures if they exist
-potential_clinical_columns = [
-    'adhd_index', 'adhd_measure', 'iq', 'verbal_iq', 'performance_iq',
-    'full_iq', 'handedness', 'scanned', 'site'
-]
-
-final_columns = priority_columns + [col for col in potential_clinical_columns
-                                    if col in selected_df.columns]
-
-# Make sure all essential columns are present
-for col in ['participant_id', 'gender_std', 'diagnosis_status']:
-    if col not in final_columns and col in selected_df.columns:
-        final_columns.append(col)
-
-# Save the datasets
-train_df[final_columns].to_csv(os.path.join(output_dir, 'train_data.csv'), index=False)
-val_df[final_columns].to_csv(os.path.join(output_dir, 'validation_data.csv'), index=False)
-test_df[final_columns].to_csv(os.path.join(output_dir, 'test_data.csv'), index=False)
-
-# Also save the full selected dataset
-selected_df[final_columns].to_csv(os.path.join(output_dir, 'full_dataset.csv'), index=False)
-
-# Save participant IDs to text files with proper formatting
-if 'participant_id' in selected_df.columns:
-    # Save all participant IDs with 'sub-' prefix and zero-padding
-    with open(os.path.join(output_dir, 'all_participant_ids.txt'), 'w') as f:
-        for participant_id in selected_df['participant_id']:
-            # Convert to string, strip any existing prefixes
-            pid_str = str(participant_id)
-            if pid_str.startswith('sub-'):
-                pid_str = pid_str[4:]
-
-            # Zero-pad to 7 digits and add 'sub-' prefix
-            try:
-                # For numeric IDs
-                numeric_id = int(pid_str)
-                formatted_id = f"sub-{numeric_id:07d}"
-            except ValueError:
-                # For non-numeric IDs, just add the prefix
-                formatted_id = f"sub-{pid_str}"
-
-            f.write(f"{formatted_id}\n")
-
-    # Save train participant IDs with the same formatting
-    with open(os.path.join(output_dir, 'train_participant_ids.txt'), 'w') as f:
-        for participant_id in train_df['participant_id']:
-            # Convert to string, strip any existing prefixes
-            pid_str = str(participant_id)
-            if pid_str.startswith('sub-'):
-                pid_str = pid_str[4:]
-
-            # Zero-pad to 7 digits and add 'sub-' prefix
-            try:
-                numeric_id = int(pid_str)
-                formatted_id = f"sub-{numeric_id:07d}"
-            except ValueError:
-                formatted_id = f"sub-{pid_str}"
-
-            f.write(f"{formatted_id}\n")
-
-    # Save validation participant IDs with the same formatting
-    with open(os.path.join(output_dir, 'validation_participant_ids.txt'), 'w') as f:
-        for participant_id in val_df['participant_id']:
-            # Convert to string, strip any existing prefixes
-            pid_str = str(participant_id)
-            if pid_str.startswith('sub-'):
-                pid_str = pid_str[4:]
-
-            # Zero-pad to 7 digits and add 'sub-' prefix
-            try:
-                numeric_id = int(pid_str)
-                formatted_id = f"sub-{numeric_id:07d}"
-            except ValueError:
-                formatted_id = f"sub-{pid_str}"
-
-            f.write(f"{formatted_id}\n")
-
-    # Save test participant IDs with the same formatting
-    with open(os.path.join(output_dir, 'test_participant_ids.txt'), 'w') as f:
-        for participant_id in test_df['participant_id']:
-            # Convert to string, strip any existing prefixes
-            pid_str = str(participant_id)
-            if pid_str.startswith('sub-'):
-                pid_str = pid_str[4:]
-
-            # Zero-pad to 7 digits and add 'sub-' prefix
-            try:
-                numeric_id = int(pid_str)
-                formatted_id = f"sub-{numeric_id:07d}"
-            except ValueError:
-                formatted_id = f"sub-{pid_str}"
-
-            f.write(f"{formatted_id}\n")
-
-    print(f"Participant IDs saved to text files with 'sub-' prefix and zero-padding:")
-    print(f"  - all_participant_ids.txt: {len(selected_df)} IDs")
-    print(f"  - train_participant_ids.txt: {len(train_df)} IDs")
-    print(f"  - validation_participant_ids.txt: {len(val_df)} IDs")
-    print(f"  - test_participant_ids.txt: {len(test_df)} IDs")
-
-# Create a metadata file
-with open(os.path.join(output_dir, 'dataset_info.txt'), 'w') as f:
-    f.write("ADHD200 MACHINE LEARNING DATASET\n")
-    f.write("===============================\n\n")
-    f.write(f"Total samples: {len(selected_df)}\n")
-    f.write(f"Training samples: {len(train_df)} (60%)\n")
-    f.write(f"Validation samples: {len(val_df)} (20%)\n")
-    f.write(f"Test samples: {len(test_df)} (20%)\n\n")
-    f.write(f"All participants have anatomical images available in: {anat_dir}\n\n")
-
-    f.write("DATASET DISTRIBUTION\n")
-    f.write("-------------------\n\n")
-
-    f.write("Diagnosis distribution:\n")
-    diag_counts = selected_df['diagnosis_status'].value_counts()
-    for diag, count in diag_counts.items():
-        f.write(f"  {diag}: {count} ({count / len(selected_df) * 100:.1f}%)\n")
-
-    f.write("\nGender distribution:\n")
-    gender_counts = selected_df['gender_std'].value_counts()
-    for gender, count in gender_counts.items():
-        f.write(f"  {gender}: {count} ({count / len(selected_df) * 100:.1f}%)\n")
-
-    if 'age_group' in selected_df.columns:
-        f.write("\nAge group distribution:\n")
-        age_counts = selected_df['age_group'].value_counts()
-        for age, count in age_counts.items():
-            f.write(f"  {age}: {count} ({count / len(selected_df) * 100:.1f}%)\n")
-
-    f.write("\nCROSS-TABULATION\n")
-    f.write("--------------\n\n")
-
-    f.write("Diagnosis by Gender:\n")
-    diag_gender = pd.crosstab(selected_df['diagnosis_status'], selected_df['gender_std'])
-    for diag in diag_gender.index:
-        f.write(f"  {diag}:\n")
-        for gender in diag_gender.columns:
-            count = diag_gender.loc[diag, gender]
-            f.write(f"    {gender}: {count}\n")
+    print("\nFinal gender distribution:")
+    print(selected_df['gender_std'].value_counts())
 
     if 'age_group' in selected_df.columns:
-        f.write("\nDiagnosis by Age Group:\n")
-        diag_age = pd.crosstab(selected_df['diagnosis_status'], selected_df['age_group'])
-        for diag in diag_age.index:
-            f.write(f"  {diag}:\n")
-            for age in diag_age.columns:
-                count = diag_age.loc[diag, age]
-                f.write(f"    {age}: {count}\n")
-
-    f.write("\nFEATURES\n")
-    f.write("--------\n\n")
-    f.write("Columns included in the dataset:\n")
-    for col in final_columns:
-        f.write(f"  - {col}\n")
-
-print(f"\nDatasets saved to {output_dir}")
-print(f"  - train_data.csv: {len(train_df)} samples")
-print(f"  - validation_data.csv: {len(val_df)} samples")
-print(f"  - test_data.csv: {len(test_df)} samples")
-print(f"  - full_dataset.csv: {len(selected_df)} samples")
-print(f"  - dataset_info.txt: Dataset information and statistics")
-print("\nDone!")
-
-# Save participant IDs to text files
-if 'participant_id' in selected_df.columns:
-    # Save all participant IDs with 'sub-' prefix and zero-padding
-    with open(os.path.join(output_dir, 'all_participant_ids.txt'), 'w') as f:
-        for participant_id in selected_df['participant_id']:
-            # Convert to string, strip any existing prefixes
-            pid_str = str(participant_id)
-            if pid_str.startswith('sub-'):
-                pid_str = pid_str[4:]
-
-            # Zero-pad to 7 digits and add 'sub-' prefix
-            try:
-                # For numeric IDs
-                numeric_id = int(pid_str)
-                formatted_id = f"sub-{numeric_id:07d}"
-            except ValueError:
-                # For non-numeric IDs, just add the prefix
-                formatted_id = f"sub-{pid_str}"
-
-            f.write(f"{formatted_id}\n")
-
-    # Save train participant IDs with the same formatting
-    with open(os.path.join(output_dir, 'train_participant_ids.txt'), 'w') as f:
-        for participant_id in train_df['participant_id']:
-            # Convert to string, strip any existing prefixes
-            pid_str = str(participant_id)
-            if pid_str.startswith('sub-'):
-                pid_str = pid_str[4:]
-
-            # Zero-pad to 7 digits and add 'sub-' prefix
-            try:
-                numeric_id = int(pid_str)
-                formatted_id = f"sub-{numeric_id:07d}"
-            except ValueError:
-                formatted_id = f"sub-{pid_str}"
-
-            f.write(f"{formatted_id}\n")
-
-    # Save validation participant IDs with the same formatting
-    with open(os.path.join(output_dir, 'validation_participant_ids.txt'), 'w') as f:
-        for participant_id in val_df['participant_id']:
-            # Convert to string, strip any existing prefixes
-            pid_str = str(participant_id)
-            if pid_str.startswith('sub-'):
-                pid_str = pid_str[4:]
-
-            # Zero-pad to 7 digits and add 'sub-' prefix
-            try:
-                numeric_id = int(pid_str)
-                formatted_id = f"sub-{numeric_id:07d}"
-            except ValueError:
-                formatted_id = f"sub-{pid_str}"
-
-            f.write(f"{formatted_id}\n")
-
-    # Save test participant IDs with the same formatting
-    with open(os.path.join(output_dir, 'test_participant_ids.txt'), 'w') as f:
-        for participant_id in test_df['participant_id']:
-            # Convert to string, strip any existing prefixes
-            pid_str = str(participant_id)
-            if pid_str.startswith('sub-'):
-                pid_str = pid_str[4:]
-
-            # Zero-pad to 7 digits and add 'sub-' prefix
-            try:
-                numeric_id = int(pid_str)
-                formatted_id = f"sub-{numeric_id:07d}"
-            except ValueError:
-                formatted_id = f"sub-{pid_str}"
-
-            f.write(f"{formatted_id}\n")
-
-    print(f"Participant IDs saved to text files with 'sub-' prefix and zero-padding:")
-    print(f"  - all_participant_ids.txt: {len(selected_df)} IDs")
-    print(f"  - train_participant_ids.txt: {len(train_df)} IDs")
-    print(f"  - validation_participant_ids.txt: {len(val_df)} IDs")
-    print(f"  - test_participant_ids.txt: {len(test_df)} IDs")
-
-# Create a metadata file
-with open(os.path.join(output_dir, 'dataset_info.txt'), 'w') as f:
-    f.write("ADHD200 MACHINE LEARNING DATASET\n")
-    f.write("===============================\n\n")
-    f.write(f"Total samples: {len(selected_df)}\n")
-    f.write(f"Training samples: {len(train_df)} (60%)\n")
-    f.write(f"Validation samples: {len(val_df)} (20%)\n")
-    f.write(f"Test samples: {len(test_df)} (20%)\n\n")
-
-    f.write("DATASET DISTRIBUTION\n")
-    f.write("-------------------\n\n")
-
-    f.write("Diagnosis distribution:\n")
-    diag_counts = selected_df['diagnosis_status'].value_counts()
-    for diag, count in diag_counts.items():
-        f.write(f"  {diag}: {count} ({count / len(selected_df) * 100:.1f}%)\n")
-
-    f.write("\nGender distribution:\n")
-    gender_counts = selected_df['gender_std'].value_counts()
-    for gender, count in gender_counts.items():
-        f.write(f"  {gender}: {count} ({count / len(selected_df) * 100:.1f}%)\n")
+        print("\nFinal age group distribution:")
+        print(selected_df['age_group'].value_counts())
+    return selected_df
+
+
+def matched_sample(filtered_df, n_samples=100, ratio=1, caliper=DEFAULT_CALIPER, method='greedy'):
+    """
+    Select ADHD participants together with age-, gender- and site-matched Typical Development controls
+
+    Every ADHD participant gets up to ratio controls (see control_matching.match_controls). A case
+    and its controls form a match group that is kept whole; when the groups hold more than
+    n_samples participants, groups are drawn at random until n_samples is reached.
+
+    :param filtered_df: DataFrame returned by filter_participants
+    :param n_samples: Largest number of participants to select
+    :param ratio: Controls per ADHD participant
+    :param caliper: Largest age distance in pooled SDs, or None for no limit
+    :param method: 'greedy' or 'optimal' assignment
+    :return: Selected DataFrame with match_group and match_distance columns
+    """
+    matches = match_controls(filtered_df, ratio=ratio, caliper=caliper, method=method)
+    n_cases = (filtered_df['diagnosis_status'] == 'ADHD').sum()
+    print(f"\nMatched {matches['case'].nunique()} of {n_cases} ADHD participants to {len(matches)} controls "
+          f"(1:{ratio}, {method}, caliper {caliper})")
+    if matches.empty:
+        print("No matches found, falling back to stratified sampling")
+        return stratified_sample(filtered_df, n_samples)
+
+    group_sizes = matches.groupby('case').size().sample(frac=1, random_state=42) + 1
+    cases = group_sizes.index[group_sizes.cumsum() <= n_samples]
+    matches = matches[matches['case'].isin(cases)]
+
+    selected_df = filtered_df.loc[list(cases) + matches['control'].tolist()].copy()
+    case_ids = filtered_df.loc[cases, 'participant_id'].apply(format_participant_id)
+    selected_df['match_group'] = list(case_ids) + case_ids[matches['case']].tolist()
+    selected_df['match_distance'] = [0.0] * len(cases) + matches['distance'].round(4).tolist()
+
+    print(f"Selected {len(selected_df)} participants in {len(cases)} match groups")
+    before = balance_table(filtered_df, filtered_df['diagnosis_status'] == 'ADHD')
+    after = balance_table(selected_df, selected_df['diagnosis_status'] == 'ADHD')
+    for covariate, smd in before.items():
+        print(f"Standardized mean difference of {covariate}: {smd:+.3f} before, {after[covariate]:+.3f} after matching")
+
+    print("\nFinal diagnosis distribution:")
+    print(selected_df['diagnosis_status'].value_counts())
+
+    print("\nFinal gender distribution:")
+    print(selected_df['gender_std'].value_counts())
+    return selected_df
+
+
+def select_participants(filtered_df, n_samples=100, matching=None):
+    """stratified_sample, or matched_sample with the keyword arguments in matching when given."""
+    if matching is None:
+        return stratified_sample(filtered_df, n_samples)
+    return matched_sample(filtered_df, n_samples, **matching)
+
+
+def split_dataset(selected_df):
+    """
+    Split into train (60%), validation (20%), test (20%), stratified by diagnosis
+
+    Participants selected by matched_sample are split by match group instead, so every case stays
+    in the same split as its controls.
+
+    :return: Tuple of (train_df, val_df, test_df)
+    """
+    if 'match_group' in selected_df.columns:
+        groups = selected_df['match_group'].unique()
+        train_groups, temp_groups = train_test_split(groups, test_size=0.4, random_state=42)
+        val_groups, test_groups = train_test_split(temp_groups, test_size=0.5, random_state=42)
+        train_df, val_df, test_df = (selected_df[selected_df['match_group'].isin(g)]
+                                     for g in (train_groups, val_groups, test_groups))
+        print(f"\nSplit results: Training={len(train_df)}, Validation={len(val_df)}, Test={len(test_df)}")
+        return train_df, val_df, test_df
+
+    train_df, temp_df = train_test_split(
+        selected_df, test_size=0.4, random_state=42,
+        stratify=selected_df['diagnosis_status'] if 'diagnosis_status' in selected_df.columns else None
+    )
 
-    if 'age_group' in selected_df.columns:
-        f.write("\nAge group distribution:\n")
-        age_counts = selected_df['age_group'].value_counts()
-        for age, count in age_counts.items():
-            f.write(f"  {age}: {count} ({count / len(selected_df) * 100:.1f}%)\n")
-
-    f.write("\nCROSS-TABULATION\n")
-    f.write("--------------\n\n")
-
-    f.write("Diagnosis by Gender:\n")
-    diag_gender = pd.crosstab(selected_df['diagnosis_status'], selected_df['gender_std'])
-    for diag in diag_gender.index:
-        f.write(f"  {diag}:\n")
-        for gender in diag_gender.columns:
-            count = diag_gender.loc[diag, gender]
-            f.write(f"    {gender}: {count}\n")
+    val_df, test_df = train_test_split(
+        temp_df, test_size=0.5, random_state=42,
+        stratify=temp_df['diagnosis_status'] if 'diagnosis_status' in temp_df.columns else None
+    )
 
-    if 'age_group' in selected_df.columns:
-        f.write("\nDiagnosis by Age Group:\n")
-        diag_age = pd.crosstab(selected_df['diagnosis_status'], selected_df['age_group'])
-        for diag in diag_age.index:
+    print(f"\nSplit results: Training={len(train_df)}, Validation={len(val_df)}, Test={len(test_df)}")
+    return train_df, val_df, test_df
+
+
+def get_final_columns(selected_df):
+    """Choose columns for the final dataset."""
+    final_columns = PRIORITY_COLUMNS + [col for col in POTENTIAL_CLINICAL_COLUMNS + MATCH_COLUMNS
+                                        if col in selected_df.columns]
+
+    # Make sure all essential columns are present
+    for col in ['participant_id', 'gender_std', 'diagnosis_status']:
+        if col not in final_columns and col in selected_df.columns:
+            final_columns.append(col)
+    return final_columns
+
+
+def write_participant_ids(participant_ids, path):
+    """Save participant IDs to a text file with 'sub-' prefix and zero-padding."""
+    with open(path, 'w') as f:
+        for participant_id in participant_ids:
+            f.write(f"{format_participant_id(participant_id)}\n")
+
+
+def write_dataset(selected_df, train_df, val_df, test_df, output_dir, anat_dir):
+    """
+    Save the split CSV files, participant ID lists and dataset_info.txt
+
+    :param selected_df: All selected participants
+    :param train_df: Training split
+    :param val_df: Validation split
+    :param test_df: Test split
+    :param output_dir: Output folder
+    :param anat_dir: Directory containing the anatomical images (recorded in dataset_info.txt)
+    """
+    final_columns = get_final_columns(selected_df)
+
+    # Save the datasets
+    train_df[final_columns].to_csv(os.path.join(output_dir, 'train_data.csv'), index=False)
+    val_df[final_columns].to_csv(os.path.join(output_dir, 'validation_data.csv'), index=False)
+    test_df[final_columns].to_csv(os.path.join(output_dir, 'test_data.csv'), index=False)
+
+    # Also save the full selected dataset
+    selected_df[final_columns].to_csv(os.path.join(output_dir, 'full_dataset.csv'), index=False)
+
+    # Save participant IDs to text files with proper formatting
+    if 'participant_id' in selected_df.columns:
+        write_participant_ids(selected_df['participant_id'], os.path.join(output_dir, 'all_participant_ids.txt'))
+        write_participant_ids(train_df['participant_id'], os.path.join(output_dir, 'train_participant_ids.txt'))
+        write_participant_ids(val_df['participant_id'], os.path.join(output_dir, 'validation_participant_ids.txt'))
+        write_participant_ids(test_df['participant_id'], os.path.join(output_dir, 'test_participant_ids.txt'))
+
+        print(f"Participant IDs saved to text files with 'sub-' prefix and zero-padding:")
+        print(f"  - all_participant_ids.txt: {len(selected_df)} IDs")
+        print(f"  - train_participant_ids.txt: {len(train_df)} IDs")
+        print(f"  - validation_participant_ids.txt: {len(val_df)} IDs")
+        print(f"  - test_participant_ids.txt: {len(test_df)} IDs")
+
+    # Create a metadata file
+    with open(os.path.join(output_dir, 'dataset_info.txt'), 'w') as f:
+        f.write("ADHD200 MACHINE LEARNING DATASET\n")
+        f.write("===============================\n\n")
+        f.write(f"Total samples: {len(selected_df)}\n")
+        f.write(f"Training samples: {len(train_df)} (60%)\n")
+        f.write(f"Validation samples: {len(val_df)} (20%)\n")
+        f.write(f"Test samples: {len(test_df)} (20%)\n\n")
+        if anat_dir is None:
+            f.write("All participants have a remote anatomical image (see scan_key)\n\n")
+        else:
+            f.write(f"All participants have anatomical images available in: {anat_dir}\n\n")
+
+        f.write("DATASET DISTRIBUTION\n")
+        f.write("-------------------\n\n")
+
+        f.write("Diagnosis distribution:\n")
+        diag_counts = selected_df['diagnosis_status'].value_counts()
+        for diag, count in diag_counts.items():
+            f.write(f"  {diag}: {count} ({count / len(selected_df) * 100:.1f}%)\n")
+
+        f.write("\nGender distribution:\n")
+        gender_counts = selected_df['gender_std'].value_counts()
+        for gender, count in gender_counts.items():
+            f.write(f"  {gender}: {count} ({count / len(selected_df) * 100:.1f}%)\n")
+
+        if 'age_group' in selected_df.columns:
+            f.write("\nAge group distribution:\n")
+            age_counts = selected_df['age_group'].value_counts()
+            for age, count in age_counts.items():
+                f.write(f"  {age}: {count} ({count / len(selected_df) * 100:.1f}%)\n")
+
+        f.write("\nCROSS-TABULATION\n")
+        f.write("--------------\n\n")
+
+        f.write("Diagnosis by Gender:\n")
+        diag_gender = pd.crosstab(selected_df['diagnosis_status'], selected_df['gender_std'])
+        for diag in diag_gender.index:
             f.write(f"  {diag}:\n")
-            for age in diag_age.columns:
-                count = diag_age.loc[diag, age]
-                f.write(f"    {age}: {count}\n")
-
-    f.write("\nFEATURES\n")
-    f.write("--------\n\n")
-    f.write("Columns included in the dataset:\n")
-    for col in final_columns:
-        f.write(f"  - {col}\n")
-
-print(f"\nDatasets saved to {output_dir}")
-print(f"  - train_data.csv: {len(train_df)} samples")
-print(f"  - validation_data.csv: {len(val_df)} samples")
-print(f"  - test_data.csv: {len(test_df)} samples")
-print(f"  - full_dataset.csv: {len(selected_df)} samples")
-print(f"  - dataset_info.txt: Dataset information and statistics")
-print("\nDone!")
\ No newline at end of file
+            for gender in diag_gender.columns:
+                count = diag_gender.loc[diag, gender]
+                f.write(f"    {gender}: {count}\n")
+
+        if 'age_group' in selected_df.columns:
+            f.write("\nDiagnosis by Age Group:\n")
+            diag_age = pd.crosstab(selected_df['diagnosis_status'], selected_df['age_group'])
+            for diag in diag_age.index:
+                f.write(f"  {diag}:\n")
+                for age in diag_age.columns:
+                    count = diag_age.loc[diag, age]
+                    f.write(f"    {age}: {count}\n")
+
+        f.write("\nFEATURES\n")
+        f.write("--------\n\n")
+        f.write("Columns included in the dataset:\n")
+        for col in final_columns:
+            f.write(f"  - {col}\n")
+
+    print(f"\nDatasets saved to {output_dir}")
+    print(f"  - train_data.csv: {len(train_df)} samples")
+    print(f"  - validation_data.csv: {len(val_df)} samples")
+    print(f"  - test_data.csv: {len(test_df)} samples")
+    print(f"  - full_dataset.csv: {len(selected_df)} samples")
+    print(f"  - dataset_info.txt: Dataset information and statistics")
+
+
+def read_cohort_splits(cohort_dir):
+    """
+    Read the split CSVs of a cohort written by this script, e.g. data/train_data.csv or
+    data/additional/additional_train_data.csv
+
+    :return: Dictionary mapping split name to its DataFrame
+    """
+    splits = {}
+    for split in SPLITS:
+        matches = sorted(f for f in os.listdir(cohort_dir) if f.endswith(f"{split}_data.csv"))
+        if not matches:
+            raise FileNotFoundError(f"No {split}_data.csv in {cohort_dir}")
+        splits[split] = pd.read_csv(os.path.join(cohort_dir, matches[0]))
+    return splits
+
+
+def existing_assignments(cohort_dirs):
+    """
+    Collect the split of every participant of existing cohorts
+
+    A participant found in more than one split keeps the first one, in the order of cohort_dirs
+    and then train, validation, test; the other rows are left out with a warning.
+
+    :param cohort_dirs: Folders with split CSVs
+    :return: Dictionary mapping split name to a DataFrame of its participants across all cohorts
+    """
+    assignments = {}
+    combined = {split: [] for split in SPLITS}
+    conflicts = 0
+    for cohort_dir in cohort_dirs:
+        for split, df in read_cohort_splits(cohort_dir).items():
+            keep = []
+            for participant_id in df['participant_id'].apply(format_participant_id):
+                previous = assignments.setdefault(participant_id, (split, cohort_dir))
+                keep.append(previous[0] == split)
+                if previous[0] != split:
+                    conflicts += 1
+                    print(f"Warning: {participant_id} is in {previous[0]} in {previous[1]} and in {split} "
+                          f"in {cohort_dir}; keeping {previous[0]}")
+            combined[split].append(df[keep])
+
+    result = {}
+    for split, frames in combined.items():
+        df = pd.concat(frames, ignore_index=True)
+        result[split] = df[~df['participant_id'].apply(format_participant_id).duplicated()].reset_index(drop=True)
+    print("Existing cohorts: " + ', '.join(f"{split}={len(df)}" for split, df in result.items())
+          + (f" ({conflicts} rows in a second split left out)" if conflicts else ''))
+    return result
+
+
+def extend_dataset(root_dir, output_dir, anat_dir, cohort_dirs, n_new=100, scan_filters=None, subjects_dir=None,
+                   matching=None):
+    """
+    Add participants to existing cohorts without changing their train/validation/test assignments
+
+    Participants of any existing cohort are never selected again, so no subject ends up in
+    two splits. The new ones are sampled and split 60/20/20 like a new cohort, and the
+    combined splits are written to output_dir together with new_participant_ids.txt, the
+    subjects that still need to be downloaded and processed.
+
+    :param root_dir: Folder containing the combined participants CSV from phenotype_data.py
+    :param output_dir: Output folder for the combined split files
+    :param anat_dir: Directory with the anatomical images, or None to use the remote scan headers
+    :param cohort_dirs: Folders with the split CSVs of the existing cohorts (e.g. data, data/additional)
+    :param n_new: Number of participants to add
+    :param scan_filters: Keyword arguments of filter_scan_properties
+    :param subjects_dir: Optional FreeSurfer SUBJECTS_DIR; subjects already processed there are left
+        out of new_participant_ids.txt
+    :param matching: Keyword arguments of matched_sample to select matched sets instead of a stratified sample
+    :return: Tuple of (selected_df, train_df, val_df, test_df, new participant IDs to process)
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    existing = existing_assignments(cohort_dirs)
+    existing_ids = set(pd.concat(existing.values())['participant_id'].apply(format_participant_id))
+
+    df = load_participants(root_dir)
+    df = df[~df['participant_id'].apply(format_participant_id).isin(existing_ids)].copy()
+    print(f"{len(df)} participants are not in an existing cohort")
+    if scan_filters:
+        df = filter_scan_properties(df, **scan_filters)
+    filtered_df = filter_participants(df, anat_dir, n_new)
+    new_df = select_participants(filtered_df, n_new, matching)
+    new_splits = split_dataset(new_df)
+
+    columns = get_final_columns(new_df)
+    train_df, val_df, test_df = (
+        pd.concat([existing[split], new_split[[c for c in columns if c in new_split.columns]]], ignore_index=True)
+        for split, new_split in zip(SPLITS, new_splits)
+    )
+    selected_df = pd.concat([train_df, val_df, test_df], ignore_index=True)
+    write_dataset(selected_df, train_df, val_df, test_df, output_dir, anat_dir)
+
+    to_process = [
+        participant_id for participant_id in sorted(new_df['participant_id'].apply(format_participant_id))
+        if not (subjects_dir and os.path.isfile(os.path.join(subjects_dir, participant_id, 'scripts',
+                                                             'recon-all.done')))
+    ]
+    write_participant_ids(to_process, os.path.join(output_dir, 'new_participant_ids.txt'))
+    print(f"\nAdded {len(new_df)} participants; {len(to_process)} to download and process "
+          f"listed in {os.path.join(output_dir, 'new_participant_ids.txt')}")
+    return selected_df, train_df, val_df, test_df, to_process
+
+
+def generate_dataset(root_dir, output_dir, anat_dir, n_samples=100, scan_filters=None, matching=None):
+    """
+    Select a stratified cohort with available T1 images and split it into train/validation/test
+
+    :param root_dir: Folder containing the combined participants CSV from phenotype_data.py
+    :param output_dir: Output folder for the split files
+    :param anat_dir: Directory containing one sub-XXXXXXX folder of anatomical images per participant,
+        or None to use the remote scan headers in the participants CSV
+    :param n_samples: Number of participants to select
+    :param scan_filters: Keyword arguments of filter_scan_properties; requires the scan_* columns
+    :param matching: Keyword arguments of matched_sample to select matched sets instead of a stratified sample
+    :return: Tuple of (selected_df, train_df, val_df, test_df)
+    """
+    # Create output directory if it doesn't exist
+    os.makedirs(output_dir, exist_ok=True)
+
+    df = load_participants(root_dir)
+    if scan_filters:
+        df = filter_scan_properties(df, **scan_filters)
+    filtered_df = filter_participants(df, anat_dir, n_samples)
+    selected_df = select_participants(filtered_df, n_samples, matching)
+    train_df, val_df, test_df = split_dataset(selected_df)
+    write_dataset(selected_df, train_df, val_df, test_df, output_dir, anat_dir)
+    print("\nDone!")
+    return selected_df, train_df, val_df, test_df
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generate train/validation/test splits for the ML dataset')
+    parser.add_argument('--root-dir', required=True,
+                        help='Folder containing combined_participants_with_diagnosis.csv (output of phenotype_data.py)')
+    parser.add_argument('--output-dir', default='./data', help='Output folder for the split files (default: data)')
+    parser.add_argument('--anat-dir', default=None,
+                        help='Directory containing one sub-XXXXXXX folder of anatomical images per participant '
+                             '(omit to use scan headers added by remote_headers.py)')
+    parser.add_argument('--n-samples', type=int, default=100,
+                        help='Number of participants to select, or to add with --extend (default: 100)')
+    parser.add_argument('--extend', nargs='+', default=None,
+                        help='Folders of existing cohorts (e.g. data data/additional) to extend instead of '
+                             'selecting a new cohort; their split assignments are kept')
+    parser.add_argument('--subjects-dir', default=None,
+                        help='With --extend, FreeSurfer SUBJECTS_DIR whose processed subjects are left out '
+                             'of new_participant_ids.txt')
+    parser.add_argument('--max-voxel-size', type=float, default=None,
+                        help='Only select scans whose largest voxel edge is at most this many mm')
+    parser.add_argument('--min-slices', type=int, default=None,
+                        help='Only select scans with at least this many voxels along each axis')
+    parser.add_argument('--datatypes', nargs='+', default=None,
+                        help='Only select scans with these NIfTI datatypes, e.g. int16 uint8')
+    parser.add_argument('--strategy', choices=['stratified', 'matched'], default='stratified',
+                        help='Stratified sample, or ADHD participants with age-, gender- and site-matched '
+                             'controls (default: stratified)')
+    parser.add_argument('--match-ratio', type=int, default=1,
+                        help='With --strategy matched, controls per ADHD participant (default: 1)')
+    parser.add_argument('--caliper', type=float, default=DEFAULT_CALIPER,
+                        help=f'With --strategy matched, largest age distance in SDs (default: {DEFAULT_CALIPER})')
+    parser.add_argument('--match-method', choices=['greedy', 'optimal'], default='greedy',
+                        help='With --strategy matched, assignment of controls to cases (default: greedy)')
+
+    args = parser.parse_args()
+
+    filters = {name: value for name, value in (('max_voxel_size', args.max_voxel_size),
+                                               ('min_slices', args.min_slices),
+                                               ('datatypes', args.datatypes)) if value is not None}
+    match_options = None
+    if args.strategy == 'matched':
+        match_options = {'ratio': args.match_ratio, 'caliper': args.caliper, 'method': args.match_method}
+    if args.extend:
+        extend_dataset(args.root_dir, args.output_dir, args.anat_dir, args.extend, args.n_samples, filters,
+                       args.subjects_dir, match_options)
+    else:
+        generate_dataset(args.root_dir, args.output_dir, args.anat_dir, args.n_samples, filters, match_options)
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+import argparse
+import csv
+import hashlib
+import logging
+import os
+import re
+import shutil
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+from nifti_header import read_nifti_header
+
+# Read files in 4 MB chunks when hashing
+CHUNK_SIZE = 4 * 1024 * 1024
+
+MANIFEST_FIELDS = [
+    'subject_id', 'selected_file', 'sha256', 'shape', 'voxel_size', 'acq',
+    'n_candidates', 'duplicates', 'rejected'
+]
+
+
+def hash_file(path, chunk_size=CHUNK_SIZE):
+    """
+    Compute the SHA-256 of a file, reading it in fixed-size chunks
+
+    :param path: Path to the file
+    :param chunk_size: Number of bytes to read at a time
+    :return: Tuple of (path, hex digest)
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return path, digest.hexdigest()
+
+
+def hash_files(paths, workers=None):
+    """
+    Hash files in parallel using a process pool
+
+    :param paths: List of file paths
+    :param workers: Number of worker processes (default: CPU count)
+    :return: Dictionary mapping path to hex digest
+    """
+    if not paths:
+        return {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return dict(executor.map(hash_file, paths, chunksize=max(1, len(paths) // 64)))
+
+
+def find_duplicate_groups(paths, workers=None):
+    """
+    Find byte-identical files. Only files that share a size with another file are hashed.
+
+    :param paths: List of file paths
+    :param workers: Number of worker processes used for hashing
+    :return: Tuple of (digests, groups) where digests maps path to hex digest for every hashed
+             file and groups maps a digest to the list of paths with that content
+    """
+    by_size = defaultdict(list)
+    for path in paths:
+        by_size[os.path.getsize(path)].append(path)
+
+    candidates = [p for same_size in by_size.values() if len(same_size) > 1 for p in same_size]
+    digests = hash_files(candidates, workers)
+
+    groups = defaultdict(list)
+    for path, digest in digests.items():
+        groups[digest].append(path)
+    return digests, {d: sorted(p) for d, p in groups.items() if len(p) > 1}
+
+
+def parse_entity(filename, entity):
+    """Return the value of a BIDS entity (e.g. acq, run) from a filename, or None."""
+    match = re.search(rf'(?:^|_){entity}-([a-zA-Z0-9]+)', filename)
+    return match.group(1) if match else None
+
+
+def scan_rank_key(path, header):
+    """
+    Build a sort key ranking candidate T1 scans, best first.
+
+    Unreadable or non-3D images sort last. Among usable scans, smaller voxels win, then
+    more isotropic voxels, then larger field of view, then the earliest acquisition label
+    and run number so the choice is deterministic.
+
+    :param path: Path to the scan
+    :param header: Header dictionary from read_nifti_header, or None if it could not be read
+    :return: Tuple usable as a sort key
+    """
+    filename = os.path.basename(path)
+    acq = parse_entity(filename, 'acq') or ''
+    run = parse_entity(filename, 'run')
+    run = int(run) if run and run.isdigit() else 0
+
+    if header is None or len(header['shape']) < 3 or any(s > 1 for s in header['shape'][3:]):
+        return (1, float('inf'), float('inf'), 0, acq, run, filename)
+
+    voxel_size = header['voxel_size'] or (1.0, 1.0, 1.0)
+    voxel_volume = round(voxel_size[0] * voxel_size[1] * voxel_size[2], 3)
+    anisotropy = round(max(voxel_size) / min(voxel_size), 3) if min(voxel_size) > 0 else float('inf')
+    n_voxels = header['shape'][0] * header['shape'][1] * header['shape'][2]
+
+    return (0, voxel_volume, anisotropy, -n_voxels, acq, run, filename)
+
+
+def list_subject_scans(anat_dir):
+    """
+    List NIfTI files per subject directory (anat_dir/sub-XXXXXXX/*.nii[.gz])
+
+    :param anat_dir: Directory produced by organize_mri_data
+    :return: Dictionary mapping subject ID to sorted list of file paths
+    """
+    scans = {}
+    for subject_id in sorted(os.listdir(anat_dir)):
+        subject_dir = os.path.join(anat_dir, subject_id)
+        if not subject_id.startswith('sub-') or not os.path.isdir(subject_dir):
+            continue
+        files = [
+            os.path.join(subject_dir, f) for f in sorted(os.listdir(subject_dir))
+            if f.endswith('.nii') or f.endswith('.nii.gz')
+        ]
+        if files:
+            scans[subject_id] = files
+    return scans
+
+
+def select_best_scans(anat_dir, workers=None):
+    """
+    Choose one T1 scan per subject after removing byte-identical duplicates
+
+    :param anat_dir: Directory produced by organize_mri_data
+    :param workers: Number of worker processes used for hashing
+    :return: List of manifest rows, one per subject
+    """
+    scans = list_subject_scans(anat_dir)
+    all_files = [p for files in scans.values() for p in files]
+    logging.info(f"Found {len(all_files)} scans for {len(scans)} subjects in {anat_dir}")
+
+    digests, groups = find_duplicate_groups(all_files, workers)
+    logging.info(f"Found {len(groups)} groups of byte-identical files")
+
+    # Identical files of different subjects are reported but not removed, so every subject keeps a scan
+    subject_of = {path: subject_id for subject_id, files in scans.items() for path in files}
+    for paths in groups.values():
+        subjects = sorted({subject_of[path] for path in paths})
+        if len(subjects) > 1:
+            logging.warning(f"Subjects {', '.join(subjects)} share a byte-identical scan: {paths[0]}")
+
+    rows = []
+    for subject_id, files in scans.items():
+        # Only the first copy of a content within the subject is ranked
+        seen = set()
+        unique, duplicates = [], []
+        for path in files:
+            digest = digests.get(path)
+            if digest in seen:
+                duplicates.append(path)
+            else:
+                unique.append(path)
+                if digest:
+                    seen.add(digest)
+
+        headers = {}
+        for path in unique:
+            try:
+                headers[path] = read_nifti_header(path)
+            except (OSError, EOFError, ValueError) as e:
+                logging.warning(f"Could not read header of {path}: {e}")
+                headers[path] = None
+
+        ranked = sorted(unique, key=lambda p: scan_rank_key(p, headers[p]))
+        best = ranked[0]
+        header = headers[best] or {}
+
+        rows.append({
+            'subject_id': subject_id,
+            'selected_file': best,
+            'sha256': digests.get(best, ''),
+            'shape': 'x'.join(str(s) for s in header.get('shape', ())),
+            'voxel_size': 'x'.join(f"{v:g}" for v in header.get('voxel_size', ())),
+            'acq': parse_entity(os.path.basename(best), 'acq') or '',
+            'n_candidates': len(files),
+            'duplicates': ';'.join(duplicates),
+            'rejected': ';'.join(ranked[1:]),
+        })
+    return rows
+
+
+def write_manifest(rows, manifest_path):
+    """
+    Write the selected scans to a CSV manifest
+
+    :param rows: Rows returned by select_best_scans
+    :param manifest_path: Output CSV path
+    """
+    manifest_dir = os.path.dirname(manifest_path)
+    if manifest_dir:
+        os.makedirs(manifest_dir, exist_ok=True)
+    with open(manifest_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=MANIFEST_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    logging.info(f"Manifest with {len(rows)} subjects saved to {manifest_path}")
+
+
+def move_unselected(rows, backup_dir):
+    """
+    Move duplicate and rejected scans out of the subject directories
+
+    :param rows: Rows returned by select_best_scans
+    :param backup_dir: Folder receiving the moved files
+    :return: Number of files moved
+    """
+    os.makedirs(backup_dir, exist_ok=True)
+    moved = 0
+    for row in rows:
+        for field, label in (('duplicates', 'duplicate'), ('rejected', 'rejected scan')):
+            for path in filter(None, row[field].split(';')):
+                # Prefix with the subject ID to avoid conflicts in the backup directory
+                dest = os.path.join(backup_dir, f"{row['subject_id']}_{os.path.basename(path)}")
+                logging.info(f"Moving {label} {path} -> {dest}")
+                shutil.move(path, dest)
+                moved += 1
+    return moved
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Remove duplicate T1 scans and select the best scan per subject')
+    parser.add_argument('--anat-dir', required=True,
+                        help='Directory with one sub-XXXXXXX folder per subject (output of data_organizer.py)')
+    parser.add_argument('--manifest', default='./data/selected_scans.csv',
+                        help='Output CSV manifest (default: data/selected_scans.csv)')
+    parser.add_argument('--backup-dir', default=None,
+                        help='Move duplicate and rejected scans to this folder (default: leave files in place)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of hashing processes (default: CPU count)')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    selected = select_best_scans(args.anat_dir, args.workers)
+    write_manifest(selected, args.manifest)
+
+    if args.backup_dir:
+        total_moved = move_unselected(selected, args.backup_dir)
+        logging.info(f"Moved {total_moved} files to {args.backup_dir}")
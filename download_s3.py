@@ -1,15 +1,36 @@
 import json
 import os
+import sqlite3
 import subprocess
 import argparse
 import logging
 
+from s3_manifest import load_objects
+import tracing
+
+
+def download_s3_object(s3_uri, output_path):
+    """
+    Download a single S3 object using the AWS CLI
+
+    :param s3_uri: S3 URI of the object (s3://bucket/key)
+    :param output_path: Local path to write the object to
+    :return: True if the download succeeded
+    """
+    command = ['aws', 's3', 'cp', s3_uri, output_path]
+    result = subprocess.run(command, capture_output=True, text=True)
+
+    if result.returncode != 0:
+        logging.error(f"Failed to download {s3_uri}: {result.stderr}")
+        return False
+    return True
+
 
 def download_s3_objects(json_file, output_folder):
     """
-    Read S3 URIs from JSON file and download files to specified output folder
+    Read S3 URIs from a JSON or SQLite manifest and download files to specified output folder
 
-    :param json_file: Path to the JSON file containing S3 object information
+    :param json_file: Path to the JSON file or SQLite manifest containing S3 object information
     :param output_folder: Folder where files should be downloaded
     """
     # Set up logging
@@ -21,9 +42,8 @@ def download_s3_objects(json_file, output_folder):
         os.makedirs(output_folder)
 
     try:
-        # Read JSON file
-        with open(json_file, 'r') as f:
-            objects = json.load(f)
+        # Read JSON file or SQLite manifest
+        objects = load_objects(json_file)
 
         logging.info(f"Found {len(objects)} objects in JSON file")
 
@@ -47,20 +67,19 @@ def download_s3_objects(json_file, output_folder):
             # Download using AWS CLI
             logging.info(f"Downloading [{i + 1}/{len(objects)}]: {s3_uri} to {output_path}")
 
-            command = ['aws', 's3', 'cp', s3_uri, output_path]
-            result = subprocess.run(command, capture_output=True, text=True)
-
-            if result.returncode == 0:
-                logging.info(f"Successfully downloaded: {filename}")
-            else:
-                logging.error(f"Failed to download {s3_uri}: {result.stderr}")
+            with tracing.span('download', key=obj.get('key')) as span:
+                if download_s3_object(s3_uri, output_path):
+                    span.add_bytes(os.path.getsize(output_path))
+                    logging.info(f"Successfully downloaded: {filename}")
+                else:
+                    span.fail("aws s3 cp failed")
 
         logging.info(f"Download process completed")
 
     except FileNotFoundError:
         logging.error(f"JSON file not found: {json_file}")
-    except json.JSONDecodeError:
-        logging.error(f"Invalid JSON format in file: {json_file}")
+    except (json.JSONDecodeError, sqlite3.DatabaseError):
+        logging.error(f"Invalid manifest format in file: {json_file}")
     except Exception as e:
         logging.error(f"An error occurred: {str(e)}")
 
@@ -69,7 +88,7 @@ if __name__ == "__main__":
     # Set up command line argument parsing
     parser = argparse.ArgumentParser(description='Download S3 objects from JSON file')
     parser.add_argument('--json', default='./data/s3_objects.json',
-                        help='Path to JSON file with S3 object information (default: data/s3_objects.json)')
+                        help='Path to JSON file or SQLite manifest with S3 object information (default: data/s3_objects.json)')
     parser.add_argument('--output', default='./anat',
                         help='Output folder for downloaded files (default: downloads)')
 
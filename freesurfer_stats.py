@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+import argparse
+import csv
+import os
+
+import tracing
+
+# Columns taken from ?h.aparc.stats, named the same way as aparcstats2table
+APARC_MEASURES = {'SurfArea': 'area', 'GrayVol': 'volume', 'ThickAvg': 'thickness'}
+
+
+def read_stats_file(path):
+    """
+    Parse a FreeSurfer .stats file
+
+    :param path: Path to e.g. stats/aseg.stats or stats/lh.aparc.stats
+    :return: Tuple of (measures, rows) where measures maps the "# Measure" short names to values
+             and rows is a list of dictionaries keyed by the "# ColHeaders" names
+    """
+    measures = {}
+    headers = []
+    rows = []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('# Measure'):
+                # e.g. "# Measure BrainSeg, BrainSegVol, Brain Segmentation Volume, 1156823.0, mm^3"
+                parts = [p.strip() for p in line[len('# Measure'):].split(',')]
+                if len(parts) >= 4:
+                    try:
+                        measures[parts[1]] = float(parts[3])
+                    except ValueError:
+                        pass
+            elif line.startswith('# ColHeaders'):
+                headers = line.split()[2:]
+            elif not line.startswith('#') and headers:
+                rows.append(dict(zip(headers, line.split())))
+    return measures, rows
+
+
+def extract_subject_features(subject_dir):
+    """
+    Build one feature row for a subject from its aseg and aparc stats files
+
+    :param subject_dir: FreeSurfer subject directory
+    :return: Dictionary of features; keys follow the asegstats2table / aparcstats2table naming
+    """
+    subject_id = os.path.basename(os.path.normpath(subject_dir))
+    features = {'subject_id': subject_id}
+
+    aseg_path = os.path.join(subject_dir, 'stats', 'aseg.stats')
+    if os.path.exists(aseg_path):
+        measures, rows = read_stats_file(aseg_path)
+        for row in rows:
+            features[row['StructName']] = float(row['Volume_mm3'])
+        for name, value in measures.items():
+            features[name] = value
+
+    for hemi in ('lh', 'rh'):
+        aparc_path = os.path.join(subject_dir, 'stats', f'{hemi}.aparc.stats')
+        if not os.path.exists(aparc_path):
+            continue
+        measures, rows = read_stats_file(aparc_path)
+        for row in rows:
+            for column, measure in APARC_MEASURES.items():
+                if column in row:
+                    features[f"{hemi}_{row['StructName']}_{measure}"] = float(row[column])
+        for name, value in measures.items():
+            features[f"{hemi}_{name}"] = value
+
+    return features
+
+
+def write_feature_table(rows, output_path):
+    """
+    Write feature rows to a CSV file. Columns missing for a subject are left empty.
+
+    :param rows: List of dictionaries returned by extract_subject_features
+    :param output_path: Output CSV path
+    """
+    columns = ['subject_id']
+    seen = set(columns)
+    for row in rows:
+        for column in row:
+            if column not in seen:
+                seen.add(column)
+                columns.append(column)
+
+    output_dir = os.path.dirname(output_path)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    with open(output_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Extract aseg/aparc features from processed subjects')
+    parser.add_argument('--subjects-dir', required=True, help='FreeSurfer SUBJECTS_DIR')
+    parser.add_argument('--output', default='./data/freesurfer_features.csv',
+                        help='Output CSV (default: data/freesurfer_features.csv)')
+
+    args = parser.parse_args()
+
+    subjects = sorted(
+        s for s in os.listdir(args.subjects_dir)
+        if os.path.isfile(os.path.join(args.subjects_dir, s, 'scripts', 'recon-all.done'))
+    )
+    feature_rows = []
+    for s in subjects:
+        with tracing.span('extract', s):
+            feature_rows.append(extract_subject_features(os.path.join(args.subjects_dir, s)))
+    write_feature_table(feature_rows, args.output)
+    print(f"Features for {len(feature_rows)} subjects saved to {args.output}")
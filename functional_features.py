@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+import argparse
+import logging
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from freesurfer_stats import write_feature_table
+from volume_cache import DEFAULT_BUDGET_GB, configure as configure_volume_cache, default_cache, load_mgh
+from volume_io import aparc_aseg_rois, decompress_to_file, memmap_nifti, resample_labels
+
+# Memory allowed per worker for one chunk of BOLD frames
+DEFAULT_CHUNK_MB = 256
+
+
+def find_bold_runs(func_dir, subject_id):
+    """
+    List the BOLD runs of a subject organized by data_organizer.py
+
+    :param func_dir: <dest_root>/func
+    :param subject_id: Zero-padded subject ID, e.g. sub-0010001
+    :return: Sorted list of *_bold.nii(.gz) paths
+    """
+    subject_dir = os.path.join(func_dir, subject_id)
+    if not os.path.isdir(subject_dir):
+        return []
+    return sorted(
+        os.path.join(subject_dir, f) for f in os.listdir(subject_dir)
+        if f.endswith('_bold.nii.gz') or f.endswith('_bold.nii')
+    )
+
+
+def load_registration(func_dir, subject_id):
+    """
+    Load an optional 4x4 RAS-to-RAS matrix from BOLD to anatomical space, stored as
+    <func_dir>/<subject>/<subject>_bold2anat.txt. Without it both images are assumed to share
+    scanner coordinates.
+    """
+    path = os.path.join(func_dir, subject_id, f"{subject_id}_bold2anat.txt")
+    if os.path.isfile(path):
+        return np.loadtxt(path).reshape(4, 4)
+    return None
+
+
+def roi_timeseries(bold, roi_index, n_rois, chunk_frames, scl_slope=1.0, scl_inter=0.0):
+    """
+    Average the BOLD signal within each ROI, reading chunk_frames volumes at a time
+
+    Voxels are grouped once by sorting on their ROI index; every chunk is then reduced with a
+    single np.add.reduceat instead of a loop over ROIs.
+
+    :param bold: 4D array indexed [x, y, z, t] in Fortran order (e.g. a memmap)
+    :param roi_index: Flat (Fortran order) array with the ROI index of every voxel, -1 outside ROIs
+    :param n_rois: Number of ROIs
+    :param chunk_frames: Number of volumes read per chunk
+    :param scl_slope: NIfTI intensity scaling slope
+    :param scl_inter: NIfTI intensity scaling intercept
+    :return: Array (n_frames, n_rois) of ROI means; NaN for ROIs without voxels
+    """
+    n_voxels = int(np.prod(bold.shape[:3]))
+    n_frames = bold.shape[3]
+
+    in_roi = np.flatnonzero(roi_index >= 0)
+    order = in_roi[np.argsort(roi_index[in_roi], kind='stable')]
+    sorted_rois = roi_index[order]
+    present, starts, counts = np.unique(sorted_rois, return_index=True, return_counts=True)
+
+    timeseries = np.full((n_frames, n_rois), np.nan, dtype=np.float64)
+    if len(present) == 0:
+        return timeseries
+
+    for start in range(0, n_frames, chunk_frames):
+        stop = min(start + chunk_frames, n_frames)
+        # Frames are the slowest axis, so this slice is one contiguous block of the file
+        chunk = np.asarray(bold[..., start:stop]).reshape(n_voxels, stop - start, order='F')
+        sums = np.add.reduceat(chunk[order].astype(np.float64), starts, axis=0)
+        timeseries[start:stop, present] = (sums / counts[:, None]).T
+
+    return timeseries * scl_slope + scl_inter
+
+
+def connectivity_matrix(timeseries):
+    """
+    Fisher z-transformed Pearson correlation between ROI timeseries
+
+    :param timeseries: Array (n_frames, n_rois)
+    :return: Array (n_rois, n_rois); NaN for ROIs without signal, 0 on the diagonal
+    """
+    centered = timeseries - timeseries.mean(axis=0)
+    norms = np.sqrt((centered ** 2).sum(axis=0))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        correlation = (centered.T @ centered) / np.outer(norms, norms)
+    correlation = np.clip(correlation, -0.999999, 0.999999)
+    z = np.arctanh(correlation)
+    np.fill_diagonal(z, 0.0)
+    return z
+
+
+def extract_run(bold_path, labels, label_affine, registration, roi_lookup, n_rois, chunk_bytes, scratch_dir):
+    """Compute the ROI timeseries of one BOLD run."""
+    cache = default_cache()
+    scratch_path = None
+    image_path = bold_path
+    if cache is not None:
+        image_path = cache.path(bold_path)
+    elif bold_path.endswith('.gz'):
+        image_path = scratch_path = decompress_to_file(bold_path, scratch_dir)
+    try:
+        bold, _, geometry = memmap_nifti(image_path)
+        if bold.ndim != 4:
+            raise ValueError(f"{bold_path} is not a 4D image")
+
+        bold_labels = resample_labels(labels, label_affine, bold.shape[:3], geometry['affine'], registration)
+        roi_index = roi_lookup[bold_labels.ravel(order='F')]
+
+        frame_bytes = int(np.prod(bold.shape[:3])) * 8
+        chunk_frames = max(1, chunk_bytes // frame_bytes)
+        timeseries = roi_timeseries(bold, roi_index, n_rois, chunk_frames,
+                                    geometry['scl_slope'], geometry['scl_inter'])
+        del bold
+        return timeseries
+    finally:
+        if scratch_path:
+            os.remove(scratch_path)
+
+
+def extract_subject_functional(subject_id, func_dir, subjects_dir, store_dir,
+                               chunk_bytes=DEFAULT_CHUNK_MB * 1024 ** 2, scratch_dir=None):
+    """
+    Compute ROI timeseries and a connectivity matrix for every BOLD run of a subject
+
+    The per-run connectivity matrices are averaged in Fisher z. Timeseries, matrix and ROI
+    names are saved to <store_dir>/functional/<subject>.npz.
+
+    :param subject_id: Zero-padded subject ID
+    :param func_dir: <dest_root>/func of data_organizer.py
+    :param subjects_dir: FreeSurfer SUBJECTS_DIR containing <subject>/mri/aparc+aseg.mgz
+    :param store_dir: Feature store directory
+    :param chunk_bytes: Memory allowed for one chunk of frames
+    :param scratch_dir: Where gzipped runs are decompressed when no volume cache is configured
+                        (default: system temp dir)
+    :return: Feature row for the connectivity table
+    """
+    runs = find_bold_runs(func_dir, subject_id)
+    if not runs:
+        raise FileNotFoundError(f"No BOLD runs for {subject_id} in {func_dir}")
+
+    labels, label_affine = load_mgh(os.path.join(subjects_dir, subject_id, 'mri', 'aparc+aseg.mgz'))
+    registration = load_registration(func_dir, subject_id)
+
+    rois = aparc_aseg_rois()
+    roi_labels = np.array(sorted(rois), dtype=np.int64)
+    roi_names = [rois[label] for label in roi_labels]
+    # Map every label value to its ROI index, -1 for labels that are not ROIs
+    roi_lookup = np.full(max(int(labels.max()), int(roi_labels.max())) + 1, -1, dtype=np.int64)
+    roi_lookup[roi_labels] = np.arange(len(roi_labels))
+
+    run_timeseries = [
+        extract_run(run, labels, label_affine, registration, roi_lookup, len(roi_labels), chunk_bytes, scratch_dir)
+        for run in runs
+    ]
+    with warnings.catch_warnings():
+        # ROIs without voxels in any run stay NaN
+        warnings.simplefilter('ignore', RuntimeWarning)
+        connectivity = np.nanmean([connectivity_matrix(ts) for ts in run_timeseries], axis=0)
+
+    os.makedirs(os.path.join(store_dir, 'functional'), exist_ok=True)
+    np.savez_compressed(
+        os.path.join(store_dir, 'functional', f"{subject_id}.npz"),
+        timeseries=np.concatenate(run_timeseries).astype(np.float32),
+        run_lengths=np.array([len(ts) for ts in run_timeseries]),
+        connectivity=connectivity.astype(np.float32),
+        roi_labels=roi_labels,
+        roi_names=np.array(roi_names),
+    )
+
+    row = {'subject_id': subject_id, 'n_runs': len(runs), 'n_frames': sum(len(ts) for ts in run_timeseries)}
+    upper_i, upper_j = np.triu_indices(len(roi_names), k=1)
+    for i, j in zip(upper_i, upper_j):
+        value = connectivity[i, j]
+        row[f"fc_{roi_names[i]}__{roi_names[j]}"] = '' if np.isnan(value) else round(float(value), 6)
+    return row
+
+
+def extract_functional_features(subject_ids, func_dir, subjects_dir, store_dir, workers=4,
+                                chunk_bytes=DEFAULT_CHUNK_MB * 1024 ** 2, scratch_dir=None):
+    """
+    Run extract_subject_functional for many subjects in a process pool
+
+    Peak memory is roughly workers x (chunk_bytes + one label volume).
+
+    :return: Tuple of (feature rows, failed subject IDs)
+    """
+    rows = []
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(extract_subject_functional, subject_id, func_dir, subjects_dir, store_dir,
+                            chunk_bytes, scratch_dir): subject_id
+            for subject_id in subject_ids
+        }
+        for future in as_completed(futures):
+            subject_id = futures[future]
+            try:
+                rows.append(future.result())
+                logging.info(f"Functional features done for {subject_id}")
+            except Exception as e:
+                logging.error(f"Functional features failed for {subject_id}: {e}")
+                failed.append(subject_id)
+
+    rows.sort(key=lambda row: row['subject_id'])
+    return rows, sorted(failed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Extract ROI timeseries and connectivity from BOLD runs')
+    parser.add_argument('--func-dir', required=True, help='func/ folder created by data_organizer.py')
+    parser.add_argument('--subjects-dir', required=True, help='FreeSurfer SUBJECTS_DIR with aparc+aseg.mgz')
+    parser.add_argument('--store', default='./data',
+                        help='Feature store directory, next to freesurfer_features.csv (default: data)')
+    parser.add_argument('--subjects', default=None,
+                        help='File with one subject ID per line (default: every subject in --func-dir)')
+    parser.add_argument('--workers', type=int, default=4, help='Subjects processed in parallel (default: 4)')
+    parser.add_argument('--chunk-mb', type=int, default=DEFAULT_CHUNK_MB,
+                        help=f'Memory per worker for one chunk of frames (default: {DEFAULT_CHUNK_MB})')
+    parser.add_argument('--scratch-dir', default=None, help='Where gzipped runs are decompressed')
+    parser.add_argument('--cache-dir', default=None,
+                        help='Shared cache of decompressed volumes, reused across runs (see volume_cache.py)')
+    parser.add_argument('--cache-gb', type=float, default=DEFAULT_BUDGET_GB,
+                        help=f'Disk budget of the volume cache (default: {DEFAULT_BUDGET_GB})')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if args.cache_dir:
+        configure_volume_cache(args.cache_dir, args.cache_gb)
+
+    if args.subjects:
+        with open(args.subjects, 'r') as f:
+            subjects = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    else:
+        subjects = sorted(s for s in os.listdir(args.func_dir) if s.startswith('sub-'))
+
+    feature_rows, failed_subjects = extract_functional_features(
+        subjects, args.func_dir, args.subjects_dir, args.store, args.workers,
+        args.chunk_mb * 1024 ** 2, args.scratch_dir)
+    output_path = os.path.join(args.store, 'functional_connectivity.csv')
+    write_feature_table(feature_rows, output_path)
+    print(f"Functional features for {len(feature_rows)} subjects saved to {output_path}")
+    if failed_subjects:
+        print(f"Failed subjects: {', '.join(failed_subjects)}")
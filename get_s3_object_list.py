@@ -1,7 +1,10 @@
+import argparse
 import boto3
 import logging
 import json
 
+import tracing
+
 
 def get_s3_object_references(bucket_name):
     """
@@ -19,7 +22,10 @@ def get_s3_object_references(bucket_name):
         object_info = []
 
         # Collect information for each object
-        for obj in bucket.objects.all():
+        with tracing.span('list-objects', bucket=bucket_name) as span:
+            objects = list(bucket.objects.all())
+            span.set(objects=len(objects))
+        for obj in objects:
             region = s3_resource.meta.client.meta.region_name
 
             # Create both URL and S3 URI formats
@@ -41,8 +47,13 @@ def get_s3_object_references(bucket_name):
 
 
 if __name__ == "__main__":
-    # Set your bucket name here
-    bucket_name = "biomedin260"
+    parser = argparse.ArgumentParser(description='List all objects in an S3 bucket')
+    parser.add_argument('--bucket', default='biomedin260', help='Bucket name (default: biomedin260)')
+    parser.add_argument('--output', default='data/s3_objects.json',
+                        help='Output JSON file (default: data/s3_objects.json)')
+
+    args = parser.parse_args()
+    bucket_name = args.bucket
 
     # Set up logging
     logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -63,9 +74,9 @@ if __name__ == "__main__":
             print(f"AWS CLI Download: {obj['aws_cli_download']}")
 
         # Save to JSON for programmatic use
-        with open('data/s3_objects.json', 'w') as f:
+        with open(args.output, 'w') as f:
             json.dump(objects, f, indent=2)
-        print("\nObject information saved to 's3_objects.json'")
+        print(f"\nObject information saved to '{args.output}'")
 
     else:
         print("Failed to access bucket objects. Check your AWS credentials and permissions.")
\ No newline at end of file
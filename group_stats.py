@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+# Mass-univariate ADHD vs Typical Development comparison of every feature column. The same GLM
+# (intercept, diagnosis, covariates and site indicators) is fitted to all features at once: the
+# design is factored once with a QR decomposition and every feature is a column of one
+# least-squares solve. Permutation tests use Freedman-Lane: the residuals of the model without
+# diagnosis are permuted. Only the projections of the permuted residuals onto the design are
+# needed per permutation, so a chunk of permutations is a few matrix products over the residuals,
+# which the worker processes memory-map from one file.
+import argparse
+import logging
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+# Columns of classify.load_cohort adjusted for; site is added as indicator columns
+DEFAULT_COVARIATES = ('age', 'gender')
+DEFAULT_PERMUTATION_CHUNK = 100
+# Largest number of floats of the projections computed in one matrix product
+_BATCH_ELEMENTS = 2 ** 24
+
+
+def design_matrix(cohort, covariates=DEFAULT_COVARIATES, site_column='site'):
+    """
+    GLM design of a cohort: intercept, diagnosis (label, 1 = ADHD), covariates and site indicators
+
+    The first site is the reference level. Set site_column to None to leave site out. Covariates
+    that are constant or confounded with site (e.g. gender in an all-male cohort) are left out with
+    a warning.
+
+    :param cohort: DataFrame from classify.load_cohort
+    :return: Tuple of (design matrix, column names); the diagnosis is column 1
+    """
+    sites, site_names = [], []
+    if site_column:
+        for site in sorted(cohort[site_column].astype(str).unique())[1:]:
+            sites.append((cohort[site_column].astype(str) == site).to_numpy(dtype=float))
+            site_names.append(f"site[{site}]")
+
+    columns = [np.ones(len(cohort)), cohort['label'].to_numpy(dtype=float)]
+    names = ['intercept', 'label']
+    for covariate in covariates:
+        values = cohort[covariate].to_numpy(dtype=float)
+        candidate = np.column_stack(columns + [values] + sites)
+        if np.linalg.matrix_rank(candidate) < candidate.shape[1]:
+            logging.warning(f"Covariate {covariate} is constant or confounded with site; left out of the design")
+            continue
+        columns.append(values)
+        names.append(covariate)
+    return np.column_stack(columns + sites), names + site_names
+
+
+def _factor(X):
+    """Thin QR factors of a design, and the inverse of R."""
+    Q, R = np.linalg.qr(X)
+    if np.linalg.matrix_rank(X) < X.shape[1]:
+        raise ValueError("The design is rank deficient; diagnosis is constant or confounded with site")
+    return Q, np.linalg.inv(R)
+
+
+def fit_glm(Y, X, column=1):
+    """
+    Fit the GLM of design X to every column of Y and test one coefficient
+
+    :param Y: Matrix (n_subjects x n_features) without missing values
+    :param X: Design matrix (n_subjects x n_regressors)
+    :param column: Regressor to test
+    :return: Dictionary of arrays over features: beta, se, t and two-sided p, plus dof
+    """
+    Y = np.asarray(Y, dtype=np.float64)
+    Q, R_inv = _factor(X)
+    projections = Q.T @ Y
+    residuals = Y - Q @ projections
+    dof = X.shape[0] - X.shape[1]
+    sigma2 = (residuals ** 2).sum(axis=0) / dof
+    # Diagonal element of (X'X)^-1 = R^-1 R^-T for the tested coefficient
+    variance_factor = R_inv[column] @ R_inv[column]
+
+    beta = R_inv[column] @ projections
+    se = np.sqrt(sigma2 * variance_factor)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.where(se > 0, beta / se, 0.0)
+    return {'beta': beta, 'se': se, 't': t, 'p': 2 * stats.t.sf(np.abs(t), dof), 'dof': dof}
+
+
+def fdr_bh(p):
+    """Benjamini-Hochberg adjusted p-values (q-values) of an array of p-values."""
+    p = np.asarray(p, dtype=np.float64)
+    order = np.argsort(p)
+    ranked = p[order] * len(p) / np.arange(1, len(p) + 1)
+    # Enforce monotonicity from the largest p-value down
+    ranked = np.minimum.accumulate(ranked[::-1])[::-1]
+    q = np.empty_like(ranked)
+    q[order] = np.minimum(ranked, 1.0)
+    return q
+
+
+def _permute(rng, n_rows, blocks):
+    """Random order of n_rows rows, exchanging rows only within the same block when blocks is given."""
+    if blocks is None:
+        return rng.permutation(n_rows)
+    order = np.arange(n_rows)
+    for rows in blocks:
+        order[rows] = rng.permutation(rows)
+    return order
+
+
+def _permutation_chunk(residuals_path, Q, contrast, variance_factor, dof, observed, blocks, seed, n_permutations):
+    """
+    Run n_permutations Freedman-Lane permutations on memory-mapped reduced-model residuals
+
+    :return: Tuple of (per-feature counts of |t| at least the observed |t|, max |t| of every permutation)
+    """
+    residuals = np.load(residuals_path, mmap_mode='r')
+    n_subjects, n_features = residuals.shape
+    total = np.einsum('ij,ij->j', residuals, residuals)
+    rng = np.random.default_rng(seed)
+    batch = max(1, _BATCH_ELEMENTS // (Q.shape[1] * n_features))
+
+    counts = np.zeros(n_features, dtype=np.int64)
+    maxima = []
+    for start in range(0, n_permutations, batch):
+        orders = [_permute(rng, n_subjects, blocks) for _ in range(min(batch, n_permutations - start))]
+        # Q' P e for every permutation P at once: rows of Q reordered instead of the residuals
+        stacked = np.concatenate([Q[order].T for order in orders])
+        projections = (stacked @ residuals).reshape(len(orders), Q.shape[1], n_features)
+        beta = np.einsum('p,bpm->bm', contrast, projections)
+        rss = np.maximum(total - (projections ** 2).sum(axis=1), 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = np.abs(np.where(rss > 0, beta / np.sqrt(rss / dof * variance_factor), 0.0))
+        counts += (t >= observed).sum(axis=0)
+        maxima.extend(t.max(axis=1))
+    return counts, np.array(maxima)
+
+
+def permutation_test(Y, X, column=1, n_permutations=1000, blocks=None, workers=4,
+                     chunk_size=DEFAULT_PERMUTATION_CHUNK, seed=42):
+    """
+    Freedman-Lane permutation test of one coefficient for every column of Y
+
+    Chunks of chunk_size permutations run in worker processes, each with its own seed derived
+    from seed, so the result does not depend on the number of workers.
+
+    :param blocks: Optional list of row index arrays; rows are only exchanged within their block (e.g. site)
+    :return: Tuple of (uncorrected permutation p-values, family-wise p-values from the max |t| distribution)
+    """
+    Y = np.asarray(Y, dtype=np.float64)
+    # t is scale invariant; unit variance keeps the residual sums of squares well conditioned
+    scale = Y.std(axis=0)
+    Y = Y / np.where(scale > 0, scale, 1.0)
+    observed = np.abs(fit_glm(Y, X, column)['t'])
+
+    Q, R_inv = _factor(X)
+    reduced = np.delete(X, column, axis=1)
+    Q_reduced, _ = np.linalg.qr(reduced)
+    residuals = Y - Q_reduced @ (Q_reduced.T @ Y)
+    dof = X.shape[0] - X.shape[1]
+    variance_factor = R_inv[column] @ R_inv[column]
+
+    work_dir = tempfile.mkdtemp(prefix='group_stats-')
+    try:
+        residuals_path = os.path.join(work_dir, 'residuals.npy')
+        np.save(residuals_path, residuals)
+        del residuals
+
+        sizes = [min(chunk_size, n_permutations - start) for start in range(0, n_permutations, chunk_size)]
+        seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+        arguments = [(residuals_path, Q, R_inv[column], variance_factor, dof, observed, blocks, chunk_seed, size)
+                     for chunk_seed, size in zip(seeds, sizes)]
+        if workers > 1 and len(sizes) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(_permutation_chunk, *zip(*arguments)))
+        else:
+            results = [_permutation_chunk(*chunk_arguments) for chunk_arguments in arguments]
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    counts = sum(chunk_counts for chunk_counts, _ in results)
+    maxima = np.sort(np.concatenate([chunk_maxima for _, chunk_maxima in results]))
+    p_permutation = (counts + 1) / (n_permutations + 1)
+    exceeding = len(maxima) - np.searchsorted(maxima, observed, side='left')
+    p_fwe = (exceeding + 1) / (n_permutations + 1)
+    return p_permutation, p_fwe
+
+
+def group_comparison(cohort, feature_columns, covariates=DEFAULT_COVARIATES, site_column='site',
+                     n_permutations=0, within_site=False, workers=4, chunk_size=DEFAULT_PERMUTATION_CHUNK, seed=42):
+    """
+    ADHD vs Typical Development difference of every feature, adjusted for covariates and site
+
+    Participants with a missing feature or covariate are left out, so all features share one design.
+
+    :param cohort: DataFrame from classify.load_cohort
+    :param feature_columns: Features to test
+    :param n_permutations: Number of Freedman-Lane permutations (0 for parametric tests only)
+    :param within_site: Only exchange participants of the same site in the permutations
+    :return: DataFrame with one row per feature: beta (adjusted ADHD - TD difference), se, t, p,
+             q (Benjamini-Hochberg), cohens_d, partial_r2 and, with permutations, p_perm, q_perm and p_fwe;
+             sorted by p
+    """
+    used = list(feature_columns) + list(covariates)
+    complete = cohort[used].notna().all(axis=1)
+    if not complete.all():
+        logging.warning(f"{(~complete).sum()} participants with missing values are left out")
+    cohort = cohort[complete].reset_index(drop=True)
+
+    X, _ = design_matrix(cohort, covariates, site_column)
+    Y = cohort[list(feature_columns)].to_numpy(dtype=np.float64)
+    fit = fit_glm(Y, X)
+
+    n_adhd = int(cohort['label'].sum())
+    n_td = len(cohort) - n_adhd
+    results = pd.DataFrame({
+        'feature': list(feature_columns),
+        'beta': fit['beta'],
+        'se': fit['se'],
+        't': fit['t'],
+        'p': fit['p'],
+        'q': fdr_bh(fit['p']),
+        'cohens_d': fit['t'] * np.sqrt(1 / n_adhd + 1 / n_td),
+        'partial_r2': fit['t'] ** 2 / (fit['t'] ** 2 + fit['dof']),
+    })
+    if n_permutations:
+        blocks = None
+        if within_site:
+            blocks = [np.flatnonzero(cohort[site_column].to_numpy() == site) for site in cohort[site_column].unique()]
+        results['p_perm'], results['p_fwe'] = permutation_test(Y, X, 1, n_permutations, blocks, workers,
+                                                               chunk_size, seed)
+        results['q_perm'] = fdr_bh(results['p_perm'])
+    results.attrs.update(n_adhd=n_adhd, n_td=n_td, dof=fit['dof'])
+    return results.sort_values('p', kind='stable').reset_index(drop=True)
+
+
+if __name__ == "__main__":
+    from classify import load_cohort
+
+    parser = argparse.ArgumentParser(description='ADHD vs TD comparison of every feature with one GLM')
+    parser.add_argument('--data-dir', default='./data',
+                        help='Folder with train/validation/test_data.csv (default: data)')
+    parser.add_argument('--features', nargs='+', default=['./data/freesurfer_features.csv'],
+                        help='Feature CSVs keyed by subject_id (default: data/freesurfer_features.csv)')
+    parser.add_argument('--covariates', nargs='*', default=list(DEFAULT_COVARIATES),
+                        help='Covariates among age and gender (default: both)')
+    parser.add_argument('--no-site', action='store_true', help='Do not adjust for site, e.g. for harmonized features')
+    parser.add_argument('--permutations', type=int, default=0,
+                        help='Number of Freedman-Lane permutations (default: 0, parametric only)')
+    parser.add_argument('--within-site', action='store_true', help='Only permute participants within a site')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 4,
+                        help='Processes for the permutations (default: all CPUs)')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_PERMUTATION_CHUNK,
+                        help=f'Permutations per task (default: {DEFAULT_PERMUTATION_CHUNK})')
+    parser.add_argument('--alpha', type=float, default=0.05, help='FDR level of the summary (default: 0.05)')
+    parser.add_argument('--output', default='./data/group_stats.csv',
+                        help='Per-feature statistics (default: data/group_stats.csv)')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    cohort_df, columns = load_cohort(args.data_dir, args.features)
+    table = group_comparison(cohort_df, columns, args.covariates, None if args.no_site else 'site',
+                             args.permutations, args.within_site, args.workers, args.chunk_size)
+    table.to_csv(args.output, index=False)
+
+    print(f"{len(columns)} features, {table.attrs['n_adhd']} ADHD vs {table.attrs['n_td']} TD, "
+          f"{table.attrs['dof']} degrees of freedom")
+    print(f"{(table['q'] < args.alpha).sum()} features with FDR q < {args.alpha}")
+    if args.permutations:
+        print(f"{(table['p_fwe'] < args.alpha).sum()} features with family-wise permutation p < {args.alpha}")
+    print(table.head(10).to_string(index=False, float_format=lambda value: f"{value:.4g}"))
+    print(f"Statistics saved to {args.output}")
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import logging
+
+import numpy as np
+
+# Covariate columns of classify.load_cohort whose effects ComBat preserves ('label' is the diagnosis)
+DEFAULT_COVARIATES = ('age', 'gender', 'label')
+
+# Convergence threshold and iteration cap of the empirical Bayes updates
+EB_TOLERANCE = 1e-4
+EB_MAX_ITERATIONS = 1000
+
+
+def _site_design(sites, site_levels):
+    """One-hot matrix (n_rows x n_sites) of sites; rows of unknown sites are all zero."""
+    lookup = {site: k for k, site in enumerate(site_levels)}
+    design = np.zeros((len(sites), len(site_levels)))
+    for row, site in enumerate(sites):
+        if site in lookup:
+            design[row, lookup[site]] = 1.0
+    return design
+
+
+def _prior_inverse_gamma(delta_hat):
+    """Method-of-moments a and b of the inverse gamma prior of the site variances, per site."""
+    mean = delta_hat.mean(axis=1)
+    variance = delta_hat.var(axis=1, ddof=1)
+    return (2 * variance + mean ** 2) / variance, (mean * variance + mean ** 3) / variance
+
+
+def _empirical_bayes(sums, squares, counts, gamma_hat, delta_hat):
+    """
+    Parametric empirical Bayes shrinkage of the site location and scale parameters
+
+    All sites and features are updated together as (n_sites x n_features) arrays. The
+    residual sum of squares of every iteration comes from the per-site sums and sums of
+    squares of the standardized data, so the data are never revisited.
+
+    :return: Tuple of (gamma_star, delta_star)
+    """
+    gamma_bar = gamma_hat.mean(axis=1, keepdims=True)
+    tau2 = gamma_hat.var(axis=1, ddof=1, keepdims=True)
+    a_prior, b_prior = (p[:, None] for p in _prior_inverse_gamma(delta_hat))
+    n = counts[:, None]
+
+    gamma_old, delta_old = gamma_hat, delta_hat
+    for _ in range(EB_MAX_ITERATIONS):
+        gamma_new = (tau2 * n * gamma_hat + delta_old * gamma_bar) / (tau2 * n + delta_old)
+        residual = squares - 2 * gamma_new * sums + n * gamma_new ** 2
+        delta_new = (0.5 * residual + b_prior) / (n / 2 + a_prior - 1)
+        # Relative change, floored so site means near zero do not stall convergence
+        change = max((np.abs(gamma_new - gamma_old) / np.maximum(np.abs(gamma_old), EB_TOLERANCE)).max(),
+                     (np.abs(delta_new - delta_old) / delta_old).max())
+        gamma_old, delta_old = gamma_new, delta_new
+        if change < EB_TOLERANCE:
+            break
+    else:
+        logging.warning(f"Empirical Bayes did not converge in {EB_MAX_ITERATIONS} iterations")
+    return gamma_old, delta_old
+
+
+def fit_combat(X, sites, covariates=None, empirical_bayes=True):
+    """
+    Estimate ComBat site harmonization parameters (Johnson et al. 2007, Fortin et al. 2018)
+
+    Features are regressed on site and covariates in one least-squares solve, standardized,
+    and the per-site location (gamma) and scale (delta) are shrunk towards priors pooled
+    across features.
+
+    :param X: Matrix (n_subjects x n_features) without missing values
+    :param sites: Site of every row (e.g. source_folder)
+    :param covariates: Optional matrix (n_subjects x n_covariates) of effects to preserve; columns
+                       that are constant or confounded with site are left out with a warning
+    :param empirical_bayes: Shrink the site parameters; without it the raw per-site estimates are used
+    :return: Model dictionary for apply_combat
+    """
+    X = np.asarray(X, dtype=np.float64)
+    if np.isnan(X).any():
+        raise ValueError("ComBat input has missing values; impute them first")
+    n_subjects = X.shape[0]
+    covariates = np.zeros((n_subjects, 0)) if covariates is None else np.asarray(covariates, dtype=np.float64)
+    covariates = covariates.reshape(n_subjects, -1)
+
+    site_levels, counts = np.unique(np.asarray(sites).astype(str), return_counts=True)
+    if (counts < 2).any():
+        raise ValueError(f"Sites need at least 2 subjects: {', '.join(site_levels[counts < 2])}")
+    site_design = _site_design(np.asarray(sites).astype(str), site_levels)
+    # Covariates that are constant or confounded with site (e.g. gender in an all-male cohort)
+    # cannot be estimated; they are left out and get a zero coefficient
+    kept = []
+    for column in range(covariates.shape[1]):
+        design = np.hstack([site_design, covariates[:, kept + [column]]])
+        if np.linalg.matrix_rank(design) == design.shape[1]:
+            kept.append(column)
+        else:
+            logging.warning(f"Covariate column {column} is constant or confounded with site; its effect is not preserved")
+    design = np.hstack([site_design, covariates[:, kept]])
+
+    beta = np.linalg.lstsq(design, X, rcond=None)[0]
+    n_sites = len(site_levels)
+    covariate_beta = np.zeros((covariates.shape[1], X.shape[1]))
+    covariate_beta[kept] = beta[n_sites:]
+    grand_mean = (counts / n_subjects) @ beta[:n_sites]
+    pooled_variance = ((X - design @ beta) ** 2).mean(axis=0)
+    # Constant features are left as they are
+    pooled_variance[pooled_variance == 0] = 1.0
+
+    standardized = (X - grand_mean - covariates @ covariate_beta) / np.sqrt(pooled_variance)
+    sums = site_design.T @ standardized
+    squares = site_design.T @ (standardized ** 2)
+    gamma_hat = sums / counts[:, None]
+    delta_hat = (squares - counts[:, None] * gamma_hat ** 2) / (counts[:, None] - 1)
+    delta_hat[delta_hat == 0] = 1.0
+
+    if empirical_bayes:
+        gamma_star, delta_star = _empirical_bayes(sums, squares, counts, gamma_hat, delta_hat)
+    else:
+        gamma_star, delta_star = gamma_hat, delta_hat
+
+    return {
+        'site_levels': site_levels,
+        'grand_mean': grand_mean,
+        'covariate_beta': covariate_beta,
+        'pooled_variance': pooled_variance,
+        'gamma_star': gamma_star,
+        'delta_star': delta_star,
+    }
+
+
+def apply_combat(model, X, sites, covariates=None):
+    """
+    Harmonize rows with parameters from fit_combat; rows of sites not seen in the fit are only
+    standardized and restored, so they keep their site effect
+
+    :param model: Dictionary from fit_combat or load_combat
+    :param X: Matrix (n_subjects x n_features)
+    :param sites: Site of every row
+    :param covariates: Matrix with the same covariate columns used for the fit
+    :return: Harmonized matrix
+    """
+    X = np.asarray(X, dtype=np.float64)
+    sites = np.asarray(sites).astype(str)
+    covariate_beta = model['covariate_beta']
+    if covariates is None:
+        covariates = np.zeros((X.shape[0], covariate_beta.shape[0]))
+    covariates = np.asarray(covariates, dtype=np.float64).reshape(X.shape[0], -1)
+
+    unseen = sorted(set(sites) - set(model['site_levels']))
+    if unseen:
+        logging.warning(f"Sites not in the ComBat fit are not harmonized: {', '.join(unseen)}")
+    site_design = _site_design(sites, model['site_levels'])
+    known = site_design.sum(axis=1)[:, None]
+
+    stand_mean = model['grand_mean'] + covariates @ covariate_beta
+    scale = np.sqrt(model['pooled_variance'])
+    standardized = (X - stand_mean) / scale
+    # Unknown sites get gamma 0 and delta 1
+    gamma = site_design @ model['gamma_star']
+    delta = site_design @ model['delta_star'] + (1.0 - known)
+    return (standardized - gamma) / np.sqrt(delta) * scale + stand_mean
+
+
+def save_combat(model, path):
+    """Save a fit_combat model to a .npz file."""
+    np.savez(path, **{name: np.asarray(value) for name, value in model.items()})
+
+
+def load_combat(path):
+    """Load a model written by save_combat."""
+    with np.load(path) as data:
+        return {name: data[name] for name in data.files}
+
+
+def harmonize_cohort(cohort, feature_columns, covariate_columns=DEFAULT_COVARIATES, fit_splits=('train',),
+                     empirical_bayes=True):
+    """
+    Fit ComBat on the rows of fit_splits and apply it to the whole cohort
+
+    Missing feature values are imputed with the medians of the fit rows and missing
+    covariates with their medians, as in classify.preprocess_fold.
+
+    :param cohort: DataFrame from classify.load_cohort
+    :param feature_columns: Feature columns to harmonize
+    :param covariate_columns: Numeric columns whose effects are preserved
+    :param fit_splits: Splits the parameters are estimated on
+    :param empirical_bayes: Shrink the site parameters
+    :return: Tuple of (harmonized copy of cohort, model)
+    """
+    fit = cohort['split'].isin(fit_splits).to_numpy()
+    if not fit.any():
+        raise ValueError(f"No rows in splits {', '.join(fit_splits)}")
+
+    X = cohort[feature_columns].to_numpy(dtype=np.float64)
+    medians = np.nanmedian(X[fit], axis=0)
+    medians = np.where(np.isnan(medians), 0.0, medians)
+    X = np.where(np.isnan(X), medians, X)
+
+    covariates = cohort[list(covariate_columns)].astype(float)
+    covariates = covariates.fillna(covariates[fit].median()).to_numpy()
+
+    sites = cohort['site'].to_numpy()
+    model = fit_combat(X[fit], sites[fit], covariates[fit], empirical_bayes)
+    harmonized = cohort.copy()
+    harmonized[feature_columns] = apply_combat(model, X, sites, covariates)
+    return harmonized, model
+
+
+if __name__ == "__main__":
+    from classify import load_cohort
+
+    parser = argparse.ArgumentParser(description='ComBat site harmonization of extracted features')
+    parser.add_argument('--data-dir', default='./data',
+                        help='Folder with train/validation/test_data.csv (default: data)')
+    parser.add_argument('--features', nargs='+', default=['./data/freesurfer_features.csv'],
+                        help='Feature CSVs keyed by subject_id (default: data/freesurfer_features.csv)')
+    parser.add_argument('--covariates', nargs='*', default=list(DEFAULT_COVARIATES),
+                        help='Effects to preserve among age, gender and label (default: all three)')
+    parser.add_argument('--fit-splits', nargs='+', choices=['train', 'validation', 'test'], default=['train'],
+                        help='Splits the parameters are estimated on (default: train)')
+    parser.add_argument('--no-eb', action='store_true', help='Use the raw per-site estimates without shrinkage')
+    parser.add_argument('--model', default=None, help='Also save the fitted parameters to this .npz file')
+    parser.add_argument('--output', default='./data/harmonized_features.csv',
+                        help='Harmonized feature table (default: data/harmonized_features.csv)')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    cohort_df, columns = load_cohort(args.data_dir, args.features)
+    harmonized_df, combat_model = harmonize_cohort(cohort_df, columns, args.covariates, args.fit_splits,
+                                                   not args.no_eb)
+    harmonized_df[['subject_id'] + columns].to_csv(args.output, index=False)
+    if args.model:
+        save_combat(combat_model, args.model)
+        print(f"ComBat parameters saved to {args.model}")
+
+    print(json.dumps({
+        'subjects': len(harmonized_df),
+        'features': len(columns),
+        'sites': combat_model['site_levels'].tolist(),
+        'covariates': args.covariates,
+    }, indent=2))
+    print(f"Harmonized features saved to {args.output}")
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+# Runs FreeSurfer's longitudinal stream for subjects scanned in several sessions: a
+# cross-sectional run per session, one unbiased template (-base) per subject built from them, and
+# a -long run per session initialized from the template. The runs form a dependency graph that is
+# scheduled over a fixed number of job slots, longest remaining chain first, so sessions and
+# subjects proceed concurrently and the template of a subject is built only once for all its
+# timepoints. Subjects with a single session get the usual cross-sectional run.
+import argparse
+import heapq
+import logging
+import os
+import subprocess
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import tracing
+from dedup_scans import list_subject_scans, parse_entity, scan_rank_key
+from nifti_header import read_nifti_header
+
+# Rough single-thread hours of each kind of run, only used to order the ready runs
+NODE_HOURS = {'cross': 8.0, 'base': 3.0, 'long': 4.5}
+
+# Outcomes of run_dag
+DONE = 'done'
+ALREADY_DONE = 'already done'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+
+def select_session_scans(files):
+    """
+    Choose the best T1 of every session of a subject
+
+    Sessions come from the ses- entity data_organizer.py keeps in the filenames.
+
+    :param files: Scans of one subject, e.g. from dedup_scans.list_subject_scans
+    :return: Dictionary mapping session label (None without a ses- entity) to the scan path
+    """
+    by_session = defaultdict(list)
+    for path in files:
+        by_session[parse_entity(os.path.basename(path), 'ses')].append(path)
+
+    best = {}
+    for session, paths in by_session.items():
+        headers = {}
+        for path in paths:
+            try:
+                headers[path] = read_nifti_header(path)
+            except (OSError, EOFError, ValueError) as e:
+                logging.warning(f"Could not read header of {path}: {e}")
+                headers[path] = None
+        best[session] = min(paths, key=lambda p: scan_rank_key(p, headers[p]))
+    return best
+
+
+def timepoint_id(subject_id, session):
+    return f"{subject_id}_ses-{session}"
+
+
+def base_id(subject_id):
+    return f"{subject_id}_base"
+
+
+def long_id(subject_id, session):
+    return f"{timepoint_id(subject_id, session)}.long.{base_id(subject_id)}"
+
+
+def build_dag(session_scans):
+    """
+    Build the recon-all runs of a cohort
+
+    Every node is named after the SUBJECTS_DIR folder it produces and holds the recon-all
+    arguments (without -openmp) and the nodes it waits for.
+
+    :param session_scans: Dictionary mapping subject ID to {session: T1 path}
+    :return: Dictionary mapping node ID to {'subject_id', 'kind', 'args', 'deps'}
+    """
+    nodes = {}
+    for subject_id, scans in sorted(session_scans.items()):
+        sessions = sorted(s for s in scans if s is not None)
+        if len(sessions) < 2:
+            t1_path = scans[sessions[0]] if sessions else scans[None]
+            nodes[subject_id] = {'subject_id': subject_id, 'kind': 'cross',
+                                 'args': ['-subject', subject_id, '-i', t1_path, '-all'], 'deps': []}
+            continue
+        if None in scans:
+            logging.warning(f"Ignoring {os.path.basename(scans[None])} of {subject_id}: it has no session")
+
+        timepoints = [timepoint_id(subject_id, s) for s in sessions]
+        for session, node_id in zip(sessions, timepoints):
+            nodes[node_id] = {'subject_id': subject_id, 'kind': 'cross',
+                              'args': ['-subject', node_id, '-i', scans[session], '-all'], 'deps': []}
+
+        base_args = ['-base', base_id(subject_id)]
+        for node_id in timepoints:
+            base_args += ['-tp', node_id]
+        nodes[base_id(subject_id)] = {'subject_id': subject_id, 'kind': 'base',
+                                      'args': base_args + ['-all'], 'deps': timepoints}
+
+        for session, node_id in zip(sessions, timepoints):
+            nodes[long_id(subject_id, session)] = {
+                'subject_id': subject_id, 'kind': 'long',
+                'args': ['-long', node_id, base_id(subject_id), '-all'],
+                'deps': [base_id(subject_id)],
+            }
+    return nodes
+
+
+def remaining_hours(nodes):
+    """Hours of the longest chain from every node to the end of the graph (its scheduling priority)."""
+    dependents = defaultdict(list)
+    for node_id, node in nodes.items():
+        for dep in node['deps']:
+            dependents[dep].append(node_id)
+
+    ranks = {}
+
+    def rank(node_id):
+        if node_id not in ranks:
+            ranks[node_id] = NODE_HOURS[nodes[node_id]['kind']] + max(
+                (rank(d) for d in dependents[node_id]), default=0.0)
+        return ranks[node_id]
+
+    for node_id in nodes:
+        rank(node_id)
+    return ranks
+
+
+def is_node_done(subjects_dir, node_id):
+    return os.path.exists(os.path.join(subjects_dir, node_id, 'scripts', 'recon-all.done'))
+
+
+def run_node(subjects_dir, node_id, node, threads=1, recon_all='recon-all'):
+    """
+    Run one recon-all node, logging to SUBJECTS_DIR/logs/<node>_recon-all.log
+
+    :return: True if recon-all finished successfully
+    """
+    log_path = os.path.join(subjects_dir, 'logs', f"{node_id}_recon-all.log")
+    command = [recon_all] + node['args'] + ['-openmp', str(threads), '-no-isrunning']
+    env = dict(os.environ, SUBJECTS_DIR=subjects_dir)
+
+    logging.info(f"Starting {node['kind']} run {node_id}")
+    with tracing.span('recon-all', node['subject_id'], kind=node['kind'], node=node_id,
+                      threads=threads) as span, open(log_path, 'w') as log_file:
+        result = subprocess.run(command, stdout=log_file, stderr=subprocess.STDOUT, env=env)
+        if result.returncode != 0:
+            span.fail(f"exit code {result.returncode}")
+
+    if result.returncode != 0:
+        logging.error(f"Error in {node_id} (exit code: {result.returncode}), see {log_path}")
+        return False
+    logging.info(f"{node_id} processed successfully")
+    return True
+
+
+def run_dag(nodes, subjects_dir, jobs=4, threads=1, recon_all='recon-all'):
+    """
+    Run the nodes of build_dag with at most jobs recon-all processes at a time
+
+    A node starts once all its dependencies finished; among the ready nodes the one heading the
+    longest remaining chain goes first. Nodes with recon-all.done are not run again, and the
+    dependents of a failed node are skipped.
+
+    :return: Dictionary mapping node ID to DONE, ALREADY_DONE, FAILED or SKIPPED
+    """
+    os.makedirs(os.path.join(subjects_dir, 'logs'), exist_ok=True)
+    ranks = remaining_hours(nodes)
+    dependents = defaultdict(list)
+    for node_id, node in nodes.items():
+        for dep in node['deps']:
+            dependents[dep].append(node_id)
+
+    outcome = {}
+    waiting = {node_id: len(node['deps']) for node_id, node in nodes.items()}
+    ready = []
+
+    def finish(node_id, result):
+        outcome[node_id] = result
+        for dependent in dependents[node_id]:
+            if result in (DONE, ALREADY_DONE):
+                waiting[dependent] -= 1
+                if waiting[dependent] == 0:
+                    heapq.heappush(ready, (-ranks[dependent], dependent))
+            elif dependent not in outcome:
+                logging.warning(f"Skipping {dependent}: {node_id} did not finish")
+                finish(dependent, SKIPPED)
+
+    for node_id, count in waiting.items():
+        if count == 0:
+            heapq.heappush(ready, (-ranks[node_id], node_id))
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        running = {}
+        while ready or running:
+            while ready and len(running) < jobs:
+                _, node_id = heapq.heappop(ready)
+                if is_node_done(subjects_dir, node_id):
+                    logging.info(f"{node_id} has already been processed. Skipping.")
+                    finish(node_id, ALREADY_DONE)
+                    continue
+                future = tracing.submit(executor, run_node, subjects_dir, node_id, nodes[node_id], threads, recon_all)
+                running[future] = node_id
+            if not running:
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                node_id = running.pop(future)
+                try:
+                    ok = future.result()
+                except Exception as e:
+                    logging.error(f"{node_id} raised: {e}")
+                    ok = False
+                finish(node_id, DONE if ok else FAILED)
+    return outcome
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Run recon-all as a dependency graph, with the longitudinal stream for multi-session subjects')
+    parser.add_argument('-d', '--data-dir', required=True,
+                        help='anat/ folder of data_organizer.py (anat/sub-XXXXXXX/*T1w.nii.gz)')
+    parser.add_argument('-o', '--output-dir', required=True, help='FreeSurfer SUBJECTS_DIR')
+    parser.add_argument('-s', '--subjects', default=None,
+                        help='File with list of subject IDs to process (default: all subjects in --data-dir)')
+    parser.add_argument('-p', '--parallel', type=int, default=4,
+                        help='Number of recon-all runs at the same time (default: 4)')
+    parser.add_argument('--threads', type=int, default=1, help='OpenMP threads per recon-all run (default: 1)')
+    parser.add_argument('--recon-all', default='recon-all', help='recon-all executable (default: recon-all)')
+    parser.add_argument('--dry-run', action='store_true', help='Print the runs and their dependencies only')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    subject_scans = list_subject_scans(args.data_dir)
+    if args.subjects:
+        with open(args.subjects, 'r') as f:
+            wanted = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+        missing = [s for s in wanted if s not in subject_scans]
+        if missing:
+            logging.warning(f"No T1 image found for {len(missing)} subjects: {', '.join(missing[:10])}")
+        subject_scans = {s: subject_scans[s] for s in wanted if s in subject_scans}
+    t1_scans = {
+        subject_id: [p for p in files if 'T1w' in os.path.basename(p)]
+        for subject_id, files in subject_scans.items()
+    }
+    graph = build_dag({s: select_session_scans(files) for s, files in t1_scans.items() if files})
+
+    kinds = defaultdict(int)
+    for graph_node in graph.values():
+        kinds[graph_node['kind']] += 1
+    print(f"{len(graph)} recon-all runs: {kinds['cross']} cross-sectional, {kinds['base']} templates, "
+          f"{kinds['long']} longitudinal")
+
+    if args.dry_run:
+        for graph_id, graph_node in graph.items():
+            after = f" after {', '.join(graph_node['deps'])}" if graph_node['deps'] else ''
+            print(f"  {graph_id}: recon-all {' '.join(graph_node['args'])}{after}")
+    else:
+        outcomes = run_dag(graph, os.path.abspath(args.output_dir), args.parallel, args.threads, args.recon_all)
+        counts = defaultdict(int)
+        for result in outcomes.values():
+            counts[result] += 1
+        print(f"\n{'=' * 50}")
+        print(f"Done: {counts[DONE]} / Already done: {counts[ALREADY_DONE]} / Failed: {counts[FAILED]} / "
+              f"Skipped: {counts[SKIPPED]}")
+        failed_runs = [graph_id for graph_id, result in outcomes.items() if result == FAILED]
+        if failed_runs:
+            print(f"Failed runs: {', '.join(failed_runs)}")
+        print(f"{'=' * 50}")
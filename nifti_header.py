@@ -0,0 +1,145 @@
+import gzip
+import struct
+
+# Size in bytes of the NIfTI-1 and NIfTI-2 headers
+NIFTI1_HEADER_SIZE = 348
+NIFTI2_HEADER_SIZE = 540
+
+# NIfTI datatype codes mapped to numpy-style dtype names
+NIFTI_DATATYPES = {
+    2: 'uint8',
+    4: 'int16',
+    8: 'int32',
+    16: 'float32',
+    32: 'complex64',
+    64: 'float64',
+    128: 'rgb24',
+    256: 'int8',
+    512: 'uint16',
+    768: 'uint32',
+    1024: 'int64',
+    1280: 'uint64',
+}
+
+
+def _detect_endianness(data):
+    """Return the struct byte-order prefix and NIfTI version for a raw header."""
+    for prefix in ('<', '>'):
+        sizeof_hdr = struct.unpack(f'{prefix}i', data[:4])[0]
+        if sizeof_hdr == NIFTI1_HEADER_SIZE:
+            return prefix, 1
+        if sizeof_hdr == NIFTI2_HEADER_SIZE:
+            return prefix, 2
+    raise ValueError("Not a NIfTI-1 or NIfTI-2 header (unexpected sizeof_hdr)")
+
+
+def parse_nifti_header(data):
+    """
+    Parse the fields we care about from an uncompressed NIfTI-1 or NIfTI-2 header
+
+    :param data: bytes - at least the first 348 (NIfTI-1) or 540 (NIfTI-2) bytes of the image
+    :return: dict with version, shape, voxel_size, datatype, bitpix, vox_offset and descrip
+    """
+    if len(data) < 4:
+        raise ValueError("Header is truncated")
+
+    prefix, version = _detect_endianness(data)
+
+    if version == 1:
+        if len(data) < NIFTI1_HEADER_SIZE:
+            raise ValueError("NIfTI-1 header is truncated")
+        dim = struct.unpack(f'{prefix}8h', data[40:56])
+        datatype, bitpix = struct.unpack(f'{prefix}2h', data[70:74])
+        pixdim = struct.unpack(f'{prefix}8f', data[76:108])
+        vox_offset = struct.unpack(f'{prefix}f', data[108:112])[0]
+        descrip = data[148:228]
+    else:
+        if len(data) < NIFTI2_HEADER_SIZE:
+            raise ValueError("NIfTI-2 header is truncated")
+        datatype, bitpix = struct.unpack(f'{prefix}2h', data[12:16])
+        dim = struct.unpack(f'{prefix}8q', data[16:80])
+        pixdim = struct.unpack(f'{prefix}8d', data[104:168])
+        vox_offset = struct.unpack(f'{prefix}q', data[168:176])[0]
+        descrip = data[240:320]
+
+    ndim = max(0, min(int(dim[0]), 7))
+    shape = tuple(int(d) for d in dim[1:ndim + 1])
+    voxel_size = tuple(round(abs(float(p)), 6) for p in pixdim[1:min(ndim, 3) + 1])
+
+    return {
+        'version': version,
+        'shape': shape,
+        'voxel_size': voxel_size,
+        'datatype': NIFTI_DATATYPES.get(datatype, str(datatype)),
+        'bitpix': int(bitpix),
+        'vox_offset': int(vox_offset),
+        'descrip': descrip.split(b'\x00', 1)[0].decode('ascii', errors='replace').strip(),
+    }
+
+
+def read_nifti_header(path):
+    """
+    Read the header of a .nii or .nii.gz file without decompressing the image data
+
+    :param path: Path to the NIfTI file
+    :return: dict as returned by parse_nifti_header
+    """
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        data = f.read(NIFTI2_HEADER_SIZE)
+    return parse_nifti_header(data)
+
+
+def _quaternion_affine(qb, qc, qd, pixdim, offset):
+    """Build the qform affine from the quaternion parameters (NIfTI-1 method 2)."""
+    qa_squared = 1.0 - (qb * qb + qc * qc + qd * qd)
+    qa = qa_squared ** 0.5 if qa_squared > 0 else 0.0
+    rotation = [
+        [qa * qa + qb * qb - qc * qc - qd * qd, 2 * (qb * qc - qa * qd), 2 * (qb * qd + qa * qc)],
+        [2 * (qb * qc + qa * qd), qa * qa + qc * qc - qb * qb - qd * qd, 2 * (qc * qd - qa * qb)],
+        [2 * (qb * qd - qa * qc), 2 * (qc * qd + qa * qb), qa * qa + qd * qd - qc * qc - qb * qb],
+    ]
+    qfac = -1.0 if pixdim[0] < 0 else 1.0
+    scales = (pixdim[1], pixdim[2], pixdim[3] * qfac)
+    affine = [[rotation[i][j] * scales[j] for j in range(3)] + [offset[i]] for i in range(3)]
+    return affine + [[0.0, 0.0, 0.0, 1.0]]
+
+
+def parse_nifti_geometry(data):
+    """
+    Parse the voxel-to-world affine and intensity scaling of a NIfTI-1 or NIfTI-2 header
+
+    The sform is used when set, then the qform, then a plain scaling by the voxel size.
+
+    :param data: bytes - the uncompressed header, as for parse_nifti_header
+    :return: dict with affine (4x4 nested lists), scl_slope and scl_inter
+    """
+    prefix, version = _detect_endianness(data)
+
+    if version == 1:
+        pixdim = struct.unpack(f'{prefix}8f', data[76:108])
+        scl_slope, scl_inter = struct.unpack(f'{prefix}2f', data[112:120])
+        qform_code, sform_code = struct.unpack(f'{prefix}2h', data[252:256])
+        quatern = struct.unpack(f'{prefix}6f', data[256:280])
+        srows = struct.unpack(f'{prefix}12f', data[280:328])
+    else:
+        pixdim = struct.unpack(f'{prefix}8d', data[104:168])
+        scl_slope, scl_inter = struct.unpack(f'{prefix}2d', data[176:192])
+        qform_code, sform_code = struct.unpack(f'{prefix}2i', data[344:352])
+        quatern = struct.unpack(f'{prefix}6d', data[352:400])
+        srows = struct.unpack(f'{prefix}12d', data[400:496])
+
+    if sform_code > 0:
+        affine = [list(srows[0:4]), list(srows[4:8]), list(srows[8:12]), [0.0, 0.0, 0.0, 1.0]]
+    elif qform_code > 0:
+        affine = _quaternion_affine(quatern[0], quatern[1], quatern[2], pixdim, quatern[3:6])
+    else:
+        affine = [[pixdim[1], 0.0, 0.0, 0.0], [0.0, pixdim[2], 0.0, 0.0],
+                  [0.0, 0.0, pixdim[3], 0.0], [0.0, 0.0, 0.0, 1.0]]
+
+    return {
+        'affine': [[float(v) for v in row] for row in affine],
+        # A slope of 0 means the data are not scaled
+        'scl_slope': float(scl_slope) if scl_slope else 1.0,
+        'scl_inter': float(scl_inter) if scl_slope else 0.0,
+    }
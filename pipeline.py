@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+import argparse
+import functools
+import json
+import logging
+import os
+import shutil
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from dedup_scans import scan_rank_key
+from download_s3 import download_s3_object
+from freesurfer_stats import extract_subject_features, write_feature_table
+from nifti_header import read_nifti_header
+from recon_retry import DEFAULT_MAX_ATTEMPTS, RetryState
+from resource_sampler import DEFAULT_INTERVAL, JobSampler, predict_peak_bytes, record_job, total_memory_bytes
+from s3_manifest import Manifest, is_manifest_db
+from scratch_staging import clean_orphans, run_staged
+import tracing
+
+
+class DiskBudget:
+    """
+    Track bytes reserved on the working disk (or in memory) against a fixed budget.
+
+    reserve() blocks until the request fits. A request larger than the whole budget is let
+    through when nothing else is reserved so a single oversized subject cannot deadlock the run.
+    """
+
+    def __init__(self, limit_bytes):
+        self.limit = limit_bytes
+        self.used = 0
+        self._condition = threading.Condition()
+
+    def reserve(self, n_bytes):
+        with self._condition:
+            self._condition.wait_for(lambda: self.used + n_bytes <= self.limit or self.used == 0)
+            self.used += n_bytes
+
+    def release(self, n_bytes):
+        with self._condition:
+            self.used = max(0, self.used - n_bytes)
+            self._condition.notify_all()
+
+
+def directory_size(path):
+    """Return the total size in bytes of all files under a directory."""
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for file in files:
+            try:
+                total += os.path.getsize(os.path.join(root, file))
+            except OSError:
+                pass
+    return total
+
+
+def find_subject_objects(objects, subject_id):
+    """
+    Select the T1 objects of one subject from an s3_objects.json style manifest
+
+    :param objects: List of manifest entries with at least 'key' and 's3_uri', or a Manifest
+    :param subject_id: Zero-padded subject ID, e.g. sub-0010001
+    :return: List of matching manifest entries
+    """
+    if isinstance(objects, Manifest):
+        candidates = objects.by_subject(subject_id)
+    else:
+        candidates = objects
+    return [
+        obj for obj in candidates
+        if f"/{subject_id}/" in obj['key'] and obj['key'].endswith('T1w.nii.gz')
+    ]
+
+
+class StreamingPipeline:
+    """
+    Run download -> organize -> recon-all -> extract -> evict for each subject, overlapping the
+    stages so downloads of later subjects happen while earlier subjects are in recon-all.
+    """
+
+    def __init__(self, objects, anat_dir, subjects_dir, jobs=4, threads=1, download_workers=2,
+                 disk_budget_bytes=50 * 1024 ** 3, output_estimate_bytes=400 * 1024 ** 2,
+                 raw_estimate_bytes=20 * 1024 ** 2, keep_raw=False, archive_dir=None,
+                 recon_all='recon-all', downloader=download_s3_object, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                 scratch_dir=None, metrics_db=None, memory_budget_bytes=None, sample_interval=DEFAULT_INTERVAL):
+        """
+        :param objects: Manifest entries (s3_objects.json format, optionally with 'size') or a Manifest
+        :param anat_dir: Local folder for raw T1 downloads (one sub-XXXXXXX folder per subject)
+        :param subjects_dir: FreeSurfer SUBJECTS_DIR
+        :param jobs: Number of recon-all runs at the same time
+        :param threads: OpenMP threads per recon-all run
+        :param download_workers: Number of concurrent downloads
+        :param disk_budget_bytes: Maximum bytes of raw inputs plus outputs of subjects in progress; finished
+                                  subjects kept in subjects_dir (no archive_dir) and raw inputs kept with
+                                  keep_raw are counted separately in retained_bytes
+        :param output_estimate_bytes: Expected size of one recon-all subject directory
+        :param raw_estimate_bytes: Size assumed for objects whose size is not in the manifest
+        :param keep_raw: Keep raw inputs after recon-all instead of evicting them
+        :param archive_dir: If set, finished subjects are archived here and removed from subjects_dir
+        :param recon_all: recon-all executable
+        :param downloader: Function (s3_uri, output_path) -> bool used to fetch objects
+        :param max_attempts: recon-all runs per subject, including retries of recognized failures
+        :param scratch_dir: If set, run recon-all on this local disk and publish finished subjects to subjects_dir
+        :param metrics_db: If set, sample every recon-all run into this recon_metrics.py database and only
+                           start a run once its predicted peak memory fits memory_budget_bytes
+        :param memory_budget_bytes: Memory for the recon-all runs together (default: all memory of the node)
+        :param sample_interval: Seconds between resource samples of a run
+        """
+        self.objects = objects
+        self.anat_dir = anat_dir
+        self.subjects_dir = subjects_dir
+        self.jobs = jobs
+        self.threads = threads
+        self.download_workers = download_workers
+        self.budget = DiskBudget(disk_budget_bytes)
+        self.output_estimate_bytes = output_estimate_bytes
+        self.raw_estimate_bytes = raw_estimate_bytes
+        self.keep_raw = keep_raw
+        self.archive_dir = archive_dir
+        self.recon_all = recon_all
+        self.downloader = downloader
+        self.retries = RetryState(subjects_dir, max_attempts)
+        self.scratch_dir = scratch_dir
+        self.metrics_db = metrics_db
+        self.sample_interval = sample_interval
+        self.memory = DiskBudget(memory_budget_bytes or total_memory_bytes()) if metrics_db else None
+
+        # Bytes reserved per subject: {'raw': n, 'output': n}
+        self._reserved = {}
+        # Finished subjects left in subjects_dir and raw inputs kept with keep_raw are not in the
+        # budget: nothing frees them during the run, so downloads waiting for their space would wait forever
+        self.retained_bytes = 0
+        self._lock = threading.Lock()
+
+    def is_processed(self, subject_id):
+        return os.path.isfile(os.path.join(self.subjects_dir, subject_id, 'scripts', 'recon-all.done'))
+
+    def _release(self, subject_id, kind):
+        with self._lock:
+            n_bytes = self._reserved.get(subject_id, {}).pop(kind, 0)
+        self.budget.release(n_bytes)
+
+    def download(self, subject_id):
+        """
+        Reserve disk space and download the T1 scans of one subject into anat_dir/subject_id
+
+        :return: Path of the best T1 scan, or None if nothing could be downloaded
+        """
+        with tracing.span('download', subject_id) as span:
+            best = self._download(subject_id, span)
+            if best is None:
+                span.fail("no scan downloaded")
+            return best
+
+    def _download(self, subject_id, span):
+        subject_objects = find_subject_objects(self.objects, subject_id)
+        if not subject_objects:
+            logging.warning(f"No T1 image found in manifest for subject {subject_id}")
+            return None
+
+        raw_bytes = sum(obj.get('size') or self.raw_estimate_bytes for obj in subject_objects)
+        self.budget.reserve(raw_bytes + self.output_estimate_bytes)
+        with self._lock:
+            self._reserved[subject_id] = {'raw': raw_bytes, 'output': self.output_estimate_bytes}
+
+        subject_dir = os.path.join(self.anat_dir, subject_id)
+        os.makedirs(subject_dir, exist_ok=True)
+
+        paths = []
+        for obj in subject_objects:
+            path = os.path.join(subject_dir, os.path.basename(obj['key']))
+            if os.path.exists(path) or self.downloader(obj['s3_uri'], path):
+                paths.append(path)
+                span.add_bytes(os.path.getsize(path))
+
+        if not paths:
+            self.evict(subject_id)
+            self._release(subject_id, 'output')
+            return None
+
+        headers = {}
+        for path in paths:
+            try:
+                headers[path] = read_nifti_header(path)
+            except (OSError, EOFError, ValueError) as e:
+                logging.warning(f"Could not read header of {path}: {e}")
+                headers[path] = None
+        best = min(paths, key=lambda p: scan_rank_key(p, headers[p]))
+        logging.info(f"Downloaded {len(paths)} scan(s) for {subject_id}, using {os.path.basename(best)}")
+        return best
+
+    def run_recon_all(self, subject_id, t1_path):
+        """
+        Run recon-all for one subject, logging to SUBJECTS_DIR/logs/<subject>_recon-all.log
+
+        Failures recon_retry.py recognizes are retried with adjusted flags, up to max_attempts runs.
+
+        :return: True if recon-all finished successfully
+        """
+        log_path = os.path.join(self.subjects_dir, 'logs', f"{subject_id}_recon-all.log")
+        env = dict(os.environ, SUBJECTS_DIR=self.subjects_dir)
+        # Continue a retry planned in an earlier run of the pipeline
+        retry = self.retries.pending(subject_id)
+        args = retry['args'] if retry else ['-subject', subject_id, '-i', t1_path, '-all']
+        threads = retry['threads'] if retry else self.threads
+
+        while True:
+            command = [self.recon_all] + args + ['-openmp', str(threads), '-no-isrunning']
+            # Predicted again for a retry, which knows the peak of the failed run
+            memory_bytes = predict_peak_bytes(self.metrics_db, subject_id) if self.memory else 0
+            if self.memory:
+                self.memory.reserve(memory_bytes)
+            logging.info(f"Starting FreeSurfer processing for {subject_id}"
+                         + (f" ({memory_bytes / 1024 ** 3:.1f} GB reserved)" if memory_bytes else ''))
+            try:
+                with tracing.span('recon-all', subject_id, threads=threads) as span, \
+                        open(log_path, 'w') as log_file:
+                    wait = functools.partial(self._wait, subject_id=subject_id, threads=threads)
+                    if self.scratch_dir:
+                        returncode = run_staged(command, subject_id, self.subjects_dir, self.scratch_dir, log_file,
+                                                wait)
+                    else:
+                        returncode = wait(subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT,
+                                                           env=env))
+                    if returncode != 0:
+                        span.fail(f"exit code {returncode}")
+            finally:
+                if self.memory:
+                    self.memory.release(memory_bytes)
+
+            if returncode == 0:
+                self.retries.record_success(subject_id)
+                logging.info(f"Subject {subject_id} processed successfully")
+                return True
+
+            logging.error(f"Error processing subject {subject_id} (exit code: {returncode})")
+            # The sampled peak of the failed run may raise the memory set aside for the next one
+            more_memory = bool(self.memory) and predict_peak_bytes(self.metrics_db, subject_id) > memory_bytes
+            retry = self.retries.record_failure(subject_id, t1_path, returncode, log_path, threads, more_memory)
+            if retry is None:
+                return False
+            args, threads = retry['args'], retry['threads']
+
+    def _wait(self, process, subject_id, threads):
+        """Wait for a recon-all process, sampling and recording its resources when metrics_db is set."""
+        if not self.metrics_db:
+            return process.wait()
+        with JobSampler(process.pid, subject_id, self.sample_interval) as sampler:
+            returncode = process.wait()
+        record_job(self.metrics_db, sampler, threads, returncode)
+        return returncode
+
+    def evict(self, subject_id):
+        """Remove the raw inputs of a subject and return their space to the budget."""
+        raw_dir = os.path.join(self.anat_dir, subject_id)
+        if self.keep_raw:
+            self._retain(raw_dir)
+        else:
+            shutil.rmtree(raw_dir, ignore_errors=True)
+        self._release(subject_id, 'raw')
+
+    def _retain(self, path):
+        """Count a folder kept on disk for good in retained_bytes, warning once they outgrow the budget."""
+        with self._lock:
+            before = self.retained_bytes
+            self.retained_bytes += directory_size(path)
+        if before <= self.budget.limit < self.retained_bytes:
+            logging.warning(f"Kept raw inputs and finished subjects now use {self.retained_bytes / 1024 ** 3:.1f} GB, "
+                            f"more than the disk budget; use --archive-dir and leave out --keep-raw to free it")
+
+    def extract(self, subject_id):
+        """
+        Extract features for a finished subject, then optionally archive and remove it
+
+        :return: Feature dictionary
+        """
+        subject_dir = os.path.join(self.subjects_dir, subject_id)
+        with tracing.span('extract', subject_id):
+            features = extract_subject_features(subject_dir)
+
+        # A kept subject moves from the budget to retained_bytes
+        self._release(subject_id, 'output')
+        if self.archive_dir:
+            from archive_outputs import archive_subject, DEFAULT_KEEP_PATTERNS
+
+            os.makedirs(self.archive_dir, exist_ok=True)
+            with tracing.span('archive', subject_id) as span:
+                summary = archive_subject(subject_dir, self.archive_dir, DEFAULT_KEEP_PATTERNS)
+                span.add_bytes(summary['archive_bytes'])
+            shutil.rmtree(subject_dir)
+            logging.info(f"Archived {subject_id} to {summary['archive']}")
+        else:
+            self._retain(subject_dir)
+        return features
+
+    def run(self, subjects):
+        """
+        Process subjects in order with the stages running concurrently
+
+        :param subjects: List of subject IDs
+        :return: Tuple of (feature rows, list of failed subject IDs)
+        """
+        os.makedirs(self.anat_dir, exist_ok=True)
+        os.makedirs(os.path.join(self.subjects_dir, 'logs'), exist_ok=True)
+        if self.scratch_dir:
+            clean_orphans(self.scratch_dir, self.subjects_dir)
+
+        feature_rows = []
+        failed = []
+        pending = {}
+
+        with ThreadPoolExecutor(max_workers=self.download_workers) as download_pool, \
+                ThreadPoolExecutor(max_workers=self.jobs) as recon_pool, \
+                ThreadPoolExecutor(max_workers=1) as extract_pool:
+
+            for subject_id in subjects:
+                if self.is_processed(subject_id):
+                    logging.info(f"Subject {subject_id} has already been processed. Skipping recon-all.")
+                    pending[tracing.submit(extract_pool, self.extract, subject_id)] = ('extract', subject_id)
+                else:
+                    pending[tracing.submit(download_pool, self.download, subject_id)] = ('download', subject_id)
+
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, subject_id = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        logging.error(f"{stage} failed for {subject_id}: {e}")
+                        result = None
+
+                    if stage == 'download':
+                        if result:
+                            pending[tracing.submit(recon_pool, self.run_recon_all, subject_id, result)] = (
+                                'recon', subject_id)
+                        else:
+                            failed.append(subject_id)
+                    elif stage == 'recon':
+                        self.evict(subject_id)
+                        if result:
+                            pending[tracing.submit(extract_pool, self.extract, subject_id)] = ('extract', subject_id)
+                        else:
+                            self._release(subject_id, 'output')
+                            failed.append(subject_id)
+                    elif result:
+                        feature_rows.append(result)
+                    else:
+                        failed.append(subject_id)
+
+        return feature_rows, failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Stream subjects through download, recon-all, feature extraction and eviction')
+    parser.add_argument('--subjects', required=True, help='File with list of subject IDs to process')
+    parser.add_argument('--manifest', default='./data/s3_objects.json',
+                        help='S3 object manifest, JSON or SQLite (default: data/s3_objects.json)')
+    parser.add_argument('--anat-dir', required=True, help='Local folder for raw T1 downloads')
+    parser.add_argument('--output-dir', required=True, help='FreeSurfer SUBJECTS_DIR')
+    parser.add_argument('--features', default=None,
+                        help='Output feature CSV (default: <output-dir>/freesurfer_features.csv)')
+    parser.add_argument('-p', '--parallel', type=int, default=4,
+                        help='Number of recon-all runs at the same time (default: 4)')
+    parser.add_argument('--threads', type=int, default=1, help='OpenMP threads per recon-all run (default: 1)')
+    parser.add_argument('--download-workers', type=int, default=2, help='Concurrent downloads (default: 2)')
+    parser.add_argument('--disk-budget-gb', type=float, default=50,
+                        help='Maximum disk used by raw inputs and outputs of subjects in progress in GB (default: 50)')
+    parser.add_argument('--output-estimate-mb', type=float, default=400,
+                        help='Expected size of one processed subject in MB (default: 400)')
+    parser.add_argument('--keep-raw', action='store_true', help='Do not delete raw inputs after recon-all')
+    parser.add_argument('--archive-dir', default=None,
+                        help='Archive finished subjects here and remove them from the output directory')
+    parser.add_argument('--recon-all', default='recon-all', help='recon-all executable (default: recon-all)')
+    parser.add_argument('--scratch-dir', default=None,
+                        help='Run recon-all on this local disk or tmpfs and copy finished subjects to --output-dir')
+    parser.add_argument('--max-attempts', type=int, default=DEFAULT_MAX_ATTEMPTS,
+                        help=f'recon-all runs per subject, retrying recognized failures (default: {DEFAULT_MAX_ATTEMPTS})')
+    parser.add_argument('--metrics-db', default=None,
+                        help='Sample CPU, memory and I/O of every recon-all run into this recon_metrics.py database '
+                             'and start runs only when their predicted memory fits')
+    parser.add_argument('--memory-gb', type=float, default=None,
+                        help='Memory for all recon-all runs together with --metrics-db (default: all memory)')
+    parser.add_argument('--sample-interval', type=float, default=DEFAULT_INTERVAL,
+                        help=f'Seconds between resource samples with --metrics-db (default: {DEFAULT_INTERVAL})')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    if is_manifest_db(args.manifest):
+        manifest_objects = Manifest(args.manifest)
+    else:
+        with open(args.manifest, 'r') as f:
+            manifest_objects = json.load(f)
+    with open(args.subjects, 'r') as f:
+        subject_ids = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+
+    pipeline = StreamingPipeline(
+        manifest_objects, args.anat_dir, args.output_dir,
+        jobs=args.parallel,
+        threads=args.threads,
+        download_workers=args.download_workers,
+        disk_budget_bytes=int(args.disk_budget_gb * 1024 ** 3),
+        output_estimate_bytes=int(args.output_estimate_mb * 1024 ** 2),
+        keep_raw=args.keep_raw,
+        archive_dir=args.archive_dir,
+        recon_all=args.recon_all,
+        max_attempts=args.max_attempts,
+        scratch_dir=args.scratch_dir,
+        metrics_db=args.metrics_db,
+        memory_budget_bytes=int(args.memory_gb * 1024 ** 3) if args.memory_gb else None,
+        sample_interval=args.sample_interval,
+    )
+    rows, failed_subjects = pipeline.run(subject_ids)
+
+    features_path = args.features or os.path.join(args.output_dir, 'freesurfer_features.csv')
+    write_feature_table(rows, features_path)
+
+    print(f"\n{'=' * 50}")
+    print(f"Success: {len(rows)} / Failed: {len(failed_subjects)}")
+    if failed_subjects:
+        print(f"Failed subjects: {', '.join(failed_subjects)}")
+    print(f"Features saved to {features_path}")
+    print(f"{'=' * 50}")
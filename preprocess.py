@@ -2,11 +2,31 @@
 import subprocess
 import time
 import datetime
+import glob
 import os
+import sys
+
+from recon_progress import ProgressMonitor, format_duration
+from recon_retry import RetryState
 
 # File containing commands, one per line
 SUBJECTS_FILE = "/Users/stevenang/PycharmProjects/adhd/data/all_participant_ids.txt"
 
+# Raw T1 images (anat/ of data_organizer.py)
+DATA_DIR = "/Users/stevenang/Downloads/dataset/anat"
+
+# FreeSurfer SUBJECTS_DIR the subjects are processed into
+OUTPUT_DIR = "/Users/stevenang/PycharmProjects/adhd/preprocessed_data"
+
+# Local disk or tmpfs folder recon-all runs in before the subject is copied to OUTPUT_DIR (None: run in OUTPUT_DIR)
+SCRATCH_DIR = None
+
+# recon-all runs per subject; recognized failures are requeued with adjusted flags until then
+MAX_ATTEMPTS = 3
+
+# Returned by run_command when a failed subject stays first in the queue for a retry
+REQUEUED = -1
+
 # Optional: set a count limit
 MAX_ITERATIONS = 98  # Set to your desired number or comment out for infinite loop
 
@@ -60,14 +80,27 @@ def run_command():
     commands = [
         "/Users/stevenang/PycharmProjects/adhd/preprocessing.sh",
         "--data-dir",
-        "/Users/stevenang/Downloads/dataset/anat",
+        DATA_DIR,
         "--output-dir",
-        "/Users/stevenang/PycharmProjects/adhd/preprocessed_data",
+        OUTPUT_DIR,
         "--subjects",
         id_file,
         "-p",
         "8"
     ]
+    if SCRATCH_DIR:
+        commands += ["--scratch-dir", SCRATCH_DIR]
+    # A requeued subject is rerun with recon-all directly, with the flags planned for its failure
+    retry_state = RetryState(OUTPUT_DIR, MAX_ATTEMPTS)
+    retry = retry_state.pending(subject_id)
+    log_file = None
+    if retry:
+        commands = ["recon-all"] + retry['args'] + ["-openmp", str(retry['threads']), "-no-isrunning"]
+        if SCRATCH_DIR:
+            commands = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "scratch_staging.py"),
+                        "run", "--scratch-dir", SCRATCH_DIR, "--subjects-dir", OUTPUT_DIR,
+                        "--subject", subject_id, "--"] + commands
+        log_file = open(os.path.join(OUTPUT_DIR, "logs", f"{subject_id}_recon-all.log"), 'w')
     command_str = ' '.join(commands)
 
     try:
@@ -76,13 +109,19 @@ def run_command():
         print(f"Start time: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
 
         # Use the list of arguments instead of a string
-        process = subprocess.Popen(commands)
+        process = subprocess.Popen(commands, stdout=log_file, stderr=subprocess.STDOUT if log_file else None,
+                                   env=dict(os.environ, SUBJECTS_DIR=OUTPUT_DIR))
 
         counter = 0
+        monitor = ProgressMonitor(OUTPUT_DIR, [subject_id])
         # Monitor the process
         while process.poll() is None:  # None means the process is still running
             if counter % 15 == 0:
-                print(f"Command still running... ({datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')})")
+                monitor.poll()
+                row = monitor.status()['subjects'][0]
+                print(f"Command still running... ({datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}) "
+                      f"step: {row['step'] or '-'} ({row['steps_done']}/{row['steps_total']}), "
+                      f"ETA: {format_duration(row['eta_seconds'])}")
             counter += 1
             time.sleep(60)  # Check every minute (adjust as needed)
 
@@ -92,22 +131,35 @@ def run_command():
 
         # If successful, remove the command from the file
         if exit_code == 0:
+            retry_state.record_success(subject_id)
             if remove_first_line():
                 print("Command removed from file after successful execution.")
             else:
                 print("Failed to remove command from file.")
+        else:
+            t1_paths = sorted(glob.glob(os.path.join(DATA_DIR, "**", f"{subject_id}*T1w.nii.gz"), recursive=True))
+            retry = retry_state.record_failure(subject_id, t1_paths[0] if t1_paths else None, exit_code,
+                                               os.path.join(OUTPUT_DIR, "logs", f"{subject_id}_recon-all.log"),
+                                               threads=retry['threads'] if retry else 1)
+            if retry:
+                print(f"Requeued {subject_id} ({retry['reason']}): recon-all {' '.join(retry['args'])}")
+                return REQUEUED
 
         return exit_code
 
     except Exception as e:
         print(f"Error executing command: {e}")
         return 1
+    finally:
+        if log_file:
+            log_file.close()
 
 
 def main():
     iteration = 1
     success = 0
     failed = 0
+    retried = 0
 
     # Check if commands file exists
     if not os.path.exists(SUBJECTS_FILE):
@@ -131,6 +183,9 @@ def main():
         if exit_code == 0:
             print(f"Iteration {iteration} completed successfully")
             success += 1
+        elif exit_code == REQUEUED:
+            print(f"Iteration {iteration} failed, retrying with adjusted flags")
+            retried += 1
         else:
             print(f"Iteration {iteration} failed with exit code {exit_code}")
             failed += 1
@@ -156,7 +211,7 @@ def main():
 
     # print summary
     print(f"\n{'=' * 50}")
-    print(f"Success: {success} / Failed: {failed}")
+    print(f"Success: {success} / Failed: {failed} / Retries: {retried}")
     print(f"{'=' * 50}")
 
 
@@ -12,6 +12,7 @@
 #     -s, --subjects LIST      File with list of subject IDs to process
 #     -a, --all                Process all subjects in the data directory
 #     -c, --clean              Remove any existing output for the subject
+#     -t, --scratch-dir DIR    Run each subject on this local disk and copy it to the output when done
 #     -h, --help               Display this help message
 #
 # Example: ./process_freesurfer.sh -d /path/to/ADHD200 -o /path/to/output -p 8 -a
@@ -23,6 +24,7 @@ PARALLEL=4
 SUBJECT_LIST=""
 PROCESS_ALL=false
 CLEAN=false
+SCRATCH_DIR=""
 
 # Parse command line arguments
 while [[ $# -gt 0 ]]; do
@@ -56,6 +58,11 @@ while [[ $# -gt 0 ]]; do
             CLEAN=true
             shift
             ;;
+        -t|--scratch-dir)
+            SCRATCH_DIR="$2"
+            shift
+            shift
+            ;;
         -h|--help)
             echo "Usage: $0 [options]"
             echo "Options:"
@@ -65,6 +72,7 @@ while [[ $# -gt 0 ]]; do
             echo "  -s, --subjects LIST      File with list of subject IDs to process"
             echo "  -a, --all                Process all subjects in the data directory"
             echo "  -c, --clean              Remove any existing output for the subject"
+            echo "  -t, --scratch-dir DIR    Run each subject on this local disk and copy it to the output when done"
             echo "  -h, --help               Display this help message"
             exit 0
             ;;
@@ -157,9 +165,16 @@ process_subject() {
         return 0
     fi
 
+    # With a scratch directory recon-all runs on local disk and the subject is copied back at the end
+    local runner=()
+    if [[ -n "$SCRATCH_DIR" ]]; then
+        runner=(python3 "$SCRIPT_DIR/scratch_staging.py" run --scratch-dir "$SCRATCH_DIR"
+                --subjects-dir "$SUBJECTS_DIR" --subject "$subject_id" --)
+    fi
+
     # Run recon-all with full pipeline
     echo "Starting FreeSurfer processing for $subject_id"
-    recon-all -subject "$subject_id" -i "$t1_path" -all \
+    "${runner[@]}" recon-all -subject "$subject_id" -i "$t1_path" -all \
         -openmp 1 \
         -no-isrunning \
         > "$SUBJECTS_DIR/logs/${subject_id}_recon-all.log" 2>&1
@@ -170,6 +185,8 @@ process_subject() {
         return 0
     else
         echo "Error processing subject $subject_id (exit code: $exit_code)"
+        # Name the failure (talairach, large FOV, ventricles, out of memory) and its usual fix
+        python3 "$SCRIPT_DIR/recon_retry.py" --subjects-dir "$SUBJECTS_DIR" "$subject_id" 2>/dev/null
         return 1
     fi
 }
@@ -178,6 +195,14 @@ process_subject() {
 export -f process_subject
 export SUBJECTS_DIR
 export CLEAN
+export SCRATCH_DIR
+SCRIPT_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
+export SCRIPT_DIR
+
+# Remove scratch directories and half-copied subjects left by crashed runs
+if [[ -n "$SCRATCH_DIR" ]]; then
+    python3 "$SCRIPT_DIR/scratch_staging.py" clean --scratch-dir "$SCRATCH_DIR" --subjects-dir "$SUBJECTS_DIR"
+fi
 
 # Process subjects sequentially or in parallel
 if command -v parallel >/dev/null 2>&1 && [ ${#T1_FILES[@]} -gt 0 ]; then
@@ -333,4 +358,9 @@ EOF
 
 chmod +x "$SUBJECTS_DIR/check_quality.sh"
 echo "Created quality control script at $SUBJECTS_DIR/check_quality.sh"
-echo "Run this script to generate quality control snapshots for visual inspection."
\ No newline at end of file
+echo "Run this script to generate quality control snapshots for visual inspection."
+
+# Exit with an error if any subject failed, so callers such as preprocess.py can requeue it
+if [[ $failed -gt 0 ]]; then
+    exit 1
+fi
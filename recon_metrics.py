@@ -0,0 +1,422 @@
+#!/usr/bin/env python3
+import argparse
+import csv
+import datetime
+import logging
+import os
+import sqlite3
+from collections import defaultdict
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS log_offsets (
+    path TEXT PRIMARY KEY,
+    subject_id TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    current_step INTEGER,
+    invocation INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS steps (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    subject_id TEXT NOT NULL,
+    step TEXT NOT NULL,
+    invocation INTEGER NOT NULL DEFAULT 0,
+    start REAL NOT NULL,
+    end REAL,
+    cpu_seconds REAL NOT NULL DEFAULT 0,
+    max_rss_kb INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS steps_subject ON steps (subject_id);
+CREATE TABLE IF NOT EXISTS subjects (
+    subject_id TEXT PRIMARY KEY,
+    site TEXT,
+    status TEXT,
+    finished REAL
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    subject_id TEXT NOT NULL,
+    host TEXT,
+    threads INTEGER,
+    start REAL NOT NULL,
+    end REAL,
+    exit_code INTEGER,
+    cpu_seconds REAL NOT NULL DEFAULT 0,
+    peak_rss_kb INTEGER NOT NULL DEFAULT 0,
+    read_bytes INTEGER NOT NULL DEFAULT 0,
+    write_bytes INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS jobs_subject ON jobs (subject_id);
+CREATE TABLE IF NOT EXISTS job_steps (
+    job_id INTEGER NOT NULL,
+    step TEXT NOT NULL,
+    cpu_seconds REAL NOT NULL DEFAULT 0,
+    peak_rss_kb INTEGER NOT NULL DEFAULT 0,
+    read_bytes INTEGER NOT NULL DEFAULT 0,
+    write_bytes INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (job_id, step)
+);
+"""
+
+# Percentiles written to the per-site summary
+SUMMARY_PERCENTILES = (50, 90, 95)
+
+# First line of every run of recon-all; reruns (resumes, retries) are appended to the same log
+INVOCATION_MARKER = 'New invocation of recon-all'
+# Finished steps of the latest run of recon-all that finished them, per subject and step
+LATEST_STEPS = ("s.end IS NOT NULL AND s.invocation = (SELECT MAX(t.invocation) FROM steps t "
+                "WHERE t.subject_id = s.subject_id AND t.step = s.step AND t.end IS NOT NULL)")
+
+
+def parse_log_date(tokens):
+    """
+    Parse the output of `date` at the end of a recon-all log line, e.g. "Sat Mar 18 12:00:00 UTC 2023"
+
+    :param tokens: Whitespace-split tokens of the line
+    :return: Tuple of (epoch seconds, number of tokens used) or (None, 0)
+    """
+    for n_tokens in (6, 5):
+        if len(tokens) < n_tokens:
+            continue
+        date_tokens = tokens[-n_tokens:]
+        if n_tokens == 6:
+            # Drop the timezone abbreviation, strptime cannot parse it reliably
+            date_tokens = date_tokens[:4] + date_tokens[5:]
+        try:
+            parsed = datetime.datetime.strptime(' '.join(date_tokens), '%a %b %d %H:%M:%S %Y')
+        except ValueError:
+            continue
+        return parsed.timestamp(), n_tokens
+    return None, 0
+
+
+def parse_fstime(line):
+    """
+    Parse an "@#@FSTIME" resource line written by FreeSurfer binaries
+
+    :param line: e.g. "@#@FSTIME  2023:03:18:12:00:00 mri_convert N 1 e 2.34 S 0.10 U 2.10 P 95% M 123456 ..."
+    :return: Tuple of (cpu seconds, max RSS in KB)
+    """
+    tokens = line.split()
+    fields = dict(zip(tokens[3::2], tokens[4::2]))
+    try:
+        cpu = float(fields.get('U', 0)) + float(fields.get('S', 0))
+        max_rss = int(fields.get('M', 0))
+    except ValueError:
+        return 0.0, 0
+    return cpu, max_rss
+
+
+def percentile(values, q):
+    """Return the q-th percentile (0-100) of values using linear interpolation."""
+    if not values:
+        return None
+    values = sorted(values)
+    position = (len(values) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+class MetricsStore:
+    """SQLite store of per-step recon-all timings, filled incrementally from the logs, and of sampled jobs."""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        self.conn.executescript(SCHEMA)
+        # Databases written before runs were told apart
+        for table in ('log_offsets', 'steps'):
+            columns = [row[1] for row in self.conn.execute(f"PRAGMA table_info({table})")]
+            if 'invocation' not in columns:
+                self.conn.execute(f"ALTER TABLE {table} ADD COLUMN invocation INTEGER NOT NULL DEFAULT 0")
+
+    def close(self):
+        self.conn.close()
+
+    def ingest_log(self, subject_id, log_path):
+        """
+        Parse the part of a recon-all.log or recon-all-status.log written since the last call
+
+        Only complete lines are consumed. The parser state (offset, the step in progress and the
+        number of the recon-all run) is stored with the data so ingestion can resume in a later
+        process.
+
+        :param subject_id: Subject ID the log belongs to
+        :param log_path: Path to the log file
+        :return: Number of new lines parsed
+        """
+        row = self.conn.execute(
+            "SELECT offset, current_step, invocation FROM log_offsets WHERE path = ?", (log_path,)).fetchone()
+        offset, current_step, invocation = row if row else (0, None, 0)
+
+        size = os.path.getsize(log_path)
+        if size < offset:
+            # The log was replaced (e.g. by a rerun with -clean), start over for this subject
+            logging.info(f"{log_path} was truncated, re-reading it")
+            self.conn.execute("DELETE FROM steps WHERE subject_id = ?", (subject_id,))
+            offset, current_step, invocation = 0, None, 0
+        if size == offset:
+            return 0
+
+        with open(log_path, 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+
+        end = data.rfind(b'\n')
+        if end < 0:
+            return 0
+        lines = data[:end + 1].decode('utf-8', errors='replace').splitlines()
+
+        with self.conn:
+            for line in lines:
+                if line.startswith(INVOCATION_MARKER):
+                    # A step the previous run left unfinished is never closed
+                    current_step, invocation = None, invocation + 1
+                    continue
+                current_step = self._ingest_line(subject_id, line, current_step, invocation)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO log_offsets (path, subject_id, offset, current_step, invocation) "
+                "VALUES (?, ?, ?, ?, ?)", (log_path, subject_id, offset + end + 1, current_step, invocation))
+        return len(lines)
+
+    def _ingest_line(self, subject_id, line, current_step, invocation):
+        if line.startswith('#@#%#'):
+            return current_step
+
+        if line.startswith('#@# '):
+            tokens = line.split()
+            timestamp, n_date_tokens = parse_log_date(tokens)
+            if timestamp is None:
+                return current_step
+            step = ' '.join(tokens[1:len(tokens) - n_date_tokens])
+            if current_step is not None:
+                self.conn.execute("UPDATE steps SET end = ? WHERE id = ?", (timestamp, current_step))
+            cursor = self.conn.execute(
+                "INSERT INTO steps (subject_id, step, invocation, start) VALUES (?, ?, ?, ?)",
+                (subject_id, step, invocation, timestamp))
+            return cursor.lastrowid
+
+        if line.startswith('@#@FSTIME') and current_step is not None:
+            cpu, max_rss = parse_fstime(line)
+            self.conn.execute(
+                "UPDATE steps SET cpu_seconds = cpu_seconds + ?, max_rss_kb = MAX(max_rss_kb, ?) WHERE id = ?",
+                (cpu, max_rss, current_step))
+            return current_step
+
+        for marker, status in ((' finished without error at ', 'done'), (' exited with ERRORS at ', 'error')):
+            if marker in line:
+                timestamp, _ = parse_log_date(line.split())
+                if current_step is not None and timestamp is not None:
+                    self.conn.execute("UPDATE steps SET end = ? WHERE id = ?", (timestamp, current_step))
+                self.conn.execute(
+                    "INSERT INTO subjects (subject_id, status, finished) VALUES (?, ?, ?) "
+                    "ON CONFLICT(subject_id) DO UPDATE SET status = excluded.status, finished = excluded.finished",
+                    (subject_id, status, timestamp))
+                return None
+        return current_step
+
+    def ingest_subjects_dir(self, subjects_dir, sites=None):
+        """
+        Ingest the log of every subject in a FreeSurfer SUBJECTS_DIR
+
+        scripts/recon-all.log is preferred because it also contains the @#@FSTIME CPU lines.
+        SUBJECTS_DIR/logs/<subject>_recon-all.log (written by preprocessing.sh) and
+        scripts/recon-all-status.log are used when it is missing.
+
+        :param subjects_dir: FreeSurfer SUBJECTS_DIR
+        :param sites: Optional dictionary mapping subject ID to acquisition site
+        :return: Number of logs read
+        """
+        sites = sites or {}
+        n_logs = 0
+        for subject_id in sorted(os.listdir(subjects_dir)):
+            candidates = [
+                os.path.join(subjects_dir, subject_id, 'scripts', 'recon-all.log'),
+                os.path.join(subjects_dir, 'logs', f"{subject_id}_recon-all.log"),
+                os.path.join(subjects_dir, subject_id, 'scripts', 'recon-all-status.log'),
+            ]
+            log_path = next((p for p in candidates if os.path.isfile(p)), None)
+            if log_path is None:
+                continue
+
+            self.ingest_log(subject_id, log_path)
+            n_logs += 1
+            with self.conn:
+                self.conn.execute(
+                    "INSERT INTO subjects (subject_id, site) VALUES (?, ?) "
+                    "ON CONFLICT(subject_id) DO UPDATE SET site = COALESCE(excluded.site, subjects.site)",
+                    (subject_id, sites.get(subject_id)))
+        return n_logs
+
+    def step_durations(self, subject_id=None):
+        """
+        Return finished steps as (subject_id, site, step, duration seconds, cpu seconds, max RSS KB)
+
+        A step recon-all ran more than once for a subject is only counted from its latest run.
+
+        :param subject_id: Optional subject ID to filter on
+        """
+        query = ("SELECT s.subject_id, COALESCE(j.site, 'unknown'), s.step, s.end - s.start, s.cpu_seconds, "
+                 "s.max_rss_kb FROM steps s LEFT JOIN subjects j ON s.subject_id = j.subject_id "
+                 f"WHERE {LATEST_STEPS}")
+        params = ()
+        if subject_id:
+            query += " AND s.subject_id = ?"
+            params = (subject_id,)
+        return self.conn.execute(query + " ORDER BY s.subject_id, s.start", params).fetchall()
+
+    def subject_totals(self):
+        """Return (subject_id, site, wall seconds, cpu seconds, max RSS KB) for every subject with finished steps."""
+        return self.conn.execute(
+            "SELECT s.subject_id, COALESCE(j.site, 'unknown'), SUM(s.end - s.start), SUM(s.cpu_seconds), "
+            "MAX(s.max_rss_kb) FROM steps s LEFT JOIN subjects j ON s.subject_id = j.subject_id "
+            f"WHERE {LATEST_STEPS} GROUP BY s.subject_id ORDER BY s.subject_id").fetchall()
+
+    def record_job(self, subject_id, host, threads, start, end, exit_code, totals, steps):
+        """
+        Store a recon-all job sampled by resource_sampler.py
+
+        :param totals: dict with cpu_seconds, peak_rss_kb, read_bytes and write_bytes of the job
+        :param steps: Dictionary mapping recon-all step to a dict like totals
+        :return: Job ID
+        """
+        columns = ('cpu_seconds', 'peak_rss_kb', 'read_bytes', 'write_bytes')
+        with self.conn:
+            cursor = self.conn.execute(
+                "INSERT INTO jobs (subject_id, host, threads, start, end, exit_code, cpu_seconds, peak_rss_kb, "
+                "read_bytes, write_bytes) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (subject_id, host, threads, start, end, exit_code) + tuple(totals[c] for c in columns))
+            self.conn.executemany(
+                "INSERT INTO job_steps (job_id, step, cpu_seconds, peak_rss_kb, read_bytes, write_bytes) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(cursor.lastrowid, step) + tuple(values[c] for c in columns) for step, values in steps.items()])
+        return cursor.lastrowid
+
+    def job_peaks(self, subject_id=None):
+        """Peak RSS in KB of every sampled job, optionally of one subject only."""
+        query = "SELECT peak_rss_kb FROM jobs WHERE peak_rss_kb > 0"
+        params = ()
+        if subject_id:
+            query += " AND subject_id = ?"
+            params = (subject_id,)
+        return [row[0] for row in self.conn.execute(query, params)]
+
+    def job_step_resources(self):
+        """Return (step, cpu seconds, peak RSS KB, read bytes, write bytes) of every step of the sampled jobs."""
+        return self.conn.execute(
+            "SELECT step, cpu_seconds, peak_rss_kb, read_bytes, write_bytes FROM job_steps").fetchall()
+
+    def export_prometheus(self, output_path):
+        """
+        Write metrics in the Prometheus node_exporter textfile format (atomically)
+
+        Per-step metrics are aggregated over subjects to keep the number of series small.
+        """
+        by_step = defaultdict(lambda: [0, 0.0, 0.0])
+        for _, _, step, duration, cpu, _ in self.step_durations():
+            by_step[step][0] += 1
+            by_step[step][1] += duration
+            by_step[step][2] += cpu
+
+        lines = [
+            "# HELP reconall_step_duration_seconds_sum Total wall-clock time spent in a recon-all step",
+            "# TYPE reconall_step_duration_seconds_sum gauge",
+        ]
+        lines += [f'reconall_step_duration_seconds_sum{{step="{s}"}} {v[1]:.1f}' for s, v in sorted(by_step.items())]
+        lines += [
+            "# HELP reconall_step_cpu_seconds_sum Total CPU time spent in a recon-all step",
+            "# TYPE reconall_step_cpu_seconds_sum gauge",
+        ]
+        lines += [f'reconall_step_cpu_seconds_sum{{step="{s}"}} {v[2]:.1f}' for s, v in sorted(by_step.items())]
+        lines += [
+            "# HELP reconall_step_count Number of subjects that completed a recon-all step",
+            "# TYPE reconall_step_count gauge",
+        ]
+        lines += [f'reconall_step_count{{step="{s}"}} {v[0]}' for s, v in sorted(by_step.items())]
+        lines += [
+            "# HELP reconall_subject_duration_seconds Wall-clock time of all finished steps of a subject",
+            "# TYPE reconall_subject_duration_seconds gauge",
+        ]
+        totals = self.subject_totals()
+        lines += [f'reconall_subject_duration_seconds{{subject="{s}",site="{site}"}} {wall:.1f}'
+                  for s, site, wall, _, _ in totals]
+        lines += [
+            "# HELP reconall_subject_cpu_seconds CPU time of all finished steps of a subject",
+            "# TYPE reconall_subject_cpu_seconds gauge",
+        ]
+        lines += [f'reconall_subject_cpu_seconds{{subject="{s}",site="{site}"}} {cpu:.1f}'
+                  for s, site, _, cpu, _ in totals]
+
+        tmp_path = output_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, output_path)
+
+    def export_site_summary(self, output_path):
+        """
+        Write a CSV with per-site percentiles of wall-clock hours and CPU hours, per step and in total
+        """
+        groups = defaultdict(lambda: ([], []))
+        for _, site, step, duration, cpu, _ in self.step_durations():
+            groups[(site, step)][0].append(duration / 3600)
+            groups[(site, step)][1].append(cpu / 3600)
+        for _, site, wall, cpu, _ in self.subject_totals():
+            groups[(site, 'total')][0].append(wall / 3600)
+            groups[(site, 'total')][1].append(cpu / 3600)
+
+        header = ['site', 'step', 'n_subjects']
+        header += [f'wall_hours_p{q}' for q in SUMMARY_PERCENTILES]
+        header += [f'cpu_hours_p{q}' for q in SUMMARY_PERCENTILES]
+        with open(output_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            for (site, step), (wall_hours, cpu_hours) in sorted(groups.items()):
+                row = [site, step, len(wall_hours)]
+                row += [f"{percentile(wall_hours, q):.4f}" for q in SUMMARY_PERCENTILES]
+                row += [f"{percentile(cpu_hours, q):.4f}" for q in SUMMARY_PERCENTILES]
+                writer.writerow(row)
+
+
+def load_sites(phenotype_csv):
+    """
+    Map zero-padded subject IDs to their acquisition site (source_folder column)
+
+    :param phenotype_csv: CSV with participant_id and source_folder columns, e.g. data/full_dataset.csv
+    """
+    sites = {}
+    with open(phenotype_csv, 'r', newline='') as f:
+        for row in csv.DictReader(f):
+            pid_str = str(row.get('participant_id', '')).replace('sub-', '')
+            try:
+                subject_id = f"sub-{int(pid_str):07d}"
+            except ValueError:
+                subject_id = f"sub-{pid_str}"
+            sites[subject_id] = row.get('source_folder') or None
+    return sites
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Collect per-step timing metrics from recon-all logs')
+    parser.add_argument('--subjects-dir', required=True, help='FreeSurfer SUBJECTS_DIR')
+    parser.add_argument('--db', default=None, help='SQLite metrics database (default: <subjects-dir>/metrics.db)')
+    parser.add_argument('--phenotype', default=None,
+                        help='CSV with participant_id and source_folder used for per-site summaries')
+    parser.add_argument('--prometheus', default=None, help='Write a Prometheus textfile to this path')
+    parser.add_argument('--summary', default=None, help='Write a per-site percentile CSV to this path')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    store = MetricsStore(args.db or os.path.join(args.subjects_dir, 'metrics.db'))
+    site_map = load_sites(args.phenotype) if args.phenotype else None
+    n_read = store.ingest_subjects_dir(args.subjects_dir, site_map)
+    logging.info(f"Read {n_read} recon-all logs")
+
+    if args.prometheus:
+        store.export_prometheus(args.prometheus)
+        logging.info(f"Prometheus metrics saved to {args.prometheus}")
+    if args.summary:
+        store.export_site_summary(args.summary)
+        logging.info(f"Per-site summary saved to {args.summary}")
+    store.close()
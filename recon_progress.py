@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+import argparse
+import datetime
+import heapq
+import json
+import logging
+import os
+import sys
+import time
+from collections import defaultdict
+
+from recon_metrics import MetricsStore, parse_log_date, percentile
+
+# Steps of recon-all -all as written to recon-all-status.log, with typical single-threaded wall-clock
+# minutes. Used for the remaining work of a subject until the metrics database or finished
+# subjects of the current run provide measured durations.
+DEFAULT_STEP_MINUTES = {
+    'MotionCor': 1, 'Talairach': 2, 'Talairach Failure Detection': 0.2, 'Nu Intensity Correction': 2,
+    'Intensity Normalization': 1, 'Skull Stripping': 5, 'EM Registration': 10, 'CA Normalize': 1,
+    'CA Reg': 60, 'SubCort Seg': 20, 'Merge ASeg': 0.5, 'Intensity Normalization2': 2, 'Mask BFS': 0.2,
+    'WM Segmentation': 1, 'Fill': 1,
+    'Tessellate lh': 1, 'Smooth1 lh': 0.2, 'Inflation1 lh': 1, 'QSphere lh': 5, 'Fix Topology lh': 15,
+    'White Surf lh': 5, 'Smooth2 lh': 0.2, 'Inflation2 lh': 1, 'Sphere lh': 20, 'Surf Reg lh': 30,
+    'Cortical Parc lh': 1, 'Pial Surf lh': 10, 'Parcellation Stats lh': 1, 'BA_exvivo Labels lh': 10,
+    'Tessellate rh': 1, 'Smooth1 rh': 0.2, 'Inflation1 rh': 1, 'QSphere rh': 5, 'Fix Topology rh': 15,
+    'White Surf rh': 5, 'Smooth2 rh': 0.2, 'Inflation2 rh': 1, 'Sphere rh': 20, 'Surf Reg rh': 30,
+    'Cortical Parc rh': 1, 'Pial Surf rh': 10, 'Parcellation Stats rh': 1, 'BA_exvivo Labels rh': 10,
+    'Cortical ribbon mask': 5, 'AParc-to-ASeg aparc': 5, 'ASeg Stats': 2,
+}
+
+STATUS_FILE = 'progress.json'
+
+
+class LogTail:
+    """Read the lines appended to a file since the last call, from a saved byte offset."""
+
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+
+    def read_lines(self):
+        """
+        :return: Tuple of (complete new lines, True if the file was truncated or replaced since the last call)
+        """
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return [], False
+        truncated = size < self.offset
+        if truncated:
+            self.offset = 0
+        if size == self.offset:
+            return [], truncated
+
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read(size - self.offset)
+        # A partial last line is read again once it is complete
+        end = data.rfind(b'\n')
+        if end < 0:
+            return [], truncated
+        self.offset += end + 1
+        return data[:end + 1].decode('utf-8', errors='replace').splitlines(), truncated
+
+
+class SubjectProgress:
+    """Steps of one subject parsed from its recon-all-status.log."""
+
+    def __init__(self, subject_id, status_log):
+        self.subject_id = subject_id
+        self.tail = LogTail(status_log)
+        self.reset()
+
+    def reset(self):
+        self.steps_done = []
+        self.step = None
+        self.step_start = None
+        self.start = None
+        self.finished = False
+
+    def update(self):
+        """
+        Consume new log lines
+
+        :return: List of (step, seconds) for the steps that finished since the last call
+        """
+        lines, truncated = self.tail.read_lines()
+        if truncated:
+            logging.info(f"{self.tail.path} was truncated, following the new run")
+            self.reset()
+
+        finished_steps = []
+        for line in lines:
+            if line.startswith('#@#%#'):
+                if 'recon-all done' in line:
+                    self.finished = True
+                continue
+            if not line.startswith('#@# '):
+                continue
+            tokens = line.split()
+            timestamp, n_date_tokens = parse_log_date(tokens)
+            if timestamp is None:
+                continue
+            if self.step is not None:
+                self.steps_done.append(self.step)
+                finished_steps.append((self.step, timestamp - self.step_start))
+            self.step = ' '.join(tokens[1:len(tokens) - n_date_tokens])
+            self.step_start = timestamp
+            if self.start is None:
+                self.start = timestamp
+        return finished_steps
+
+
+def load_step_history(db_path):
+    """
+    Return measured step durations from a recon_metrics.py database
+
+    :return: Dictionary mapping step name to a list of durations in seconds
+    """
+    history = defaultdict(list)
+    if db_path and os.path.isfile(db_path):
+        store = MetricsStore(db_path)
+        for _, _, step, duration, _, _ in store.step_durations():
+            history[step].append(duration)
+        store.close()
+    return history
+
+
+def format_duration(seconds):
+    """Format seconds as e.g. 3h07m, 12m or 45s."""
+    if seconds is None:
+        return '-'
+    seconds = int(max(seconds, 0))
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m"
+    return f"{seconds}s"
+
+
+class ProgressMonitor:
+    """
+    Follow the recon-all runs of a batch and estimate when each subject and the batch will finish.
+
+    Every poll reads only the bytes appended to each recon-all-status.log since the previous
+    poll. The expected duration of a step is the median of its measured durations (metrics
+    database plus steps finished during this run), falling back to DEFAULT_STEP_MINUTES.
+    """
+
+    def __init__(self, subjects_dir, subject_ids=None, jobs=1, history=None):
+        """
+        :param subjects_dir: FreeSurfer SUBJECTS_DIR
+        :param subject_ids: Subjects of the batch in processing order (default: subjects found in subjects_dir)
+        :param jobs: Number of subjects processed at the same time, for the batch ETA
+        :param history: Dictionary mapping step name to durations in seconds, e.g. from load_step_history
+        """
+        self.subjects_dir = subjects_dir
+        self.subject_ids = list(subject_ids) if subject_ids else None
+        self.jobs = max(1, jobs)
+        self.history = defaultdict(list, {step: list(d) for step, d in (history or {}).items()})
+        # Steps every subject goes through: those of past runs if there are any, in the order they ran
+        self.plan = list(self.history) or list(DEFAULT_STEP_MINUTES)
+        self.subjects = {}
+
+    def _subject_ids(self):
+        if self.subject_ids is not None:
+            return self.subject_ids
+        return sorted(
+            s for s in os.listdir(self.subjects_dir)
+            if os.path.isdir(os.path.join(self.subjects_dir, s, 'scripts'))
+        )
+
+    def poll(self):
+        """Read new log lines of every subject."""
+        for subject_id in self._subject_ids():
+            if subject_id not in self.subjects:
+                status_log = os.path.join(self.subjects_dir, subject_id, 'scripts', 'recon-all-status.log')
+                self.subjects[subject_id] = SubjectProgress(subject_id, status_log)
+            for step, seconds in self.subjects[subject_id].update():
+                self.history[step].append(seconds)
+                if step not in self.plan:
+                    self.plan.append(step)
+
+    def expected_steps(self):
+        """Return the expected seconds of every step: the measured median or the default."""
+        expected = {step: minutes * 60 for step, minutes in DEFAULT_STEP_MINUTES.items()}
+        for step, durations in self.history.items():
+            if durations:
+                expected[step] = percentile(durations, 50)
+        return expected
+
+    def subject_status(self, subject_id):
+        """Return queued, running, done or error from the log and the markers recon-all writes."""
+        scripts_dir = os.path.join(self.subjects_dir, subject_id, 'scripts')
+        progress = self.subjects.get(subject_id)
+        if os.path.isfile(os.path.join(scripts_dir, 'recon-all.error')):
+            return 'error'
+        if (progress and progress.finished) or os.path.isfile(os.path.join(scripts_dir, 'recon-all.done')):
+            return 'done'
+        if progress and progress.step is not None:
+            return 'running'
+        return 'queued'
+
+    def status(self, now=None):
+        """
+        Estimate per-subject and batch progress
+
+        :param now: Current epoch seconds (default: time.time())
+        :return: JSON-serializable dictionary with a row per subject and a batch summary
+        """
+        now = time.time() if now is None else now
+        expected = self.expected_steps()
+        planned = self.plan
+        total_seconds = sum(expected[step] for step in planned)
+
+        rows = []
+        running_remaining = []
+        queued = []
+        for subject_id in self._subject_ids():
+            progress = self.subjects.get(subject_id)
+            status = self.subject_status(subject_id)
+            row = {'subject_id': subject_id, 'status': status, 'step': None, 'steps_done': 0,
+                   'steps_total': len(planned), 'percent': 0.0, 'elapsed_seconds': None, 'eta_seconds': None}
+
+            if progress and progress.step is not None:
+                row['step'] = progress.step
+                row['steps_done'] = len(set(progress.steps_done) & set(planned))
+                # Finished runs are timed up to their last step marker
+                end = now if status == 'running' else progress.step_start
+                row['elapsed_seconds'] = round(end - progress.start)
+
+            if status == 'running':
+                done = set(progress.steps_done)
+                step_elapsed = now - progress.step_start
+                current = expected.get(progress.step, 0.0)
+                remaining = sum(expected[step] for step in planned if step not in done and step != progress.step)
+                remaining += max(current - step_elapsed, 0.0)
+                row['eta_seconds'] = round(remaining)
+                row['percent'] = round(100.0 * (1 - remaining / total_seconds), 1) if total_seconds else 0.0
+                running_remaining.append(remaining)
+            elif status == 'done':
+                row['percent'] = 100.0
+                row['steps_done'] = len(planned)
+                row['eta_seconds'] = 0
+            elif status == 'queued':
+                row['eta_seconds'] = round(total_seconds)
+                queued.append(subject_id)
+            rows.append(row)
+
+        # List scheduling: queued subjects start, in order, on the first slot to free up
+        slots = sorted(running_remaining)
+        slots += [0.0] * max(self.jobs - len(slots), 0)
+        heapq.heapify(slots)
+        for _ in queued:
+            heapq.heappush(slots, heapq.heappop(slots) + total_seconds)
+        batch_eta = max(slots) if (running_remaining or queued) else 0.0
+
+        counts = defaultdict(int)
+        for row in rows:
+            counts[row['status']] += 1
+        return {
+            'updated': datetime.datetime.fromtimestamp(now).isoformat(timespec='seconds'),
+            'subjects_dir': self.subjects_dir,
+            'jobs': self.jobs,
+            'batch': {
+                'subjects': len(rows),
+                'queued': counts['queued'],
+                'running': counts['running'],
+                'done': counts['done'],
+                'error': counts['error'],
+                'eta_seconds': round(batch_eta),
+                'eta': datetime.datetime.fromtimestamp(now + batch_eta).isoformat(timespec='minutes'),
+            },
+            'subjects': rows,
+        }
+
+
+def write_status(status, path):
+    """Write the status dictionary to a JSON file atomically."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(status, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def render(status, show_all=False):
+    """
+    Format the status as a terminal table; only running and failed subjects unless show_all
+
+    :return: String
+    """
+    batch = status['batch']
+    lines = [
+        f"{status['updated']}  {batch['subjects']} subjects: {batch['running']} running, {batch['queued']} queued, "
+        f"{batch['done']} done, {batch['error']} failed  (jobs: {status['jobs']})",
+        f"Batch ETA: {format_duration(batch['eta_seconds'])} ({batch['eta']})",
+        '',
+        f"{'subject':<14} {'status':<8} {'step':<28} {'steps':>7} {'%':>6} {'elapsed':>8} {'ETA':>8}",
+    ]
+    for row in status['subjects']:
+        if not show_all and row['status'] not in ('running', 'error'):
+            continue
+        steps = f"{row['steps_done']}/{row['steps_total']}"
+        lines.append(f"{row['subject_id']:<14} {row['status']:<8} {(row['step'] or '-')[:28]:<28} {steps:>7} "
+                     f"{row['percent']:>6.1f} {format_duration(row['elapsed_seconds']):>8} "
+                     f"{format_duration(row['eta_seconds']):>8}")
+    return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Live progress and ETA of recon-all runs')
+    parser.add_argument('--subjects-dir', required=True, help='FreeSurfer SUBJECTS_DIR')
+    parser.add_argument('--subjects', default=None,
+                        help='File with the subject IDs of the batch in processing order, so queued subjects '
+                             'count towards the ETA (default: subjects already in --subjects-dir)')
+    parser.add_argument('-p', '--parallel', type=int, default=1,
+                        help='Subjects processed at the same time (default: 1)')
+    parser.add_argument('--db', default=None,
+                        help='recon_metrics.py database with past step durations '
+                             '(default: <subjects-dir>/metrics.db if it exists)')
+    parser.add_argument('--status-file', default=None,
+                        help=f'JSON status written on every update (default: <subjects-dir>/{STATUS_FILE})')
+    parser.add_argument('--interval', type=float, default=30, help='Seconds between updates (default: 30)')
+    parser.add_argument('--once', action='store_true', help='Print one update and exit')
+    parser.add_argument('--all', action='store_true', help='List queued and finished subjects too')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    batch_ids = None
+    if args.subjects:
+        with open(args.subjects, 'r') as f:
+            batch_ids = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    monitor = ProgressMonitor(args.subjects_dir, batch_ids, args.parallel,
+                              load_step_history(args.db or os.path.join(args.subjects_dir, 'metrics.db')))
+    status_path = args.status_file or os.path.join(args.subjects_dir, STATUS_FILE)
+
+    try:
+        while True:
+            monitor.poll()
+            current = monitor.status()
+            write_status(current, status_path)
+            if sys.stdout.isatty() and not args.once:
+                # Redraw in place
+                print('\033[2J\033[H', end='')
+            print(render(current, args.all), flush=True)
+            if args.once or (current['batch']['running'] == 0 and current['batch']['queued'] == 0):
+                break
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+    print(f"\nStatus saved to {status_path}")
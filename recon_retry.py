@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# Classifies failed recon-all runs from the end of their logs and plans a retry with the flags
+# that usually fix them, restarting at the autorecon stage that failed when the earlier stages
+# are unaffected. Attempts, flags and the reason of every failure are kept in
+# SUBJECTS_DIR/logs/retries.json, so a requeued subject is retried with what was learned so far
+# and given up after a fixed number of attempts.
+import argparse
+import datetime
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+
+from recon_metrics import INVOCATION_MARKER
+from recon_progress import SubjectProgress
+
+RETRY_FILE = 'retries.json'
+DEFAULT_MAX_ATTEMPTS = 3
+
+# Only the end of the last run in recon-all.log is searched, since a healthy run mentions
+# talairach, ventricles etc. and reruns are appended to the same log.
+LOG_TAIL_BYTES = 64 * 1024
+LOG_TAIL_LINES = 60
+
+# Steps of recon-all-status.log per autorecon stage; the steps not listed belong to autorecon2
+AUTORECON1_STEPS = {'MotionCor', 'Talairach', 'Talairach Failure Detection', 'Nu Intensity Correction',
+                    'Intensity Normalization', 'Skull Stripping'}
+AUTORECON3_PREFIXES = ('Sphere', 'Surf Reg', 'Jacobian', 'AvgCurv', 'Cortical Parc', 'Pial Surf', 'Curv .H',
+                       'Parcellation Stats', 'Cortical ribbon', 'Hyper/Hypo', 'Relabel Hypointensities',
+                       'APas-to-ASeg', 'AParc-to-ASeg', 'ASeg Stats', 'WMParc', 'BA_exvivo', 'Pctsurfcon')
+STAGES = ('autorecon1', 'autorecon2', 'autorecon3')
+# recon-all arguments that run a stage and everything after it
+STAGE_ARGS = {'autorecon1': ['-all'], 'autorecon2': ['-autorecon2', '-autorecon3'], 'autorecon3': ['-autorecon3']}
+
+# Known failures, tried in order. A rule matches on the step that failed or on its pattern in the
+# log tail; it adds flags, can lower the OpenMP threads and can force an earlier restart stage.
+FAILURE_RULES = [
+    {'reason': 'out-of-memory', 'steps': (), 'exit_codes': (137, -9),
+     'pattern': r'\bKilled\b|Cannot allocate memory|std::bad_alloc|[Oo]ut of memory',
+     'flags': [], 'threads': 1, 'stage': None},
+    {'reason': 'large-fov', 'steps': (), 'exit_codes': (),
+     'pattern': r'-cw256|(?:FOV|field of view|dimension)[^\n]{0,80}256',
+     'flags': ['-cw256'], 'threads': None, 'stage': 'autorecon1'},
+    {'reason': 'talairach-check', 'steps': ('Talairach Failure Detection',), 'exit_codes': (),
+     'pattern': r'talairach_afd[^\n]*FAILED',
+     'flags': ['-notal-check'], 'threads': None, 'stage': 'autorecon1'},
+    {'reason': 'talairach', 'steps': ('Talairach',), 'exit_codes': (),
+     'pattern': r'talairach_avi[^\n]*fail|Talairach failed',
+     'flags': ['-use-mritotal'], 'threads': None, 'stage': 'autorecon1'},
+    {'reason': 'big-ventricles', 'steps': ('CA Reg', 'SubCort Seg'), 'exit_codes': (),
+     'pattern': r'bigventricles|mri_ca_(?:register|label)[^\n]*(?:ERROR|fail)',
+     'flags': ['-bigventricles'], 'threads': None, 'stage': 'autorecon2'},
+]
+
+
+def read_log_tail(path, n_bytes=LOG_TAIL_BYTES, n_lines=LOG_TAIL_LINES):
+    """Last lines of the last recon-all run in a log file, or an empty string if it does not exist."""
+    try:
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - n_bytes))
+            data = f.read()
+    except OSError:
+        return ''
+    text = data.decode('utf-8', errors='replace')
+    start = text.rfind(INVOCATION_MARKER)
+    if start >= 0:
+        text = text[start:]
+    return '\n'.join(text.splitlines()[-n_lines:])
+
+
+def failed_step(subject_dir):
+    """Last step recon-all started according to recon-all-status.log, or None."""
+    progress = SubjectProgress(os.path.basename(subject_dir),
+                               os.path.join(subject_dir, 'scripts', 'recon-all-status.log'))
+    progress.update()
+    return progress.step
+
+
+def step_stage(step):
+    """autorecon stage of a recon-all-status.log step (autorecon1 when unknown)."""
+    if step is None or step in AUTORECON1_STEPS:
+        return 'autorecon1'
+    if step.startswith(AUTORECON3_PREFIXES):
+        return 'autorecon3'
+    return 'autorecon2'
+
+
+def classify_failure(subject_dir, log_path=None, exit_code=None):
+    """
+    Recognize why a recon-all run failed
+
+    :param subject_dir: SUBJECTS_DIR/<subject>
+    :param log_path: Captured output of the run (searched when scripts/recon-all.log is missing)
+    :param exit_code: Exit code of recon-all
+    :return: dict with reason ('unknown' if no rule matches), step, stage, flags and threads
+    """
+    step = failed_step(subject_dir)
+    tail = read_log_tail(os.path.join(subject_dir, 'scripts', 'recon-all.log'))
+    if not tail and log_path:
+        tail = read_log_tail(log_path)
+
+    classification = {'reason': 'unknown', 'step': step, 'stage': step_stage(step), 'flags': [], 'threads': None}
+    for rule in FAILURE_RULES:
+        if (step in rule['steps'] or exit_code in rule['exit_codes']
+                or re.search(rule['pattern'], tail)):
+            classification.update(reason=rule['reason'], flags=list(rule['flags']), threads=rule['threads'])
+            if rule['stage'] and STAGES.index(rule['stage']) < STAGES.index(classification['stage']):
+                classification['stage'] = rule['stage']
+            break
+    return classification
+
+
+def is_imported(subject_dir):
+    """True once recon-all copied the input volume, so a retry can run without -i."""
+    return os.path.isfile(os.path.join(subject_dir, 'mri', 'orig', '001.mgz'))
+
+
+def retry_args(subject_dir, subject_id, t1_path, stage, flags):
+    """
+    recon-all arguments (without -openmp) that rerun a subject from stage with flags
+
+    A subject that failed before its input was imported is removed and started from scratch,
+    as recon-all refuses -i for an existing subject.
+    """
+    if not is_imported(subject_dir):
+        if os.path.isdir(subject_dir):
+            shutil.rmtree(subject_dir)
+        return ['-subject', subject_id, '-i', t1_path, '-all'] + flags
+    return ['-subject', subject_id] + STAGE_ARGS[stage] + flags
+
+
+class RetryState:
+    """Attempts and accumulated remedies per subject, in SUBJECTS_DIR/logs/retries.json."""
+
+    def __init__(self, subjects_dir, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.subjects_dir = subjects_dir
+        self.max_attempts = max_attempts
+        self.path = os.path.join(subjects_dir, 'logs', RETRY_FILE)
+        self.lock = threading.Lock()
+        self.subjects = {}
+        if os.path.isfile(self.path):
+            with open(self.path, 'r') as f:
+                self.subjects = json.load(f)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.subjects, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def record_failure(self, subject_id, t1_path, exit_code, log_path=None, threads=1, more_memory=False):
+        """
+        Classify a failed attempt and plan the next one
+
+        An out-of-memory failure is only retried when the next run differs: fewer threads, or
+        more_memory when the caller will set aside more memory for it.
+
+        :return: The planned retry {'args', 'threads', 'reason'}, or None if the subject is given up
+        """
+        with self.lock:
+            entry = self.subjects.setdefault(subject_id, {'attempts': 0, 'flags': [], 'history': [], 'next': None})
+            subject_dir = os.path.join(self.subjects_dir, subject_id)
+            classification = classify_failure(subject_dir, log_path, exit_code)
+            entry['attempts'] += 1
+            entry['history'].append({
+                'time': datetime.datetime.now().isoformat(timespec='seconds'),
+                'exit_code': exit_code,
+                'reason': classification['reason'],
+                'step': classification['step'],
+            })
+
+            new_flags = [flag for flag in classification['flags'] if flag not in entry['flags']]
+            lower_threads = classification['threads'] is not None and classification['threads'] < threads
+            more_memory = more_memory and classification['reason'] == 'out-of-memory'
+            retry = None
+            if entry['attempts'] >= self.max_attempts:
+                logging.error(f"{subject_id} failed {entry['attempts']} times ({classification['reason']}), giving up")
+            elif classification['reason'] == 'unknown':
+                logging.error(f"{subject_id} failed at {classification['step'] or 'start'} for an unknown reason")
+            elif not new_flags and not lower_threads and not more_memory:
+                logging.error(f"{subject_id} failed again ({classification['reason']}) with "
+                              f"{' '.join(entry['flags']) or 'no extra flags'} and nothing else to change, giving up")
+            elif t1_path is None and not is_imported(subject_dir):
+                logging.error(f"{subject_id} failed before importing its input and no T1 image was given")
+            else:
+                entry['flags'] += new_flags
+                retry = {
+                    'args': retry_args(subject_dir, subject_id, t1_path, classification['stage'], entry['flags']),
+                    'threads': classification['threads'] if lower_threads else threads,
+                    'reason': classification['reason'],
+                }
+                logging.info(f"Requeueing {subject_id} ({classification['reason']} at "
+                             f"{classification['step'] or 'start'}): recon-all {' '.join(retry['args'])}")
+            entry['next'] = retry
+            self.save()
+            return retry
+
+    def pending(self, subject_id):
+        """Planned retry of a subject, or None."""
+        with self.lock:
+            return self.subjects.get(subject_id, {}).get('next')
+
+    def record_success(self, subject_id):
+        with self.lock:
+            if subject_id in self.subjects:
+                self.subjects[subject_id]['next'] = None
+                self.subjects[subject_id]['succeeded'] = True
+                self.save()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Classify failed recon-all runs and show planned retries')
+    parser.add_argument('--subjects-dir', required=True, help='FreeSurfer SUBJECTS_DIR')
+    parser.add_argument('subjects', nargs='*',
+                        help='Subjects to classify (default: every subject with scripts/recon-all.error)')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    subject_ids = args.subjects or sorted(
+        s for s in os.listdir(args.subjects_dir)
+        if os.path.isfile(os.path.join(args.subjects_dir, s, 'scripts', 'recon-all.error'))
+    )
+    retry_state = RetryState(args.subjects_dir)
+    for failed_id in subject_ids:
+        result = classify_failure(os.path.join(args.subjects_dir, failed_id),
+                                  os.path.join(args.subjects_dir, 'logs', f"{failed_id}_recon-all.log"))
+        remedy = ' '.join(result['flags'] + (['-openmp 1'] if result['threads'] else [])) or '-'
+        state = retry_state.subjects.get(failed_id, {})
+        print(f"{failed_id}: {result['reason']} at {result['step'] or 'start'} ({result['stage']}), "
+              f"remedy: {remedy}, attempts: {state.get('attempts', 0)}")
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+import argparse
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from freesurfer_stats import write_feature_table
+from volume_cache import DEFAULT_BUDGET_GB, configure as configure_volume_cache, load_mgh
+from volume_io import label_name
+
+# Intensity volumes summarized within every aparc+aseg label
+INTENSITY_VOLUMES = ('T1', 'brainmask')
+
+PERCENTILES = (10, 50, 90)
+
+# Histogram bins over the 0-255 range of conformed volumes, used for the intensity entropy
+ENTROPY_BINS = 16
+
+
+def group_percentiles(values, groups, counts, percentiles):
+    """
+    Percentiles of values within each group from one sort (linear interpolation, as np.percentile)
+
+    :param values: 1D array
+    :param groups: Group index (0..n_groups-1) of every value
+    :param counts: Number of values per group (all > 0)
+    :param percentiles: Percentiles in 0-100
+    :return: Array (n_groups, len(percentiles))
+    """
+    order = np.lexsort((values, groups))
+    sorted_values = values[order]
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+    result = np.empty((len(counts), len(percentiles)))
+    for k, q in enumerate(percentiles):
+        lower, upper, fraction = _percentile_positions(counts, q)
+        result[:, k] = sorted_values[starts + lower] * (1 - fraction) + sorted_values[starts + upper] * fraction
+    return result
+
+
+def histogram_percentiles(histogram, counts, percentiles):
+    """
+    Same as group_percentiles for integer values 0..n_bins-1, from a (group x value) histogram
+
+    :param histogram: Array (n_groups, n_bins) of value counts per group
+    :param counts: Number of values per group (all > 0)
+    :param percentiles: Percentiles in 0-100
+    :return: Array (n_groups, len(percentiles))
+    """
+    cumulative = np.cumsum(histogram, axis=1)
+
+    def value_at(rank):
+        # Smallest value whose cumulative count exceeds the 0-based rank
+        return (cumulative <= rank[:, None]).sum(axis=1)
+
+    result = np.empty((len(counts), len(percentiles)))
+    for k, q in enumerate(percentiles):
+        lower, upper, fraction = _percentile_positions(counts, q)
+        result[:, k] = value_at(lower) * (1 - fraction) + value_at(upper) * fraction
+    return result
+
+
+def _percentile_positions(counts, q):
+    """Return the lower and upper 0-based ranks and interpolation fraction of percentile q."""
+    position = (counts - 1) * (q / 100.0)
+    lower = np.floor(position).astype(np.int64)
+    upper = np.minimum(lower + 1, counts - 1)
+    return lower, upper, position - lower
+
+
+def group_statistics(values, groups, n_groups, counts, gradient):
+    """
+    Mean, std, percentiles, histogram entropy and mean gradient magnitude per group
+
+    uint8 volumes (conformed T1, brainmask) are summarized from one (group x intensity)
+    bincount; other types fall back to a sort for the percentiles.
+
+    :return: Dictionary mapping statistic name to an array of length n_groups
+    """
+    weights = values.astype(np.float64)
+    sums = np.bincount(groups, weights=weights, minlength=n_groups)
+    squares = np.bincount(groups, weights=weights * weights, minlength=n_groups)
+    mean = sums / counts
+    std = np.sqrt(np.maximum(squares / counts - mean * mean, 0.0))
+    stats = {'mean': mean, 'std': std}
+
+    if values.dtype == np.uint8:
+        intensity_histogram = np.bincount(groups * 256 + values, minlength=n_groups * 256).reshape(n_groups, 256)
+        percentiles = histogram_percentiles(intensity_histogram, counts, PERCENTILES)
+        histogram = intensity_histogram.reshape(n_groups, ENTROPY_BINS, 256 // ENTROPY_BINS).sum(axis=2)
+    else:
+        percentiles = group_percentiles(weights, groups, counts, PERCENTILES)
+        bins = np.clip((weights * ENTROPY_BINS / 256.0).astype(np.int64), 0, ENTROPY_BINS - 1)
+        histogram = np.bincount(groups * ENTROPY_BINS + bins,
+                                minlength=n_groups * ENTROPY_BINS).reshape(n_groups, ENTROPY_BINS)
+
+    for q, column in zip(PERCENTILES, percentiles.T):
+        stats[f"p{q}"] = column
+
+    # Entropy of the intensity distribution in ENTROPY_BINS bins over 0-255
+    probabilities = histogram / counts[:, None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        stats['entropy'] = -np.nansum(probabilities * np.log2(probabilities), axis=1)
+
+    stats['gradient'] = np.bincount(groups, weights=gradient, minlength=n_groups) / counts
+    return stats
+
+
+def extract_subject_regional(subject_dir):
+    """
+    Per-label voxel counts and intensity statistics of one processed subject
+
+    :param subject_dir: FreeSurfer subject directory with mri/aparc+aseg.mgz, T1.mgz and brainmask.mgz
+    :return: Feature row: {label}_voxels, {label}_volume and {label}_{volume}_{statistic}
+    """
+    mri_dir = os.path.join(subject_dir, 'mri')
+    labels, affine = load_mgh(os.path.join(mri_dir, 'aparc+aseg.mgz'))
+    voxel_volume = abs(np.linalg.det(affine[:3, :3]))
+
+    flat_labels = labels.ravel(order='F')
+    in_label = np.flatnonzero(flat_labels > 0)
+    label_counts = np.bincount(flat_labels[in_label])
+    present = np.flatnonzero(label_counts)
+    # Group index of every labelled voxel, without sorting
+    group_of_label = np.zeros(len(label_counts), dtype=np.int64)
+    group_of_label[present] = np.arange(len(present))
+    groups = group_of_label[flat_labels[in_label]]
+    counts = label_counts[present]
+    names = [label_name(int(label)) for label in present]
+
+    row = {'subject_id': os.path.basename(os.path.normpath(subject_dir))}
+    for name, count in zip(names, counts):
+        row[f"{name}_voxels"] = int(count)
+        row[f"{name}_volume"] = round(float(count * voxel_volume), 3)
+
+    for volume_name in INTENSITY_VOLUMES:
+        intensities, _ = load_mgh(os.path.join(mri_dir, f"{volume_name}.mgz"))
+        if intensities.shape[:3] != labels.shape[:3]:
+            raise ValueError(f"{volume_name}.mgz does not match aparc+aseg.mgz in {subject_dir}")
+
+        gradient = np.sqrt(sum(g * g for g in np.gradient(intensities.astype(np.float32))))
+        stats = group_statistics(intensities.ravel(order='F')[in_label], groups, len(present), counts,
+                                 gradient.ravel(order='F')[in_label])
+        for statistic, values in stats.items():
+            for name, value in zip(names, values):
+                row[f"{name}_{volume_name}_{statistic}"] = round(float(value), 4)
+    return row
+
+
+def extract_regional_features(subject_dirs, workers=4):
+    """
+    Run extract_subject_regional for many subjects in a process pool
+
+    :param subject_dirs: List of FreeSurfer subject directories
+    :param workers: Number of processes
+    :return: Tuple of (feature rows sorted by subject, failed subject directories)
+    """
+    rows = []
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(extract_subject_regional, d): d for d in subject_dirs}
+        for future in as_completed(futures):
+            try:
+                rows.append(future.result())
+            except Exception as e:
+                logging.error(f"Regional features failed for {futures[future]}: {e}")
+                failed.append(futures[future])
+
+    rows.sort(key=lambda row: row['subject_id'])
+    return rows, sorted(failed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Extract per-label voxel features from aparc+aseg and T1 volumes')
+    parser.add_argument('--subjects-dir', required=True, help='FreeSurfer SUBJECTS_DIR')
+    parser.add_argument('--output', default='./data/regional_features.csv',
+                        help='Output CSV (default: data/regional_features.csv)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 4,
+                        help='Subjects processed in parallel (default: number of CPUs)')
+    parser.add_argument('--cache-dir', default=None,
+                        help='Shared cache of decompressed volumes, reused across runs (see volume_cache.py)')
+    parser.add_argument('--cache-gb', type=float, default=DEFAULT_BUDGET_GB,
+                        help=f'Disk budget of the volume cache (default: {DEFAULT_BUDGET_GB})')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if args.cache_dir:
+        configure_volume_cache(args.cache_dir, args.cache_gb)
+
+    subjects = sorted(
+        s for s in os.listdir(args.subjects_dir)
+        if os.path.isfile(os.path.join(args.subjects_dir, s, 'mri', 'aparc+aseg.mgz'))
+    )
+    feature_rows, failed_subjects = extract_regional_features(
+        [os.path.join(args.subjects_dir, s) for s in subjects], args.workers)
+    write_feature_table(feature_rows, args.output)
+    print(f"Regional features for {len(feature_rows)} subjects saved to {args.output}")
+    if failed_subjects:
+        print(f"Failed subjects: {', '.join(failed_subjects)}")
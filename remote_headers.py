@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import logging
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+import pandas as pd
+from botocore.config import Config
+
+from data_organizer import format_participant_id
+from dedup_scans import scan_rank_key
+from nifti_header import NIFTI2_HEADER_SIZE, parse_nifti_header
+from s3_manifest import Manifest, is_manifest_db, subject_from_key
+
+# Bytes requested by the first ranged GET; a gzip stream of a NIfTI header almost always fits
+INITIAL_RANGE = 4096
+# Give up on an object after fetching this many bytes without inflating a complete header
+MAX_RANGE = 1024 * 1024
+GZIP_MAGIC = b'\x1f\x8b'
+
+# Columns added to the phenotype table, one row per participant
+PHENOTYPE_SCAN_COLUMNS = ['scan_key', 'scan_ndim', 'scan_nx', 'scan_ny', 'scan_nz', 'scan_nt',
+                          'scan_vx', 'scan_vy', 'scan_vz', 'scan_datatype']
+
+
+def split_s3_uri(s3_uri):
+    """Return (bucket, key) of an s3://bucket/key URI."""
+    if not s3_uri.startswith('s3://'):
+        raise ValueError(f"Not an S3 URI: {s3_uri}")
+    bucket, _, key = s3_uri[len('s3://'):].partition('/')
+    return bucket, key
+
+
+def fetch_range(s3_client, bucket, key, start, end):
+    """
+    Fetch bytes start..end (inclusive) of an object with a ranged GET
+
+    :return: Tuple of (data, total object size)
+    """
+    response = s3_client.get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-{end}")
+    data = response['Body'].read()
+    # Content-Range: bytes 0-4095/123456
+    content_range = response.get('ContentRange')
+    if content_range and '/' in content_range:
+        total = int(content_range.rsplit('/', 1)[1])
+    else:
+        # The server ignored the range and returned the whole object
+        total = response.get('ContentLength', len(data))
+    return data, total
+
+
+def read_remote_header(s3_client, bucket, key, initial_range=INITIAL_RANGE, max_range=MAX_RANGE):
+    """
+    Read the NIfTI header of an S3 object without downloading the image
+
+    The first initial_range bytes are fetched and, for .nii.gz objects, inflated only until
+    the 540 bytes of a NIfTI-2 header are available. Further ranges of doubling size are
+    fetched if the header is not complete yet.
+
+    :param s3_client: boto3 S3 client
+    :param bucket: Bucket name
+    :param key: Object key
+    :param initial_range: Size of the first ranged GET
+    :param max_range: Maximum number of bytes fetched before giving up
+    :return: Header dictionary from parse_nifti_header with 'bytes_fetched' added
+    """
+    inflater = None
+    header_bytes = b''
+    offset = 0
+    length = initial_range
+    total = None
+
+    while len(header_bytes) < NIFTI2_HEADER_SIZE:
+        if total is not None and offset >= total:
+            break
+        if offset >= max_range:
+            raise ValueError(f"No complete header within the first {max_range} bytes")
+
+        data, total = fetch_range(s3_client, bucket, key, offset, offset + length - 1)
+        if not data:
+            break
+        if offset == 0 and data[:2] == GZIP_MAGIC:
+            inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        offset += len(data)
+
+        if inflater is None:
+            header_bytes += data
+        else:
+            header_bytes += inflater.decompress(data, NIFTI2_HEADER_SIZE - len(header_bytes))
+            if inflater.eof:
+                break
+        length = min(length * 2, max_range)
+
+    header = parse_nifti_header(header_bytes)
+    header['bytes_fetched'] = offset
+    return header
+
+
+def inspect_objects(objects, s3_client=None, workers=32, suffix='.nii.gz'):
+    """
+    Read the headers of all NIfTI objects of a manifest concurrently
+
+    :param objects: Manifest entries with 'key' and 's3_uri'
+    :param s3_client: boto3 S3 client (default: a new client with a connection pool of size workers)
+    :param workers: Number of concurrent ranged GETs
+    :param suffix: Only objects whose key ends with this suffix are inspected
+    :return: Dictionary mapping key to header dictionary, or to {'error': message}
+    """
+    s3_client = s3_client or boto3.client('s3', config=Config(max_pool_connections=workers))
+    targets = [obj for obj in objects if obj['key'].endswith(suffix)]
+
+    def inspect(obj):
+        bucket, key = split_s3_uri(obj['s3_uri'])
+        try:
+            return obj['key'], read_remote_header(s3_client, bucket, key)
+        except Exception as e:
+            logging.warning(f"Could not read header of {obj['s3_uri']}: {e}")
+            return obj['key'], {'error': str(e)}
+
+    headers = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for key, header in executor.map(inspect, targets):
+            headers[key] = header
+
+    fetched = sum(h.get('bytes_fetched', 0) for h in headers.values())
+    failed = sum('error' in h for h in headers.values())
+    logging.info(f"Read {len(headers) - failed}/{len(headers)} headers, {fetched / 1024:.0f} KB fetched")
+    return headers
+
+
+def select_subject_scans(headers):
+    """
+    Pick the best readable scan per subject, ranked as in dedup_scans.py
+
+    :param headers: Dictionary from inspect_objects
+    :return: Dictionary mapping zero-padded subject ID to (key, header)
+    """
+    by_subject = {}
+    for key, header in headers.items():
+        subject_id = subject_from_key(key)
+        if subject_id is None or 'error' in header:
+            continue
+        by_subject.setdefault(subject_id, []).append((key, header))
+
+    return {subject_id: min(candidates, key=lambda c: scan_rank_key(c[0], c[1]))
+            for subject_id, candidates in by_subject.items()}
+
+
+def scan_columns(key, header):
+    """Flatten a header into the PHENOTYPE_SCAN_COLUMNS fields."""
+    shape = list(header['shape']) + [None] * 4
+    voxel_size = list(header['voxel_size']) + [None] * 3
+    return {
+        'scan_key': key,
+        'scan_ndim': len(header['shape']),
+        'scan_nx': shape[0],
+        'scan_ny': shape[1],
+        'scan_nz': shape[2],
+        'scan_nt': shape[3] if len(header['shape']) > 3 else 1,
+        'scan_vx': voxel_size[0],
+        'scan_vy': voxel_size[1],
+        'scan_vz': voxel_size[2],
+        'scan_datatype': header['datatype'],
+    }
+
+
+def attach_to_phenotype(phenotype_csv, headers, output_csv=None):
+    """
+    Add the PHENOTYPE_SCAN_COLUMNS of each participant's best scan to a phenotype table
+
+    :param phenotype_csv: CSV with a participant_id column (e.g. combined_participants_with_diagnosis.csv)
+    :param headers: Dictionary from inspect_objects
+    :param output_csv: Output path (default: overwrite phenotype_csv)
+    :return: Updated DataFrame
+    """
+    df = pd.read_csv(phenotype_csv)
+    selected = select_subject_scans(headers)
+
+    rows = []
+    for participant_id in df['participant_id']:
+        match = selected.get(format_participant_id(participant_id))
+        rows.append(scan_columns(*match) if match else {})
+    scan_df = pd.DataFrame(rows, columns=PHENOTYPE_SCAN_COLUMNS, index=df.index)
+    int_columns = ['scan_ndim', 'scan_nx', 'scan_ny', 'scan_nz', 'scan_nt']
+    scan_df[int_columns] = scan_df[int_columns].astype('Int64')
+
+    df = pd.concat([df.drop(columns=[c for c in PHENOTYPE_SCAN_COLUMNS if c in df.columns]), scan_df], axis=1)
+    df.to_csv(output_csv or phenotype_csv, index=False)
+    logging.info(f"Attached scan headers to {scan_df['scan_key'].notna().sum()}/{len(df)} participants")
+    return df
+
+
+def attach_to_manifest(manifest_path, headers):
+    """
+    Store headers in the manifest: a scan_headers table for SQLite manifests, or a
+    'nifti_header' field on each entry for s3_objects.json
+    """
+    if is_manifest_db(manifest_path):
+        manifest = Manifest(manifest_path)
+        manifest.set_scan_headers(headers)
+        manifest.close()
+        return
+
+    with open(manifest_path, 'r') as f:
+        objects = json.load(f)
+    for obj in objects:
+        if obj['key'] in headers:
+            obj['nifti_header'] = headers[obj['key']]
+    with open(manifest_path, 'w') as f:
+        json.dump(objects, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Read NIfTI headers of S3 objects with ranged GETs')
+    parser.add_argument('--manifest', default='./data/s3_objects.json',
+                        help='S3 object manifest, JSON or SQLite (default: data/s3_objects.json)')
+    parser.add_argument('--phenotype', default=None,
+                        help='Phenotype CSV to add scan columns to (e.g. combined_participants_with_diagnosis.csv)')
+    parser.add_argument('--phenotype-output', default=None, help='Output CSV (default: overwrite --phenotype)')
+    parser.add_argument('--prefix', default='', help='Only inspect keys under this prefix')
+    parser.add_argument('--workers', type=int, default=32, help='Concurrent ranged GETs (default: 32)')
+    parser.add_argument('--endpoint-url', default=None,
+                        help='Custom S3 endpoint, e.g. a local MinIO or moto server for testing')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    if is_manifest_db(args.manifest):
+        store = Manifest(args.manifest)
+        manifest_objects = store.by_prefix(args.prefix)
+        store.close()
+    else:
+        with open(args.manifest, 'r') as f:
+            manifest_objects = [obj for obj in json.load(f) if obj['key'].startswith(args.prefix)]
+
+    client = boto3.client('s3', endpoint_url=args.endpoint_url,
+                          config=Config(max_pool_connections=args.workers))
+    scan_headers = inspect_objects(manifest_objects, client, args.workers)
+    attach_to_manifest(args.manifest, scan_headers)
+    if args.phenotype:
+        attach_to_phenotype(args.phenotype, scan_headers, args.phenotype_output)
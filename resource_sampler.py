@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+# Samples the CPU time, resident memory and disk I/O of a running recon-all job by walking its
+# process tree in /proc at a fixed interval. Children that exit and are reaped have their CPU time
+# and I/O added to their parent by the kernel, so summing the counters of the live tree gives the
+# totals of the whole job. Usage between two samples is charged to the recon-all step the subject
+# was in (from recon-all-status.log). Finished jobs are stored in the recon_metrics.py database,
+# whose history predicts the peak memory of the next job so the launcher only starts what fits.
+import argparse
+import logging
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from recon_metrics import MetricsStore, percentile
+from recon_progress import SubjectProgress
+
+DEFAULT_INTERVAL = 5.0
+# Peak memory assumed for a recon-all job before there is any history
+DEFAULT_PEAK_GB = 4.0
+# Headroom added to the predicted peak
+MEMORY_MARGIN = 1.15
+# Past jobs needed before their percentile replaces DEFAULT_PEAK_GB
+MIN_HISTORY = 3
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+
+def _read(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read().decode('utf-8', errors='replace')
+    except OSError:
+        # The process exited or is not ours
+        return None
+
+
+def list_parents():
+    """Dictionary mapping the PID of every process to its parent PID."""
+    parents = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        stat = _read(f"/proc/{name}/stat")
+        if stat:
+            # The command name in parentheses may contain spaces
+            parents[int(name)] = int(stat[stat.rfind(')') + 2:].split()[1])
+    return parents
+
+
+def process_tree(root_pid):
+    """PIDs of a process and all its descendants."""
+    children = {}
+    for pid, ppid in list_parents().items():
+        children.setdefault(ppid, []).append(pid)
+    tree = []
+    stack = [root_pid]
+    while stack:
+        pid = stack.pop()
+        tree.append(pid)
+        stack.extend(children.get(pid, []))
+    return tree
+
+
+def read_process(pid):
+    """
+    Counters of one process from /proc
+
+    :return: dict with cpu_seconds (own and reaped children), rss_kb, read_bytes and write_bytes,
+             or None if the process is gone
+    """
+    stat = _read(f"/proc/{pid}/stat")
+    if stat is None:
+        return None
+    fields = stat[stat.rfind(')') + 2:].split()
+    # utime, stime, cutime, cstime are fields 14-17 of stat, 12-15 after the command name
+    cpu_ticks = sum(int(value) for value in fields[11:15])
+
+    rss_kb = 0
+    for line in (_read(f"/proc/{pid}/status") or '').splitlines():
+        if line.startswith('VmRSS:'):
+            rss_kb = int(line.split()[1])
+            break
+
+    io = {}
+    for line in (_read(f"/proc/{pid}/io") or '').splitlines():
+        key, _, value = line.partition(':')
+        io[key] = int(value)
+    return {
+        'cpu_seconds': cpu_ticks / CLOCK_TICKS,
+        'rss_kb': rss_kb,
+        'read_bytes': io.get('read_bytes', 0),
+        'write_bytes': io.get('write_bytes', 0),
+    }
+
+
+def sample_tree(root_pid):
+    """
+    Counters summed over a process tree
+
+    :return: dict like read_process, or None if the root process is gone
+    """
+    totals = None
+    for pid in process_tree(root_pid):
+        counters = read_process(pid)
+        if counters is None:
+            continue
+        if totals is None:
+            totals = dict.fromkeys(counters, 0)
+        for key, value in counters.items():
+            totals[key] += value
+    return totals
+
+
+def find_subjects_dir(root_pid):
+    """SUBJECTS_DIR in the environment of the process tree, deepest process first, or None."""
+    for pid in reversed(process_tree(root_pid)):
+        environ = _read(f"/proc/{pid}/environ")
+        for entry in (environ or '').split('\0'):
+            if entry.startswith('SUBJECTS_DIR='):
+                return entry[len('SUBJECTS_DIR='):]
+    return None
+
+
+class JobSampler:
+    """
+    Samples the process tree of one recon-all job in a background thread; use as a context manager
+
+    The subject folder is looked up in SUBJECTS_DIR of the job's processes, so jobs that run in
+    a scratch directory are followed too. Usage after the last sample before the job exits is
+    not seen, so the totals fall short by up to one interval.
+    """
+
+    def __init__(self, pid, subject_id, interval=DEFAULT_INTERVAL):
+        self.pid = pid
+        self.subject_id = subject_id
+        self.interval = interval
+        self.start = time.time()
+        self.end = None
+        self.totals = {'cpu_seconds': 0.0, 'peak_rss_kb': 0, 'read_bytes': 0, 'write_bytes': 0}
+        # {step: dict like totals}
+        self.steps = {}
+        self._last = None
+        self._step = None
+        self._progress = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"sampler-{subject_id}", daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.end = time.time()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.sample()
+            self._stop.wait(self.interval)
+
+    def _current_step(self):
+        # Looked up again until a step shows up, as a wrapper may start recon-all in another SUBJECTS_DIR
+        if self._progress is None or self._progress.step is None:
+            subjects_dir = find_subjects_dir(self.pid)
+            if subjects_dir is None:
+                return None
+            status_log = os.path.join(subjects_dir, self.subject_id, 'scripts', 'recon-all-status.log')
+            if self._progress is None or self._progress.tail.path != status_log:
+                self._progress = SubjectProgress(self.subject_id, status_log)
+        self._progress.update()
+        return self._progress.step
+
+    def sample(self):
+        """Take one sample and charge the usage since the previous one to the step in progress then."""
+        counters = sample_tree(self.pid)
+        if counters is None:
+            return
+        step = self._current_step() or self._step or 'start'
+        previous = self._last or dict.fromkeys(counters, 0)
+        charged = self.steps.setdefault(self._step or step, dict.fromkeys(self.totals, 0))
+        for key in ('cpu_seconds', 'read_bytes', 'write_bytes'):
+            # A child that exited but is not reaped yet drops out of the sum until its parent
+            # adds it, so only growth beyond the highest value seen is charged
+            delta = max(0, counters[key] - previous[key])
+            charged[key] += delta
+            self.totals[key] += delta
+            counters[key] = max(counters[key], previous[key])
+
+        current = self.steps.setdefault(step, dict.fromkeys(self.totals, 0))
+        current['peak_rss_kb'] = max(current['peak_rss_kb'], counters['rss_kb'])
+        self.totals['peak_rss_kb'] = max(self.totals['peak_rss_kb'], counters['rss_kb'])
+        self._last = counters
+        self._step = step
+
+
+def record_job(db_path, sampler, threads=None, exit_code=None):
+    """Store the totals and steps of a finished JobSampler in a recon_metrics.py database."""
+    store = MetricsStore(db_path)
+    try:
+        store.record_job(sampler.subject_id, socket.gethostname(), threads, sampler.start, sampler.end,
+                         exit_code, sampler.totals, sampler.steps)
+    finally:
+        store.close()
+
+
+def predict_peak_bytes(db_path=None, subject_id=None, default_gb=DEFAULT_PEAK_GB, margin=MEMORY_MARGIN):
+    """
+    Memory to set aside for a recon-all job
+
+    The largest past peak of the subject itself (e.g. before a retry) is used when known, else the
+    95th percentile of the peaks of all sampled jobs, else of the @#@FSTIME peaks of past logs,
+    else default_gb; plus the margin.
+
+    :param db_path: recon_metrics.py database, or None to use default_gb
+    :return: Bytes
+    """
+    peak_kb = None
+    if db_path and os.path.isfile(db_path):
+        store = MetricsStore(db_path)
+        try:
+            own = store.job_peaks(subject_id) if subject_id else []
+            if own:
+                peak_kb = max(own)
+            else:
+                peaks = store.job_peaks() or [max_rss for *_, max_rss in store.subject_totals() if max_rss]
+                if len(peaks) >= MIN_HISTORY:
+                    peak_kb = percentile(peaks, 95)
+        finally:
+            store.close()
+    if peak_kb is None:
+        return int(default_gb * 1024 ** 3 * margin)
+    return int(peak_kb * 1024 * margin)
+
+
+def total_memory_bytes():
+    """MemTotal of this node."""
+    for line in (_read('/proc/meminfo') or '').splitlines():
+        if line.startswith('MemTotal:'):
+            return int(line.split()[1]) * 1024
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def run_sampled(command, subject_id, db_path, interval=DEFAULT_INTERVAL, threads=None, stdout=None):
+    """
+    Run a command, sample its process tree and record the job
+
+    :return: Exit code of the command
+    """
+    process = subprocess.Popen(command, stdout=stdout, stderr=subprocess.STDOUT if stdout else None)
+    with JobSampler(process.pid, subject_id, interval) as sampler:
+        returncode = process.wait()
+    record_job(db_path, sampler, threads, returncode)
+    logging.info(f"{subject_id}: {sampler.totals['cpu_seconds'] / 3600:.2f} CPU hours, "
+                 f"peak {sampler.totals['peak_rss_kb'] / 1024 ** 2:.2f} GB")
+    return returncode
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Sample the resources of recon-all jobs and predict their memory')
+    subparsers = parser.add_subparsers(dest='action', required=True)
+
+    run_parser = subparsers.add_parser('run', help='Run and sample a command: run [options] -- recon-all ...')
+    run_parser.add_argument('--db', required=True, help='SQLite metrics database of recon_metrics.py')
+    run_parser.add_argument('--subject', required=True, help='Subject the command processes')
+    run_parser.add_argument('--interval', type=float, default=DEFAULT_INTERVAL,
+                            help=f'Seconds between samples (default: {DEFAULT_INTERVAL})')
+    run_parser.add_argument('--threads', type=int, default=None, help='OpenMP threads of the run, stored with it')
+    run_parser.add_argument('command', nargs=argparse.REMAINDER, help='Command line')
+
+    predict_parser = subparsers.add_parser('predict', help='Print the memory to set aside for a job in GB')
+    predict_parser.add_argument('--db', required=True, help='SQLite metrics database of recon_metrics.py')
+    predict_parser.add_argument('--subject', default=None, help='Subject to predict (default: any subject)')
+
+    report_parser = subparsers.add_parser('report', help='Print per-step resource percentiles of sampled jobs')
+    report_parser.add_argument('--db', required=True, help='SQLite metrics database of recon_metrics.py')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    if args.action == 'run':
+        job_command = args.command[1:] if args.command[:1] == ['--'] else args.command
+        if not job_command:
+            parser.error('no command given after --')
+        sys.exit(run_sampled(job_command, args.subject, args.db, args.interval, args.threads))
+    elif args.action == 'predict':
+        print(f"{predict_peak_bytes(args.db, args.subject) / 1024 ** 3:.2f}")
+    else:
+        metrics_store = MetricsStore(args.db)
+        rows = metrics_store.job_step_resources()
+        metrics_store.close()
+        by_step = {}
+        for step, cpu, peak_kb, read_bytes, write_bytes in rows:
+            by_step.setdefault(step, []).append((cpu, peak_kb, read_bytes, write_bytes))
+        print(f"{'step':<32} {'jobs':>5} {'CPU s p50':>10} {'CPU s p95':>10} {'peak GB p95':>12} "
+              f"{'read MB p95':>12} {'write MB p95':>13}")
+        for step, values in sorted(by_step.items(), key=lambda item: -max(v[1] for v in item[1])):
+            cpu_values, peaks, reads, writes = zip(*values)
+            print(f"{step:<32} {len(values):>5} {percentile(cpu_values, 50):>10.1f} "
+                  f"{percentile(cpu_values, 95):>10.1f} {percentile(peaks, 95) / 1024 ** 2:>12.2f} "
+                  f"{percentile(reads, 95) / 1024 ** 2:>12.1f} {percentile(writes, 95) / 1024 ** 2:>13.1f}")
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+from data_organizer import zero_pad_subject_id
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    key TEXT PRIMARY KEY,
+    subject_id TEXT,
+    size INTEGER,
+    etag TEXT,
+    mtime REAL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS objects_subject ON objects (subject_id);
+CREATE TABLE IF NOT EXISTS scan_headers (
+    key TEXT PRIMARY KEY,
+    header TEXT,
+    error TEXT
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# Rows inserted per transaction when building a manifest
+BATCH_SIZE = 10000
+
+
+def subject_from_key(key):
+    """
+    Return the zero-padded subject ID of the first sub-* path component of a key, or None
+
+    :param key: Object key, e.g. data/anat/sub-0000213/sub-213_acq-a_T1w.nii.gz
+    """
+    for part in key.split('/'):
+        if part.startswith('sub-'):
+            return zero_pad_subject_id(part.split('_', 1)[0])
+    return None
+
+
+def prefix_upper_bound(prefix):
+    """Return the smallest string greater than every string starting with prefix."""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class Manifest:
+    """
+    Compact S3 object manifest stored in SQLite.
+
+    Only key, size, etag and mtime are stored. Keys are the clustered primary key, so prefix
+    queries are range scans, and subjects are indexed. The URL, S3 URI and AWS CLI command of
+    the old s3_objects.json format are derived on demand.
+    """
+
+    def __init__(self, db_path, bucket_name=None, region=None):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+        if bucket_name:
+            self.set_meta('bucket', bucket_name)
+        if region:
+            self.set_meta('region', region)
+        self.bucket_name = self.get_meta('bucket') or 'biomedin260'
+        self.region = self.get_meta('region') or 'us-east-1'
+
+    def close(self):
+        self.conn.close()
+
+    def set_meta(self, name, value):
+        with self._lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)", (name, value))
+
+    def get_meta(self, name):
+        with self._lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def add_objects(self, objects):
+        """
+        Insert or update objects
+
+        :param objects: Iterable of dictionaries with 'key' and optionally 'size', 'etag', 'mtime'
+        :return: Number of objects written
+        """
+        count = 0
+        batch = []
+        for obj in objects:
+            batch.append((obj['key'], subject_from_key(obj['key']), obj.get('size'),
+                          obj.get('etag'), obj.get('mtime')))
+            if len(batch) >= BATCH_SIZE:
+                count += self._insert(batch)
+                batch = []
+        if batch:
+            count += self._insert(batch)
+        return count
+
+    def _insert(self, rows):
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO objects (key, subject_id, size, etag, mtime) VALUES (?, ?, ?, ?, ?)", rows)
+        return len(rows)
+
+    def _query(self, where='', params=()):
+        with self._lock:
+            rows = self.conn.execute(
+                f"SELECT key, size, etag, mtime FROM objects {where} ORDER BY key", params).fetchall()
+        return [self.to_reference(*row) for row in rows]
+
+    def count(self):
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM objects").fetchone()[0]
+
+    def get(self, key):
+        """Return the reference for one key, or None."""
+        rows = self._query("WHERE key = ?", (key,))
+        return rows[0] if rows else None
+
+    def by_subject(self, subject_id):
+        """Return all objects of a subject (zero-padded ID, e.g. sub-0010001)."""
+        return self._query("WHERE subject_id = ?", (zero_pad_subject_id(subject_id),))
+
+    def by_prefix(self, prefix):
+        """Return all objects whose key starts with prefix."""
+        if not prefix:
+            return self._query()
+        return self._query("WHERE key >= ? AND key < ?", (prefix, prefix_upper_bound(prefix)))
+
+    def all(self):
+        return self._query()
+
+    def set_scan_headers(self, headers):
+        """
+        Store NIfTI headers read remotely
+
+        :param headers: Dictionary mapping key to a header dictionary, or to {'error': message}
+        """
+        rows = []
+        for key, header in headers.items():
+            if 'error' in header:
+                rows.append((key, None, header['error']))
+            else:
+                rows.append((key, json.dumps(header), None))
+        with self._lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO scan_headers (key, header, error) VALUES (?, ?, ?)", rows)
+
+    def get_scan_headers(self, prefix=''):
+        """Return a dictionary mapping key to its stored header (or {'error': message})."""
+        where, params = '', ()
+        if prefix:
+            where, params = "WHERE key >= ? AND key < ?", (prefix, prefix_upper_bound(prefix))
+        with self._lock:
+            rows = self.conn.execute(f"SELECT key, header, error FROM scan_headers {where} ORDER BY key",
+                                     params).fetchall()
+        return {key: json.loads(header) if header is not None else {'error': error}
+                for key, header, error in rows}
+
+    def url(self, key):
+        return f"https://{self.bucket_name}.s3.{self.region}.amazonaws.com/{key}"
+
+    def s3_uri(self, key):
+        return f"s3://{self.bucket_name}/{key}"
+
+    def aws_cli_download(self, key):
+        return f"aws s3 cp s3://{self.bucket_name}/{key} ."
+
+    def to_reference(self, key, size=None, etag=None, mtime=None):
+        """Build an entry in the s3_objects.json format, with size, etag and mtime added."""
+        return {
+            "key": key,
+            "url": self.url(key),
+            "s3_uri": self.s3_uri(key),
+            "aws_cli_download": self.aws_cli_download(key),
+            "size": size,
+            "etag": etag,
+            "mtime": mtime,
+        }
+
+
+def is_manifest_db(path):
+    """Return True if path is a SQLite manifest rather than a JSON file."""
+    return path.endswith(('.db', '.sqlite', '.sqlite3'))
+
+
+def load_objects(path):
+    """
+    Load every object of a manifest in the s3_objects.json format, from either JSON or SQLite
+
+    :param path: Path to s3_objects.json or a SQLite manifest
+    :return: List of object references
+    """
+    if is_manifest_db(path):
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+        manifest = Manifest(path)
+        try:
+            return manifest.all()
+        finally:
+            manifest.close()
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def convert_json_manifest(json_path, db_path):
+    """
+    Convert a pretty-printed s3_objects.json to a compact SQLite manifest
+
+    Bucket and region are taken from the first entry's URL.
+
+    :param json_path: Path to s3_objects.json
+    :param db_path: Output SQLite path
+    :return: Manifest
+    """
+    with open(json_path, 'r') as f:
+        objects = json.load(f)
+
+    bucket_name = region = None
+    if objects and objects[0].get('url', '').startswith('https://'):
+        host = objects[0]['url'][len('https://'):].split('/', 1)[0]
+        # <bucket>.s3.<region>.amazonaws.com
+        bucket_name, _, rest = host.partition('.s3.')
+        region = rest.split('.amazonaws.com', 1)[0] or None
+
+    manifest = Manifest(db_path, bucket_name, region)
+    manifest.add_objects(objects)
+    return manifest
+
+
+def build_manifest_from_bucket(bucket_name, db_path, s3_client=None, prefix=''):
+    """
+    List a bucket with the paginated ListObjectsV2 API and store the compact manifest
+
+    :param bucket_name: Name of the bucket
+    :param db_path: Output SQLite path
+    :param s3_client: boto3 S3 client (default: a new client from the default session)
+    :param prefix: Only list keys under this prefix
+    :return: Manifest
+    """
+    import boto3
+
+    s3_client = s3_client or boto3.client('s3')
+    manifest = Manifest(db_path, bucket_name, s3_client.meta.region_name)
+
+    def iter_objects():
+        paginator = s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                yield {
+                    'key': obj['Key'],
+                    'size': obj['Size'],
+                    'etag': obj['ETag'].strip('"'),
+                    'mtime': obj['LastModified'].timestamp(),
+                }
+
+    count = manifest.add_objects(iter_objects())
+    logging.info(f"Stored {count} objects from s3://{bucket_name}/{prefix} in {db_path}")
+    return manifest
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build and query the compact S3 object manifest')
+    parser.add_argument('--db', default='./data/s3_objects.db', help='SQLite manifest (default: data/s3_objects.db)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help='List a bucket into the manifest')
+    build_parser.add_argument('--bucket', default='biomedin260', help='Bucket name (default: biomedin260)')
+    build_parser.add_argument('--prefix', default='', help='Only list keys under this prefix')
+
+    convert_parser = subparsers.add_parser('convert', help='Convert an s3_objects.json file')
+    convert_parser.add_argument('--json', default='./data/s3_objects.json',
+                                help='JSON manifest to convert (default: data/s3_objects.json)')
+
+    query_parser = subparsers.add_parser('query', help='Print objects as s3_objects.json entries')
+    query_group = query_parser.add_mutually_exclusive_group()
+    query_group.add_argument('--subject', help='Subject ID, e.g. sub-0010001')
+    query_group.add_argument('--prefix', help='Key prefix, e.g. data/anat/')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    if args.command == 'build':
+        build_manifest_from_bucket(args.bucket, args.db, prefix=args.prefix).close()
+    elif args.command == 'convert':
+        converted = convert_json_manifest(args.json, args.db)
+        logging.info(f"Converted {converted.count()} objects from {args.json} to {args.db} "
+                     f"({os.path.getsize(args.json) / 1024:.0f} KB -> {os.path.getsize(args.db) / 1024:.0f} KB)")
+        converted.close()
+    else:
+        store = Manifest(args.db)
+        if args.subject:
+            results = store.by_subject(args.subject)
+        else:
+            results = store.by_prefix(args.prefix or '')
+        print(json.dumps(results, indent=2))
+        store.close()
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# Runs recon-all for one subject in a private directory on fast local disk instead of the shared
+# SUBJECTS_DIR. The input T1 (and an earlier partial run of the subject, so retries can resume) is
+# copied in first; afterwards the subject is copied back next to its final place and renamed into
+# it, so the shared SUBJECTS_DIR never holds a half-copied subject. Every job holds an flock on its
+# scratch directory while it lives; directories whose lock is free belong to crashed jobs and are
+# removed by clean_orphans.
+import argparse
+import fcntl
+import json
+import logging
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+
+LOCK_FILE = '.lock'
+OWNER_FILE = 'owner.json'
+INPUT_DIR = 'input'
+
+# Hidden folders publish() creates next to the final subject folder
+SIBLING_PATTERN = re.compile(r'^\.(?P<subject>.+)\.(?P<kind>incoming|old)\.(?P<pid>\d+)@(?P<host>.+)$')
+
+
+def _sibling(subjects_dir, subject_id, kind):
+    """Temporary name next to the final subject folder, e.g. .sub-0010001.incoming.<pid>@<host>"""
+    return os.path.join(subjects_dir, f".{subject_id}.{kind}.{os.getpid()}@{socket.gethostname()}")
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class ScratchJob:
+    """
+    Scratch directory of one recon-all run; use as a context manager
+
+    SUBJECTS_DIR of the run is job_dir. publish() moves the result to subjects_dir, and leaving
+    the context removes job_dir.
+    """
+
+    def __init__(self, scratch_root, subjects_dir, subject_id):
+        self.scratch_root = scratch_root
+        self.subjects_dir = subjects_dir
+        self.subject_id = subject_id
+        self.job_dir = None
+        self._lock_fd = None
+
+    def __enter__(self):
+        os.makedirs(self.scratch_root, exist_ok=True)
+        self.job_dir = tempfile.mkdtemp(prefix=f"{self.subject_id}.", dir=self.scratch_root)
+        self._lock_fd = os.open(os.path.join(self.job_dir, LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+        with open(os.path.join(self.job_dir, OWNER_FILE), 'w') as f:
+            json.dump({'subject_id': self.subject_id, 'host': socket.gethostname(), 'pid': os.getpid()}, f)
+
+        # Resume from an earlier partial run, e.g. a retry from autorecon2
+        existing = os.path.join(self.subjects_dir, self.subject_id)
+        if os.path.isdir(existing):
+            shutil.copytree(existing, os.path.join(self.job_dir, self.subject_id), symlinks=True)
+        return self
+
+    def __exit__(self, *exc):
+        shutil.rmtree(self.job_dir, ignore_errors=True)
+        os.close(self._lock_fd)
+        self._lock_fd = None
+
+    def stage_input(self, path):
+        """Copy an input file to local disk and return the local path."""
+        input_dir = os.path.join(self.job_dir, INPUT_DIR)
+        os.makedirs(input_dir, exist_ok=True)
+        local_path = os.path.join(input_dir, os.path.basename(path))
+        shutil.copy2(path, local_path)
+        return local_path
+
+    def publish(self):
+        """
+        Copy the subject back to subjects_dir and rename it into place
+
+        The copy goes to a hidden folder next to the final one, so the rename is atomic. A
+        previous folder of the subject is swapped out and removed afterwards.
+
+        :return: Bytes copied back
+        """
+        source = os.path.join(self.job_dir, self.subject_id)
+        if not os.path.isdir(source):
+            return 0
+        final = os.path.join(self.subjects_dir, self.subject_id)
+        incoming = _sibling(self.subjects_dir, self.subject_id, 'incoming')
+        shutil.copytree(source, incoming, symlinks=True)
+        n_bytes = sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(incoming)
+                      for f in files if not os.path.islink(os.path.join(root, f)))
+
+        if os.path.isdir(final):
+            old = _sibling(self.subjects_dir, self.subject_id, 'old')
+            os.rename(final, old)
+            os.rename(incoming, final)
+            shutil.rmtree(old)
+        else:
+            os.rename(incoming, final)
+        return n_bytes
+
+
+def run_staged(command, subject_id, subjects_dir, scratch_root, stdout=None, wait=None):
+    """
+    Run a recon-all command for one subject in scratch and publish the subject, also after a failure
+
+    The file after -i is staged to local disk first. The subject is published whatever the exit
+    code, so a failed run can be classified and resumed from SUBJECTS_DIR.
+
+    :param command: recon-all command line
+    :param subject_id: Subject the command processes
+    :param subjects_dir: Shared FreeSurfer SUBJECTS_DIR
+    :param scratch_root: Local folder for the job directories
+    :param stdout: File object for the output of recon-all
+    :param wait: Function (subprocess.Popen) -> exit code used instead of Popen.wait, e.g. to sample the run
+    :return: Exit code of recon-all
+    """
+    with ScratchJob(scratch_root, subjects_dir, subject_id) as job:
+        command = list(command)
+        if '-i' in command:
+            index = command.index('-i') + 1
+            command[index] = job.stage_input(command[index])
+        env = dict(os.environ, SUBJECTS_DIR=job.job_dir)
+        process = subprocess.Popen(command, stdout=stdout, stderr=subprocess.STDOUT if stdout else None, env=env)
+        returncode = wait(process) if wait else process.wait()
+        n_bytes = job.publish()
+        logging.info(f"Published {subject_id} ({n_bytes / 1024 ** 2:.0f} MB) from {job.job_dir}")
+    return returncode
+
+
+def clean_orphans(scratch_root, subjects_dir=None):
+    """
+    Remove what crashed jobs left behind
+
+    Scratch directories whose lock is free are removed. With subjects_dir, half-published
+    folders of dead processes on this host are removed as well, and a subject left swapped out
+    between the two renames of publish() is put back.
+
+    :return: Number of directories cleaned up
+    """
+    cleaned = 0
+    if os.path.isdir(scratch_root):
+        for name in os.listdir(scratch_root):
+            job_dir = os.path.join(scratch_root, name)
+            lock_path = os.path.join(job_dir, LOCK_FILE)
+            if not os.path.isfile(lock_path):
+                continue
+            fd = os.open(lock_path, os.O_RDWR)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # The job is still running
+                continue
+            finally:
+                os.close(fd)
+            logging.info(f"Removing orphaned scratch directory {job_dir}")
+            shutil.rmtree(job_dir, ignore_errors=True)
+            cleaned += 1
+
+    if subjects_dir and os.path.isdir(subjects_dir):
+        host = socket.gethostname()
+        for name in os.listdir(subjects_dir):
+            match = SIBLING_PATTERN.match(name)
+            if not match or match['host'] != host or _pid_alive(int(match['pid'])):
+                continue
+            path = os.path.join(subjects_dir, name)
+            final = os.path.join(subjects_dir, match['subject'])
+            pid = match['pid']
+            if match['kind'] == 'old' and not os.path.exists(final):
+                logging.info(f"Restoring {final} from {path}")
+                os.rename(path, final)
+            else:
+                logging.info(f"Removing {path} left by process {pid}")
+                shutil.rmtree(path, ignore_errors=True)
+            cleaned += 1
+    return cleaned
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run recon-all in local scratch and publish the subject atomically')
+    subparsers = parser.add_subparsers(dest='action', required=True)
+
+    run_parser = subparsers.add_parser('run', help='Run a recon-all command in scratch: run [options] -- recon-all ...')
+    run_parser.add_argument('--scratch-dir', required=True, help='Local disk or tmpfs folder for the job')
+    run_parser.add_argument('--subjects-dir', required=True, help='Shared FreeSurfer SUBJECTS_DIR')
+    run_parser.add_argument('--subject', required=True, help='Subject the command processes')
+    run_parser.add_argument('command', nargs=argparse.REMAINDER, help='recon-all command line')
+
+    clean_parser = subparsers.add_parser('clean', help='Remove scratch directories of crashed jobs')
+    clean_parser.add_argument('--scratch-dir', required=True, help='Local disk or tmpfs folder of the jobs')
+    clean_parser.add_argument('--subjects-dir', default=None, help='Also clean half-published subjects here')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    if args.action == 'run':
+        recon_command = args.command[1:] if args.command[:1] == ['--'] else args.command
+        if not recon_command:
+            parser.error('no command given after --')
+        sys.exit(run_staged(recon_command, args.subject, args.subjects_dir, args.scratch_dir))
+    else:
+        print(f"Cleaned up {clean_orphans(args.scratch_dir, args.subjects_dir)} directories")
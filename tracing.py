@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+# Spans for the pipeline stages and the per-subject work inside them. Tracing is off unless
+# PIPELINE_TRACE names a file; every finished span is then appended to it as one JSON line, so
+# several scripts and processes of a run can share the file. PIPELINE_PROFILE names a folder
+# where the Python stages opened with profile=True also write a cProfile dump.
+import argparse
+import bisect
+import contextlib
+import contextvars
+import cProfile
+import json
+import os
+import socket
+import time
+import uuid
+from collections import defaultdict
+
+from recon_metrics import percentile
+
+TRACE_ENV = 'PIPELINE_TRACE'
+TRACE_ID_ENV = 'PIPELINE_TRACE_ID'
+PROFILE_ENV = 'PIPELINE_PROFILE'
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+
+def configure(trace_path=None, profile_dir=None):
+    """
+    Enable tracing and/or profiling for this process and the processes it starts
+
+    :param trace_path: Append-only JSON lines file
+    :param profile_dir: Folder for cProfile dumps of the stages
+    :return: The trace ID shared by all spans of the run
+    """
+    if trace_path:
+        os.environ[TRACE_ENV] = os.path.abspath(trace_path)
+    os.environ.setdefault(TRACE_ID_ENV, uuid.uuid4().hex[:16])
+    if profile_dir:
+        os.makedirs(profile_dir, exist_ok=True)
+        os.environ[PROFILE_ENV] = os.path.abspath(profile_dir)
+    return os.environ[TRACE_ID_ENV]
+
+
+def enabled():
+    return bool(os.environ.get(TRACE_ENV))
+
+
+class Span:
+    """One unit of work; use span() to create it."""
+
+    def __init__(self, name, subject_id=None, attributes=None):
+        parent = _current_span.get()
+        self.record = {
+            'trace_id': os.environ.setdefault(TRACE_ID_ENV, uuid.uuid4().hex[:16]),
+            'span_id': uuid.uuid4().hex[:16],
+            'parent_id': parent.record['span_id'] if parent else None,
+            'name': name,
+            'subject_id': subject_id if subject_id is not None else (parent.record['subject_id'] if parent else None),
+            'start': time.time(),
+            'end': None,
+            'seconds': None,
+            'bytes': 0,
+            'outcome': 'ok',
+            'error': None,
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+            'attributes': dict(attributes or {}),
+        }
+
+    def add_bytes(self, n_bytes):
+        self.record['bytes'] += int(n_bytes or 0)
+
+    def set(self, **attributes):
+        self.record['attributes'].update(attributes)
+
+    def fail(self, error):
+        """Mark the span as failed without raising, e.g. for a step that returns False."""
+        self.record['outcome'] = 'error'
+        self.record['error'] = str(error)
+
+    def finish(self):
+        self.record['end'] = time.time()
+        self.record['seconds'] = round(self.record['end'] - self.record['start'], 6)
+        write_record(self.record)
+
+
+def write_record(record):
+    """Append one record to the trace file with a single O_APPEND write, safe across processes."""
+    path = os.environ.get(TRACE_ENV)
+    if not path:
+        return
+    line = (json.dumps(record, default=str) + '\n').encode('utf-8')
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+class _NullSpan(Span):
+    """Span returned when tracing is off; all methods do nothing."""
+
+    def __init__(self):
+        self.record = None
+
+    def add_bytes(self, n_bytes):
+        pass
+
+    def set(self, **attributes):
+        pass
+
+    def fail(self, error):
+        pass
+
+
+@contextlib.contextmanager
+def span(name, subject_id=None, profile=False, **attributes):
+    """
+    Time a block of work as a span, a child of the span open in the current context
+
+    Exceptions (other than a successful sys.exit) mark the span as failed and are re-raised.
+    Without PIPELINE_TRACE the block runs untraced.
+
+    :param name: Stage or step name, e.g. download, recon-all, extract
+    :param subject_id: Subject the work belongs to (inherited from the parent span if omitted)
+    :param profile: Run the block under cProfile when PIPELINE_PROFILE is set
+    :param attributes: Extra fields stored with the span
+    """
+    profile = profile and bool(os.environ.get(PROFILE_ENV))
+    if not enabled() and not profile:
+        yield _NullSpan()
+        return
+
+    current = Span(name, subject_id, attributes)
+    token = _current_span.set(current)
+    profiler = None
+    if profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        yield current
+    except SystemExit as e:
+        if e.code not in (0, None):
+            current.fail(f"exit code {e.code}")
+        raise
+    except BaseException as e:
+        current.fail(f"{type(e).__name__}: {e}")
+        raise
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profile_path = os.path.join(os.environ[PROFILE_ENV], f"{name}-{current.record['span_id']}.prof")
+            profiler.dump_stats(profile_path)
+            current.set(profile=profile_path)
+        _current_span.reset(token)
+        current.finish()
+
+
+def submit(executor, fn, *args, **kwargs):
+    """executor.submit that runs fn inside the current span, so its spans become children."""
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+def load_trace(trace_path, trace_id=None):
+    """
+    Read the spans of one run
+
+    :param trace_path: Trace file
+    :param trace_id: Run to read (default: the run of the last span in the file)
+    :return: List of span records
+    """
+    records = []
+    with open(trace_path, 'r') as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                # A line cut short by a crash
+                continue
+    if not records:
+        return []
+    trace_id = trace_id or records[-1]['trace_id']
+    return [r for r in records if r['trace_id'] == trace_id]
+
+
+def critical_path(spans):
+    """
+    Chain of leaf spans that determined the end of the run
+
+    Starting from the span that ended last, repeatedly step back to the span that ended latest
+    before the current one started. Time between consecutive spans of the chain was spent
+    waiting on nothing that was traced.
+
+    :return: Tuple of (spans on the path in time order, total gap seconds)
+    """
+    parents = {s['parent_id'] for s in spans}
+    leaves = sorted((s for s in spans if s['span_id'] not in parents), key=lambda s: s['end'])
+    if not leaves:
+        return [], 0.0
+
+    ends = [s['end'] for s in leaves]
+    path = [leaves[-1]]
+    gaps = 0.0
+    while True:
+        start = path[-1]['start']
+        index = bisect.bisect_right(ends, start) - 1
+        if index < 0:
+            break
+        gaps += start - ends[index]
+        path.append(leaves[index])
+    return path[::-1], gaps
+
+
+def summarize(spans, top=10):
+    """
+    Per-stage totals, critical path and slowest subjects of a run
+
+    :return: JSON-serializable dictionary
+    """
+    if not spans:
+        return {'spans': 0}
+    start = min(s['start'] for s in spans)
+    end = max(s['end'] for s in spans)
+
+    by_name = defaultdict(list)
+    for s in spans:
+        by_name[s['name']].append(s)
+    stages = []
+    for name, group in by_name.items():
+        durations = [s['seconds'] for s in group]
+        stages.append({
+            'name': name,
+            'count': len(group),
+            'seconds': round(sum(durations), 3),
+            'p50_seconds': round(percentile(durations, 50), 3),
+            'p95_seconds': round(percentile(durations, 95), 3),
+            'bytes': sum(s['bytes'] for s in group),
+            'errors': sum(s['outcome'] != 'ok' for s in group),
+        })
+    stages.sort(key=lambda row: row['seconds'], reverse=True)
+
+    path, gaps = critical_path(spans)
+    path_by_name = defaultdict(float)
+    for s in path:
+        path_by_name[s['name']] += s['seconds']
+
+    by_subject = defaultdict(list)
+    for s in spans:
+        if s['subject_id']:
+            by_subject[s['subject_id']].append(s)
+    subjects = []
+    for subject_id, group in by_subject.items():
+        steps = defaultdict(float)
+        for s in group:
+            steps[s['name']] += s['seconds']
+        subjects.append({
+            'subject_id': subject_id,
+            'wall_seconds': round(max(s['end'] for s in group) - min(s['start'] for s in group), 3),
+            'steps': {name: round(seconds, 3) for name, seconds in steps.items()},
+            'errors': sum(s['outcome'] != 'ok' for s in group),
+        })
+    subjects.sort(key=lambda row: row['wall_seconds'], reverse=True)
+
+    return {
+        'trace_id': spans[0]['trace_id'],
+        'spans': len(spans),
+        'wall_seconds': round(end - start, 3),
+        'stages': stages,
+        'critical_path': {
+            'seconds': round(sum(path_by_name.values()), 3),
+            'untraced_gap_seconds': round(gaps, 3),
+            'by_stage': {name: round(seconds, 3) for name, seconds in
+                         sorted(path_by_name.items(), key=lambda item: item[1], reverse=True)},
+        },
+        'slowest_subjects': subjects[:top],
+    }
+
+
+def print_summary(summary):
+    """Print a summary from summarize() as text."""
+    if not summary.get('spans'):
+        print("No spans in trace")
+        return
+    print(f"Trace {summary['trace_id']}: {summary['spans']} spans over {summary['wall_seconds']:.1f} s\n")
+    print(f"{'stage':<24} {'count':>6} {'total s':>10} {'p50 s':>8} {'p95 s':>8} {'MB':>10} {'errors':>6}")
+    for row in summary['stages']:
+        print(f"{row['name']:<24} {row['count']:>6} {row['seconds']:>10.1f} {row['p50_seconds']:>8.2f} "
+              f"{row['p95_seconds']:>8.2f} {row['bytes'] / 1024 ** 2:>10.1f} {row['errors']:>6}")
+
+    path = summary['critical_path']
+    print(f"\nCritical path: {path['seconds']:.1f} s in spans + {path['untraced_gap_seconds']:.1f} s untraced")
+    for name, seconds in path['by_stage'].items():
+        print(f"  {name:<22} {seconds:>10.1f} s")
+
+    print("\nSlowest subjects:")
+    for row in summary['slowest_subjects']:
+        steps = ', '.join(f"{name} {seconds:.1f}s" for name, seconds in row['steps'].items())
+        errors = f" ({row['errors']} errors)" if row['errors'] else ''
+        print(f"  {row['subject_id']:<14} {row['wall_seconds']:>10.1f} s  {steps}{errors}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Summarize a pipeline trace written with PIPELINE_TRACE')
+    parser.add_argument('--trace', default=os.environ.get(TRACE_ENV, './data/trace.jsonl'),
+                        help='Trace file (default: $PIPELINE_TRACE or data/trace.jsonl)')
+    parser.add_argument('--trace-id', default=None, help='Run to summarize (default: the latest)')
+    parser.add_argument('--top', type=int, default=10, help='Number of slowest subjects to list (default: 10)')
+    parser.add_argument('--json', action='store_true', help='Print the summary as JSON')
+
+    args = parser.parse_args()
+
+    run_summary = summarize(load_trace(args.trace, args.trace_id), args.top)
+    if args.json:
+        print(json.dumps(run_summary, indent=2))
+    else:
+        print_summary(run_summary)
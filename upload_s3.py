@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+import argparse
+import hashlib
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+
+# Multipart settings. The local ETag calculation must use the same values as the upload.
+MULTIPART_THRESHOLD = 64 * 1024 * 1024
+MULTIPART_CHUNKSIZE = 64 * 1024 * 1024
+
+
+def compute_etag(path, threshold=MULTIPART_THRESHOLD, chunk_size=MULTIPART_CHUNKSIZE):
+    """
+    Compute the ETag S3 will report for a file uploaded with the given multipart settings
+
+    Single-part uploads have the MD5 of the file as ETag. Multipart uploads have the MD5 of the
+    concatenated part MD5s followed by "-<number of parts>".
+
+    :param path: Path to the local file
+    :param threshold: Size at which boto3 switches to multipart upload
+    :param chunk_size: Size of each multipart part
+    :return: ETag string without quotes
+    """
+    size = os.path.getsize(path)
+    part_digests = []
+    with open(path, 'rb') as f:
+        if size < threshold:
+            digest = hashlib.md5()
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                digest.update(chunk)
+            return digest.hexdigest()
+
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            part_digests.append(hashlib.md5(chunk).digest())
+    return f"{hashlib.md5(b''.join(part_digests)).hexdigest()}-{len(part_digests)}"
+
+
+def get_remote_etag(s3_client, bucket_name, key):
+    """
+    Return the ETag of an existing object, or None if it does not exist
+
+    :param s3_client: boto3 S3 client
+    :param bucket_name: Name of the bucket
+    :param key: Object key
+    """
+    try:
+        response = s3_client.head_object(Bucket=bucket_name, Key=key)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+            return None
+        raise
+    return response['ETag'].strip('"')
+
+
+def collect_files(source_dir, subjects=None):
+    """
+    List the files to upload, relative to the source directory
+
+    :param source_dir: Directory with finished subject outputs or archives
+    :param subjects: Optional list of subject IDs; only paths starting with one of them are kept
+    :return: Sorted list of relative POSIX paths
+    """
+    files = []
+    for root, dirs, filenames in os.walk(source_dir):
+        for filename in filenames:
+            rel_path = os.path.relpath(os.path.join(root, filename), source_dir).replace(os.sep, '/')
+            if subjects is None or rel_path.split('/', 1)[0].split('.', 1)[0] in subjects:
+                files.append(rel_path)
+    return sorted(files)
+
+
+def make_object_reference(bucket_name, region, key):
+    """Build a manifest entry in the same format as get_s3_object_references."""
+    return {
+        "key": key,
+        "url": f"https://{bucket_name}.s3.{region}.amazonaws.com/{key}",
+        "s3_uri": f"s3://{bucket_name}/{key}",
+        "aws_cli_download": f"aws s3 cp s3://{bucket_name}/{key} ."
+    }
+
+
+def upload_file(s3_client, bucket_name, path, key, transfer_config):
+    """
+    Upload a single file unless an object with the same checksum already exists
+
+    :param s3_client: boto3 S3 client
+    :param bucket_name: Name of the bucket
+    :param path: Local path
+    :param key: Destination key
+    :param transfer_config: boto3 TransferConfig controlling multipart upload
+    :return: Tuple of (status, size, etag) where status is 'uploaded' or 'skipped'
+    """
+    local_etag = compute_etag(path, transfer_config.multipart_threshold, transfer_config.multipart_chunksize)
+    size = os.path.getsize(path)
+
+    if get_remote_etag(s3_client, bucket_name, key) == local_etag:
+        return 'skipped', size, local_etag
+
+    s3_client.upload_file(path, bucket_name, key, Config=transfer_config)
+    return 'uploaded', size, local_etag
+
+
+def upload_outputs(source_dir, bucket_name, prefix='', subjects=None, workers=4, max_concurrency=4,
+                   s3_client=None):
+    """
+    Upload finished subject outputs (or archives) to s3://<bucket>/<prefix>/
+
+    Files are uploaded concurrently and each large file is itself split into concurrent
+    multipart uploads.
+
+    :param source_dir: Directory with finished subject outputs or archives
+    :param bucket_name: Name of the bucket
+    :param prefix: Key prefix, e.g. preprocessed_data
+    :param subjects: Optional list of subject IDs to upload
+    :param workers: Number of files uploaded at the same time
+    :param max_concurrency: Number of parts uploaded at the same time for each file
+    :param s3_client: boto3 S3 client (default: a new client from the default session)
+    :return: List of manifest entries compatible with s3_objects.json, with size and etag added
+    """
+    s3_client = s3_client or boto3.client('s3')
+    region = s3_client.meta.region_name
+    transfer_config = TransferConfig(
+        multipart_threshold=MULTIPART_THRESHOLD,
+        multipart_chunksize=MULTIPART_CHUNKSIZE,
+        max_concurrency=max_concurrency,
+    )
+
+    files = collect_files(source_dir, subjects)
+    logging.info(f"Found {len(files)} files to upload from {source_dir}")
+    prefix = prefix.strip('/')
+
+    manifest = []
+    stats = {'uploaded': 0, 'skipped': 0, 'errors': 0}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for rel_path in files:
+            key = f"{prefix}/{rel_path}" if prefix else rel_path
+            future = executor.submit(upload_file, s3_client, bucket_name,
+                                     os.path.join(source_dir, rel_path), key, transfer_config)
+            futures[future] = key
+
+        for future in as_completed(futures):
+            key = futures[future]
+            try:
+                status, size, etag = future.result()
+            except Exception as e:
+                logging.error(f"Failed to upload {key}: {e}")
+                stats['errors'] += 1
+                continue
+
+            stats[status] += 1
+            logging.info(f"{status.capitalize()}: s3://{bucket_name}/{key}")
+            entry = make_object_reference(bucket_name, region, key)
+            entry.update({"size": size, "etag": etag})
+            manifest.append(entry)
+
+    logging.info(f"Uploaded: {stats['uploaded']} / Skipped (unchanged): {stats['skipped']} / "
+                 f"Errors: {stats['errors']}")
+    return sorted(manifest, key=lambda e: e['key'])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Upload processed subject outputs to S3')
+    parser.add_argument('--source', required=True,
+                        help='Directory with processed subjects or archives (e.g. preprocessed_data)')
+    parser.add_argument('--bucket', default='biomedin260', help='Bucket name (default: biomedin260)')
+    parser.add_argument('--prefix', default='preprocessed_data',
+                        help='Key prefix for uploaded objects (default: preprocessed_data)')
+    parser.add_argument('--subjects', default=None,
+                        help='File with subject IDs to upload (default: everything under --source)')
+    parser.add_argument('--manifest', default='./data/uploaded_objects.json',
+                        help='Output manifest in s3_objects.json format (default: data/uploaded_objects.json)')
+    parser.add_argument('--workers', type=int, default=4, help='Files uploaded concurrently (default: 4)')
+    parser.add_argument('--max-concurrency', type=int, default=4,
+                        help='Multipart parts uploaded concurrently per file (default: 4)')
+    parser.add_argument('--endpoint-url', default=None,
+                        help='Custom S3 endpoint, e.g. a local MinIO server for testing')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    subject_ids = None
+    if args.subjects:
+        with open(args.subjects, 'r') as f:
+            subject_ids = {line.strip() for line in f if line.strip() and not line.startswith('#')}
+
+    client = boto3.client('s3', endpoint_url=args.endpoint_url)
+    objects = upload_outputs(args.source, args.bucket, args.prefix, subject_ids,
+                             args.workers, args.max_concurrency, client)
+
+    with open(args.manifest, 'w') as f:
+        json.dump(objects, f, indent=2)
+    logging.info(f"Upload manifest saved to {args.manifest}")
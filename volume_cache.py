@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+# Shared cache of decompressed volumes. Every .nii.gz/.mgz that goes through it is inflated once
+# into a plain .nii/.mgh file named after the source path, modification time and size, and then
+# memory-mapped, so later readers in any process get zero-copy views instead of gunzipping again.
+# The modification time of a cache file is its last use; the least recently used files are
+# removed to keep the cache under its disk budget. Files are published with an atomic rename and
+# eviction runs under an exclusive file lock that readers hold shared while they open a file, so
+# several worker processes can share one cache folder.
+import argparse
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import struct
+import time
+
+import volume_io
+
+CACHE_DIR_ENV = 'VOLUME_CACHE_DIR'
+CACHE_GB_ENV = 'VOLUME_CACHE_GB'
+DEFAULT_BUDGET_GB = 20
+
+LOCK_DIR = '.locks'
+EVICT_LOCK = '.evict.lock'
+# Fills of different sources share one of this many lock files
+LOCK_BUCKETS = 256
+# A .tmp file not written to for this long is left over from a fill that crashed
+STALE_TMP_SECONDS = 600
+# Fills of a file that keeps being evicted before it can be opened
+OPEN_ATTEMPTS = 5
+
+
+class VolumeCache:
+    """Disk-budgeted cache of decompressed volumes in cache_dir."""
+
+    def __init__(self, cache_dir, budget_bytes=DEFAULT_BUDGET_GB * 1024 ** 3):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.budget_bytes = int(budget_bytes)
+        os.makedirs(os.path.join(self.cache_dir, LOCK_DIR), exist_ok=True)
+
+    def key(self, source):
+        """Cache key of a source file; changes when the file is modified or replaced."""
+        stat = os.stat(source)
+        identity = f"{os.path.realpath(source)}\0{stat.st_mtime_ns}\0{stat.st_size}"
+        return hashlib.sha1(identity.encode('utf-8')).hexdigest()[:24]
+
+    def path(self, source):
+        """
+        Path of the decompressed copy of source, decompressing it on a miss
+
+        Another process may evict the file once this returns; load_mgh and memmap_nifti open it
+        safely.
+
+        :param source: .nii.gz or .mgz file; other files are not cached and returned as they are
+        :return: Path to a .nii or .mgh file
+        """
+        suffix = decompressed_suffix(source)
+        if suffix is None:
+            return source
+        entry = self._entry(source, suffix)
+        if not self._touch(entry):
+            self._fill(source, entry)
+        return entry
+
+    def open(self, source, opener):
+        """
+        Call opener on the decompressed copy of source while eviction is held off
+
+        A memory map made by opener stays readable after the file is evicted.
+
+        :param opener: Function (path) -> value, e.g. volume_io.memmap_mgh
+        :return: What opener returns
+        """
+        suffix = decompressed_suffix(source)
+        if suffix is None:
+            return opener(source)
+        entry = self._entry(source, suffix)
+        for _ in range(OPEN_ATTEMPTS):
+            with self._lock(EVICT_LOCK, shared=True):
+                if self._touch(entry):
+                    return opener(entry)
+            # Not cached, or evicted by another process since it was filled
+            self._fill(source, entry)
+        raise FileNotFoundError(f"{entry} was evicted {OPEN_ATTEMPTS} times before it could be opened; "
+                                f"the cache budget is too small for the number of workers")
+
+    def load_mgh(self, source):
+        """
+        Zero-copy view of a .mgz/.mgh volume
+
+        :return: Tuple of (read-only memmap in big-endian byte order, 4x4 affine), as volume_io.memmap_mgh
+        """
+        return self.open(source, volume_io.memmap_mgh)
+
+    def memmap_nifti(self, source):
+        """
+        Zero-copy view of a .nii.gz/.nii image
+
+        :return: Tuple of (memmap, header dict, geometry dict), as volume_io.memmap_nifti
+        """
+        return self.open(source, volume_io.memmap_nifti)
+
+    def entries(self, partial=False):
+        """
+        Cached files, least recently used first
+
+        :param partial: List the .tmp files of fills (in progress or crashed) instead
+        :return: List of (path, size in bytes, last use time) tuples
+        """
+        rows = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.name.startswith('.') or entry.name.endswith('.tmp') != partial or not entry.is_file():
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    # Evicted by another process
+                    continue
+                rows.append((entry.path, stat.st_size, stat.st_mtime))
+        rows.sort(key=lambda row: row[2])
+        return rows
+
+    def evict(self, incoming=0):
+        """
+        Remove least recently used files until the cache plus incoming bytes fits the budget
+
+        Files are unlinked, so processes that still have one memory-mapped keep reading it.
+        Leftover .tmp files of crashed fills are removed first; those of fills in progress
+        count against the budget.
+
+        :param incoming: Size of a file about to be added
+        :return: Number of bytes freed
+        """
+        freed = 0
+        with self._lock(EVICT_LOCK):
+            used = 0
+            for path, size, modified in self.entries(partial=True):
+                if time.time() - modified > STALE_TMP_SECONDS and _remove(path):
+                    freed += size
+                else:
+                    used += size
+            entries = self.entries()
+            used += sum(size for _, size, _ in entries)
+            for path, size, _ in entries:
+                if used + incoming <= self.budget_bytes:
+                    break
+                _remove(path)
+                used -= size
+                freed += size
+        if incoming > self.budget_bytes:
+            logging.warning(f"A {incoming / 1024 ** 3:.1f} GB volume does not fit the "
+                            f"{self.budget_bytes / 1024 ** 3:.1f} GB cache; it is kept until the next eviction")
+        return freed
+
+    def clear(self):
+        """Remove every cached file."""
+        with self._lock(EVICT_LOCK):
+            for path, _, _ in self.entries():
+                _remove(path)
+
+    def usage(self):
+        entries = self.entries()
+        partial = self.entries(partial=True)
+        return {
+            'cache_dir': self.cache_dir,
+            'entries': len(entries),
+            'gb': round(sum(size for _, size, _ in entries) / 1024 ** 3, 3),
+            'partial_files': len(partial),
+            'partial_gb': round(sum(size for _, size, _ in partial) / 1024 ** 3, 3),
+            'budget_gb': round(self.budget_bytes / 1024 ** 3, 3),
+        }
+
+    def _entry(self, source, suffix):
+        return os.path.join(self.cache_dir, self.key(source) + suffix)
+
+    def _fill(self, source, entry):
+        """Decompress source into entry unless another process did while we waited for the lock."""
+        key = os.path.basename(entry).split('.')[0]
+        with self._lock(os.path.join(LOCK_DIR, f"{int(key, 16) % LOCK_BUCKETS}.lock")):
+            if self._touch(entry):
+                return
+            self.evict(expected_size(source))
+            tmp_path = volume_io.decompress_to_file(source, self.cache_dir, '.tmp')
+            try:
+                os.replace(tmp_path, entry)
+            except OSError:
+                os.remove(tmp_path)
+                raise
+        logging.debug(f"Cached {source} as {entry}")
+
+    def _touch(self, entry):
+        """Mark a cached file as used; False if it is not cached."""
+        try:
+            os.utime(entry)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def _lock(self, name, shared=False):
+        return _FileLock(os.path.join(self.cache_dir, name), shared)
+
+
+class _FileLock:
+    """flock on a file; each instance opens its own descriptor, so threads exclude each other too."""
+
+    def __init__(self, path, shared=False):
+        self.path = path
+        self.shared = shared
+        self.fd = None
+
+    def __enter__(self):
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self.fd, fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+
+
+def _remove(path):
+    """Remove a file; False if another process removed it first."""
+    try:
+        os.remove(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def decompressed_suffix(source):
+    """Suffix of the decompressed copy of source, or None if source is not compressed."""
+    if source.endswith('.mgz'):
+        return '.mgh'
+    if source.endswith('.nii.gz'):
+        return '.nii'
+    return None
+
+
+def expected_size(source):
+    """Uncompressed size of a gzip file from its trailer (modulo 4 GiB, enough to plan eviction)."""
+    with open(source, 'rb') as f:
+        f.seek(-4, os.SEEK_END)
+        return struct.unpack('<I', f.read(4))[0]
+
+
+def configure(cache_dir, budget_gb=DEFAULT_BUDGET_GB):
+    """Use a cache for this process and the worker processes it starts (see default_cache)."""
+    os.environ[CACHE_DIR_ENV] = os.path.abspath(cache_dir)
+    os.environ[CACHE_GB_ENV] = str(budget_gb)
+
+
+def default_cache():
+    """The cache named by VOLUME_CACHE_DIR (budget VOLUME_CACHE_GB), or None when caching is off."""
+    cache_dir = os.environ.get(CACHE_DIR_ENV)
+    if not cache_dir:
+        return None
+    budget_gb = float(os.environ.get(CACHE_GB_ENV, DEFAULT_BUDGET_GB))
+    return VolumeCache(cache_dir, budget_gb * 1024 ** 3)
+
+
+def load_mgh(path):
+    """volume_io.load_mgh through the default cache when one is configured."""
+    cache = default_cache()
+    if cache is None:
+        return volume_io.load_mgh(path)
+    return cache.load_mgh(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Inspect, prune or warm the decompressed volume cache')
+    parser.add_argument('--cache-dir', default=os.environ.get(CACHE_DIR_ENV, './data/volume_cache'),
+                        help='Cache folder (default: $VOLUME_CACHE_DIR or data/volume_cache)')
+    parser.add_argument('--budget-gb', type=float, default=float(os.environ.get(CACHE_GB_ENV, DEFAULT_BUDGET_GB)),
+                        help=f'Disk budget (default: $VOLUME_CACHE_GB or {DEFAULT_BUDGET_GB})')
+    parser.add_argument('--warm', nargs='*', default=[], help='Volumes to decompress into the cache')
+    parser.add_argument('--prune', action='store_true', help='Evict down to the budget')
+    parser.add_argument('--clear', action='store_true', help='Remove every cached volume')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    volume_cache = VolumeCache(args.cache_dir, args.budget_gb * 1024 ** 3)
+    if args.clear:
+        volume_cache.clear()
+    if args.prune:
+        print(f"Freed {volume_cache.evict() / 1024 ** 3:.2f} GB")
+    if args.warm:
+        start = time.perf_counter()
+        for volume_path in args.warm:
+            volume_cache.path(volume_path)
+        print(f"Warmed {len(args.warm)} volumes in {time.perf_counter() - start:.1f} s")
+    print(json.dumps(volume_cache.usage(), indent=2))
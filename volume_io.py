@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# Readers for the image volumes we work with, without nibabel: NIfTI files are memory-mapped
+# (gzipped ones after decompressing to a scratch file) and FreeSurfer .mgz/.mgh volumes are
+# loaded with numpy (or memory-mapped once decompressed, see volume_cache.py). Also holds the
+# aparc+aseg label names used for ROI features.
+import gzip
+import os
+import shutil
+import struct
+import tempfile
+
+import numpy as np
+
+from nifti_header import NIFTI2_HEADER_SIZE, parse_nifti_geometry, parse_nifti_header
+
+# Size of the MGH header; the voxel data follow it
+MGH_HEADER_SIZE = 284
+
+# MGH type codes mapped to big-endian numpy dtypes
+MGH_DATATYPES = {0: '>u1', 1: '>i4', 3: '>f4', 4: '>i2'}
+
+# NIfTI datatype names (from parse_nifti_header) that can be memory-mapped directly
+NIFTI_NUMPY_TYPES = {'uint8', 'int16', 'int32', 'float32', 'float64', 'int8', 'uint16', 'uint32',
+                     'int64', 'uint64'}
+
+# Subcortical gray-matter labels of aseg
+SUBCORTICAL_LABELS = {
+    10: 'Left-Thalamus', 11: 'Left-Caudate', 12: 'Left-Putamen', 13: 'Left-Pallidum',
+    17: 'Left-Hippocampus', 18: 'Left-Amygdala', 26: 'Left-Accumbens-area', 28: 'Left-VentralDC',
+    49: 'Right-Thalamus', 50: 'Right-Caudate', 51: 'Right-Putamen', 52: 'Right-Pallidum',
+    53: 'Right-Hippocampus', 54: 'Right-Amygdala', 58: 'Right-Accumbens-area', 60: 'Right-VentralDC',
+}
+
+# Remaining aseg labels, so every label of aparc+aseg has a name
+ASEG_OTHER_LABELS = {
+    2: 'Left-Cerebral-White-Matter', 4: 'Left-Lateral-Ventricle', 5: 'Left-Inf-Lat-Vent',
+    7: 'Left-Cerebellum-White-Matter', 8: 'Left-Cerebellum-Cortex', 14: '3rd-Ventricle', 15: '4th-Ventricle',
+    16: 'Brain-Stem', 24: 'CSF', 30: 'Left-vessel', 31: 'Left-choroid-plexus',
+    41: 'Right-Cerebral-White-Matter', 43: 'Right-Lateral-Ventricle', 44: 'Right-Inf-Lat-Vent',
+    46: 'Right-Cerebellum-White-Matter', 47: 'Right-Cerebellum-Cortex', 62: 'Right-vessel',
+    63: 'Right-choroid-plexus', 72: '5th-Ventricle', 77: 'WM-hypointensities', 80: 'non-WM-hypointensities',
+    85: 'Optic-Chiasm', 251: 'CC_Posterior', 252: 'CC_Mid_Posterior', 253: 'CC_Central',
+    254: 'CC_Mid_Anterior', 255: 'CC_Anterior',
+}
+
+# Desikan-Killiany regions in label order (label = 1000/2000 + index); corpus callosum (4) is unused
+APARC_REGIONS = [
+    'bankssts', 'caudalanteriorcingulate', 'caudalmiddlefrontal', None, 'cuneus', 'entorhinal',
+    'fusiform', 'inferiorparietal', 'inferiortemporal', 'isthmuscingulate', 'lateraloccipital',
+    'lateralorbitofrontal', 'lingual', 'medialorbitofrontal', 'middletemporal', 'parahippocampal',
+    'paracentral', 'parsopercularis', 'parsorbitalis', 'parstriangularis', 'pericalcarine',
+    'postcentral', 'posteriorcingulate', 'precentral', 'precuneus', 'rostralanteriorcingulate',
+    'rostralmiddlefrontal', 'superiorfrontal', 'superiorparietal', 'superiortemporal',
+    'supramarginal', 'frontalpole', 'temporalpole', 'transversetemporal', 'insula',
+]
+
+
+def aparc_aseg_rois():
+    """
+    Return the gray-matter ROIs of aparc+aseg as a dictionary mapping label to name,
+    named as in FreeSurferColorLUT.txt (e.g. ctx-lh-precuneus)
+    """
+    rois = dict(SUBCORTICAL_LABELS)
+    for base, hemi in ((1000, 'lh'), (2000, 'rh')):
+        for index, region in enumerate(APARC_REGIONS, start=1):
+            if region:
+                rois[base + index] = f"ctx-{hemi}-{region}"
+    return rois
+
+
+def label_name(label):
+    """Return the FreeSurferColorLUT name of an aparc+aseg label, or label<N> if unknown."""
+    rois = aparc_aseg_rois()
+    if label in rois:
+        return rois[label]
+    return ASEG_OTHER_LABELS.get(label, f"label{label}")
+
+
+def read_mgh_header(f):
+    """
+    Parse the header of an open .mgh stream (decompressed for .mgz)
+
+    :return: dict with shape, dtype and affine (4x4 numpy array, voxel to scanner RAS)
+    """
+    data = f.read(MGH_HEADER_SIZE)
+    if len(data) < MGH_HEADER_SIZE:
+        raise ValueError("MGH header is truncated")
+
+    version, width, height, depth, nframes, mgh_type, _dof = struct.unpack('>7i', data[:28])
+    if version != 1:
+        raise ValueError(f"Unsupported MGH version {version}")
+    if mgh_type not in MGH_DATATYPES:
+        raise ValueError(f"Unsupported MGH data type {mgh_type}")
+
+    good_ras = struct.unpack('>h', data[28:30])[0]
+    shape = (width, height, depth) if nframes == 1 else (width, height, depth, nframes)
+
+    if good_ras:
+        voxel_size = np.array(struct.unpack('>3f', data[30:42]), dtype=float)
+        # Direction cosines of the x, y and z voxel axes, then the RAS of the volume centre
+        mdc = np.array(struct.unpack('>9f', data[42:78]), dtype=float).reshape(3, 3).T
+        c_ras = np.array(struct.unpack('>3f', data[78:90]), dtype=float)
+    else:
+        # Default coronal orientation of conformed FreeSurfer volumes
+        voxel_size = np.ones(3)
+        mdc = np.array([[-1.0, 0.0, 0.0], [0.0, 0.0, 1.0], [0.0, -1.0, 0.0]])
+        c_ras = np.zeros(3)
+
+    affine = np.eye(4)
+    affine[:3, :3] = mdc * voxel_size
+    affine[:3, 3] = c_ras - affine[:3, :3] @ (np.array(shape[:3], dtype=float) / 2.0)
+    return {'shape': shape, 'dtype': np.dtype(MGH_DATATYPES[mgh_type]), 'affine': affine}
+
+
+def load_mgh(path):
+    """
+    Load a .mgz or .mgh volume
+
+    :param path: Path to the volume, e.g. <subject>/mri/aparc+aseg.mgz
+    :return: Tuple of (data indexed [x, y, z(, t)] in native byte order, 4x4 affine)
+    """
+    opener = gzip.open if path.endswith('.mgz') or path.endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        header = read_mgh_header(f)
+        n_voxels = int(np.prod(header['shape']))
+        raw = f.read(n_voxels * header['dtype'].itemsize)
+    if len(raw) < n_voxels * header['dtype'].itemsize:
+        raise ValueError(f"{path} is truncated")
+
+    data = np.frombuffer(raw, dtype=header['dtype']).reshape(header['shape'], order='F')
+    return data.astype(header['dtype'].newbyteorder('='), copy=False), header['affine']
+
+
+def memmap_mgh(path):
+    """
+    Memory-map an uncompressed .mgh volume
+
+    :param path: Path to a .mgh file, e.g. one written by decompress_to_file
+    :return: Tuple of (read-only memmap indexed [x, y, z(, t)] in the file's big-endian byte order, 4x4 affine)
+    """
+    with open(path, 'rb') as f:
+        header = read_mgh_header(f)
+    data = np.memmap(path, dtype=header['dtype'], mode='r', offset=MGH_HEADER_SIZE,
+                     shape=header['shape'], order='F')
+    return data, header['affine']
+
+
+def write_mgh(path, data, affine):
+    """
+    Write a volume as .mgz (or .mgh for other suffixes)
+
+    :param path: Output path
+    :param data: 3D or 4D array of uint8, int16, int32 or float32
+    :param affine: 4x4 voxel-to-RAS affine without shear
+    """
+    data = np.asarray(data)
+    types = {np.dtype('uint8'): 0, np.dtype('int32'): 1, np.dtype('float32'): 3, np.dtype('int16'): 4}
+    mgh_type = types[data.dtype.newbyteorder('=')]
+
+    shape = list(data.shape) + [1] * (4 - data.ndim)
+    affine = np.asarray(affine, dtype=float)
+    voxel_size = np.linalg.norm(affine[:3, :3], axis=0)
+    mdc = affine[:3, :3] / voxel_size
+    c_ras = affine[:3, :3] @ (np.array(shape[:3], dtype=float) / 2.0) + affine[:3, 3]
+
+    header = bytearray(MGH_HEADER_SIZE)
+    struct.pack_into('>7i', header, 0, 1, shape[0], shape[1], shape[2], shape[3], mgh_type, 0)
+    struct.pack_into('>h', header, 28, 1)
+    struct.pack_into('>3f', header, 30, *voxel_size)
+    struct.pack_into('>9f', header, 42, *mdc.T.ravel())
+    struct.pack_into('>3f', header, 78, *c_ras)
+
+    opener = gzip.open if path.endswith('.mgz') or path.endswith('.gz') else open
+    with opener(path, 'wb') as f:
+        f.write(bytes(header))
+        f.write(data.astype(MGH_DATATYPES[mgh_type]).tobytes(order='F'))
+
+
+def decompress_to_file(path, scratch_dir=None, suffix='.nii'):
+    """
+    Stream-decompress a .gz file (.nii.gz or .mgz) into scratch_dir without holding it in memory
+
+    :param suffix: Suffix of the decompressed file, e.g. .mgh for .mgz volumes
+    :return: Path to the decompressed file; the caller removes it
+    """
+    fd, tmp_path = tempfile.mkstemp(suffix=suffix, dir=scratch_dir)
+    with gzip.open(path, 'rb') as src, os.fdopen(fd, 'wb') as dst:
+        shutil.copyfileobj(src, dst, 16 * 1024 * 1024)
+    return tmp_path
+
+
+def memmap_nifti(path):
+    """
+    Memory-map an uncompressed NIfTI image
+
+    :param path: Path to a .nii file
+    :return: Tuple of (memmap indexed [x, y, z(, t)] in Fortran order, header dict, geometry dict)
+    """
+    with open(path, 'rb') as f:
+        header_bytes = f.read(NIFTI2_HEADER_SIZE)
+    header = parse_nifti_header(header_bytes)
+    geometry = parse_nifti_geometry(header_bytes)
+
+    if header['datatype'] not in NIFTI_NUMPY_TYPES:
+        raise ValueError(f"Cannot memory-map NIfTI datatype {header['datatype']}")
+    byte_order = '<' if struct.unpack('<i', header_bytes[:4])[0] in (348, 540) else '>'
+    dtype = np.dtype(header['datatype']).newbyteorder(byte_order)
+
+    data = np.memmap(path, dtype=dtype, mode='r', offset=header['vox_offset'],
+                     shape=header['shape'], order='F')
+    return data, header, geometry
+
+
+def resample_labels(labels, label_affine, target_shape, target_affine, target_to_label_ras=None):
+    """
+    Resample a label volume onto another voxel grid with nearest-neighbour lookup
+
+    :param labels: 3D label array (e.g. aparc+aseg)
+    :param label_affine: Voxel-to-RAS affine of labels
+    :param target_shape: Spatial shape of the target grid (e.g. the BOLD volume)
+    :param target_affine: Voxel-to-RAS affine of the target grid
+    :param target_to_label_ras: Optional 4x4 RAS-to-RAS registration from the target to the labels
+    :return: Label array of target_shape (0 outside the label volume)
+    """
+    transform = np.linalg.inv(label_affine)
+    if target_to_label_ras is not None:
+        transform = transform @ np.asarray(target_to_label_ras, dtype=float)
+    transform = transform @ np.asarray(target_affine, dtype=float)
+
+    grid = np.indices(target_shape[:3], dtype=np.float32).reshape(3, -1)
+    source = np.rint(transform[:3, :3] @ grid + transform[:3, 3:4]).astype(np.int64)
+
+    inside = np.all((source >= 0) & (source < np.array(labels.shape[:3])[:, None]), axis=0)
+    resampled = np.zeros(grid.shape[1], dtype=labels.dtype)
+    resampled[inside] = labels[source[0, inside], source[1, inside], source[2, inside]]
+    return resampled.reshape(target_shape[:3])
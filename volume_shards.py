@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+import argparse
+import csv
+import json
+import logging
+import os
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy import ndimage
+
+from data_organizer import format_participant_id
+from volume_cache import DEFAULT_BUDGET_GB, configure as configure_volume_cache, load_mgh
+
+SPLITS = ('train', 'validation', 'test')
+INDEX_FILE = 'index.json'
+
+# Box cut around the brain centre (voxels of the 1 mm conformed volume) and the grid it is resampled to
+DEFAULT_CROP = (192, 192, 192)
+DEFAULT_SHAPE = (96, 96, 96)
+DEFAULT_SHARD_SIZE = 256
+
+
+def read_split_ids(data_dir, split):
+    """Read <split>_participant_ids.txt written by dataset_generator.py."""
+    with open(os.path.join(data_dir, f"{split}_participant_ids.txt"), 'r') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def read_split_labels(data_dir, split):
+    """
+    Map subject ID to 1 (ADHD) or 0 (Typical Development) from <split>_data.csv, if it exists
+    """
+    path = os.path.join(data_dir, f"{split}_data.csv")
+    if not os.path.isfile(path):
+        return {}
+    with open(path, 'r', newline='') as f:
+        return {format_participant_id(row['participant_id']): int(row['diagnosis_status'] == 'ADHD')
+                for row in csv.DictReader(f)}
+
+
+def crop_box(mask, crop):
+    """
+    Return slices of a crop-sized box centred on the centre of the brain's bounding box
+
+    Parts of the box outside the volume are handled by preprocess_volume with zero padding.
+    """
+    nonzero = np.nonzero(mask)
+    if len(nonzero[0]) == 0:
+        raise ValueError("Empty brain mask")
+    centre = [(int(axis.min()) + int(axis.max())) // 2 for axis in nonzero]
+    return tuple(slice(c - size // 2, c - size // 2 + size) for c, size in zip(centre, crop))
+
+
+def preprocess_volume(volume, crop=DEFAULT_CROP, shape=DEFAULT_SHAPE):
+    """
+    Crop a skull-stripped volume around the brain, resample it to shape and z-score the brain voxels
+
+    :param volume: 3D array (e.g. brainmask.mgz), zero outside the brain
+    :param crop: Size of the box cut around the brain, in voxels
+    :param shape: Output grid
+    :return: float16 array of shape; background stays 0
+    """
+    box = crop_box(volume > 0, crop)
+
+    # Zero-pad where the box extends past the volume
+    cropped = np.zeros(crop, dtype=np.float32)
+    source = tuple(slice(max(b.start, 0), min(b.stop, n)) for b, n in zip(box, volume.shape))
+    target = tuple(slice(s.start - b.start, s.stop - b.start) for s, b in zip(source, box))
+    cropped[target] = volume[source]
+
+    resampled = ndimage.zoom(cropped, [o / c for o, c in zip(shape, crop)], order=1, prefilter=False)
+    brain = resampled > 0
+    if brain.any():
+        values = resampled[brain]
+        resampled[brain] = (values - values.mean()) / (values.std() or 1.0)
+    resampled[~brain] = 0
+    return resampled.astype(np.float16)
+
+
+def preprocess_subject(subjects_dir, subject_id, crop, shape):
+    """Load and preprocess <subject>/mri/brainmask.mgz, returning None on failure."""
+    try:
+        volume, _ = load_mgh(os.path.join(subjects_dir, subject_id, 'mri', 'brainmask.mgz'))
+        return preprocess_volume(volume, crop, shape)
+    except Exception as e:
+        logging.error(f"Could not preprocess {subject_id}: {e}")
+        return None
+
+
+def build_split_shards(subject_ids, subjects_dir, output_dir, split, executor, crop=DEFAULT_CROP,
+                       shape=DEFAULT_SHAPE, shard_size=DEFAULT_SHARD_SIZE, window=16):
+    """
+    Preprocess the subjects of one split in the pool and write them, in list order, to float16 shards
+
+    At most window volumes are in flight so memory stays bounded however long the list is.
+    Shards are sized for the subjects still to come, so only failed subjects leave unused rows.
+
+    :return: Dictionary for the index: shards (file, count), subject_ids and failed
+    """
+    entry = {'shards': [], 'subject_ids': [], 'failed': []}
+    shard = None
+    capacity = 0
+
+    def write(subject_id, volume, remaining):
+        nonlocal shard, capacity
+        if volume is None:
+            entry['failed'].append(subject_id)
+            return
+        if shard is None or entry['shards'][-1]['count'] == capacity:
+            if shard is not None:
+                shard.flush()
+            capacity = min(shard_size, remaining)
+            filename = f"{split}-{len(entry['shards']):05d}.npy"
+            shard = np.lib.format.open_memmap(os.path.join(output_dir, filename), mode='w+',
+                                              dtype=np.float16, shape=(capacity,) + tuple(shape))
+            entry['shards'].append({'file': filename, 'count': 0})
+        shard[entry['shards'][-1]['count']] = volume
+        entry['shards'][-1]['count'] += 1
+        entry['subject_ids'].append(subject_id)
+
+    pending = deque()
+    for position, subject_id in enumerate(subject_ids):
+        pending.append((subject_id, executor.submit(preprocess_subject, subjects_dir, subject_id, crop, shape)))
+        while len(pending) >= window or (pending and position == len(subject_ids) - 1):
+            done_id, future = pending.popleft()
+            write(done_id, future.result(), len(subject_ids) - len(entry['subject_ids']) - len(entry['failed']))
+
+    if shard is not None:
+        shard.flush()
+    return entry
+
+
+def build_shards(data_dir, subjects_dir, output_dir, crop=DEFAULT_CROP, shape=DEFAULT_SHAPE,
+                 shard_size=DEFAULT_SHARD_SIZE, workers=4, splits=SPLITS):
+    """
+    Build the shard cache for every split listed by dataset_generator.py
+
+    :param data_dir: Folder with <split>_participant_ids.txt and <split>_data.csv
+    :param subjects_dir: FreeSurfer SUBJECTS_DIR
+    :param output_dir: Cache folder for the shards and index.json
+    :param crop: Box cut around the brain, in voxels
+    :param shape: Output grid per subject
+    :param shard_size: Subjects per shard file
+    :param workers: Processes preprocessing subjects
+    :param splits: Splits to build
+    :return: The index dictionary
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    index = {'crop': list(crop), 'shape': list(shape), 'dtype': 'float16', 'splits': {}}
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for split in splits:
+            subject_ids = read_split_ids(data_dir, split)
+            entry = build_split_shards(subject_ids, subjects_dir, output_dir, split, executor, crop, shape,
+                                       shard_size, window=workers * 4)
+            labels = read_split_labels(data_dir, split)
+            if labels:
+                entry['labels'] = [labels.get(subject_id, -1) for subject_id in entry['subject_ids']]
+            index['splits'][split] = entry
+            logging.info(f"{split}: {len(entry['subject_ids'])} subjects in {len(entry['shards'])} shards, "
+                         f"{len(entry['failed'])} failed")
+
+    tmp_path = os.path.join(output_dir, INDEX_FILE + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f, indent=2)
+    os.replace(tmp_path, os.path.join(output_dir, INDEX_FILE))
+    return index
+
+
+class ShardReader:
+    """
+    Iterate over batches of a split as zero-copy views into the memory-mapped shards.
+
+    Batches never cross a shard boundary, so each one is a contiguous slice of a single file.
+    With shuffle, the order of batches is shuffled but not the subjects within a batch. A
+    background thread asks the kernel to read ahead the next `prefetch` batches.
+    """
+
+    def __init__(self, cache_dir, split, batch_size=8, shuffle=False, seed=None, prefetch=2):
+        with open(os.path.join(cache_dir, INDEX_FILE), 'r') as f:
+            self.index = json.load(f)
+        entry = self.index['splits'][split]
+        self.shards = [np.load(os.path.join(cache_dir, s['file']), mmap_mode='r') for s in entry['shards']]
+        self.counts = [s['count'] for s in entry['shards']]
+        self.subject_ids = entry['subject_ids']
+        self.labels = np.array(entry['labels']) if 'labels' in entry else None
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.rng = np.random.default_rng(seed)
+        self.prefetch = prefetch
+
+    def __len__(self):
+        return sum(-(-count // self.batch_size) for count in self.counts)
+
+    def batch_plan(self):
+        """Return (shard, start, stop, first subject position) for every batch of one epoch."""
+        plan = []
+        offset = 0
+        for shard_index, count in enumerate(self.counts):
+            for start in range(0, count, self.batch_size):
+                plan.append((shard_index, start, min(start + self.batch_size, count), offset + start))
+            offset += count
+        if self.shuffle:
+            plan = [plan[i] for i in self.rng.permutation(len(plan))]
+        return plan
+
+    def _read_ahead(self, shard_index, start, stop):
+        shard = self.shards[shard_index]
+        if hasattr(os, 'posix_fadvise') and isinstance(shard, np.memmap):
+            item_bytes = shard[0].nbytes
+            with open(shard.filename, 'rb') as f:
+                os.posix_fadvise(f.fileno(), shard.offset + start * item_bytes, (stop - start) * item_bytes,
+                                 os.POSIX_FADV_WILLNEED)
+
+    def __iter__(self):
+        plan = self.batch_plan()
+        batches = queue.Queue(maxsize=max(1, self.prefetch))
+        stop_event = threading.Event()
+
+        def put(item):
+            # Gives up when the consumer has stopped iterating, so the thread does not block forever
+            while not stop_event.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def producer():
+            for item in plan:
+                self._read_ahead(*item[:3])
+                if not put(item):
+                    return
+            put(None)
+
+        thread = threading.Thread(target=producer, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = batches.get()
+                if item is None:
+                    break
+                shard_index, start, stop, position = item
+                ids = self.subject_ids[position:position + stop - start]
+                labels = self.labels[position:position + stop - start] if self.labels is not None else None
+                yield self.shards[shard_index][start:stop], ids, labels
+        finally:
+            # Also reached when the consumer breaks out early or raises
+            stop_event.set()
+            while not batches.empty():
+                batches.get_nowait()
+            thread.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build float16 memory-mapped volume shards for CNN training')
+    parser.add_argument('--data-dir', default='./data',
+                        help='Folder with the split ID lists from dataset_generator.py (default: data)')
+    parser.add_argument('--subjects-dir', required=True, help='FreeSurfer SUBJECTS_DIR with mri/brainmask.mgz')
+    parser.add_argument('--output-dir', required=True, help='Cache folder for the shards')
+    parser.add_argument('--crop', type=int, nargs=3, default=list(DEFAULT_CROP),
+                        help='Box cut around the brain in voxels (default: 192 192 192)')
+    parser.add_argument('--shape', type=int, nargs=3, default=list(DEFAULT_SHAPE),
+                        help='Output grid (default: 96 96 96)')
+    parser.add_argument('--shard-size', type=int, default=DEFAULT_SHARD_SIZE,
+                        help=f'Subjects per shard (default: {DEFAULT_SHARD_SIZE})')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 4,
+                        help='Processes preprocessing subjects (default: number of CPUs)')
+    parser.add_argument('--cache-dir', default=None,
+                        help='Shared cache of decompressed volumes, reused across runs (see volume_cache.py)')
+    parser.add_argument('--cache-gb', type=float, default=DEFAULT_BUDGET_GB,
+                        help=f'Disk budget of the volume cache (default: {DEFAULT_BUDGET_GB})')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if args.cache_dir:
+        configure_volume_cache(args.cache_dir, args.cache_gb)
+
+    build_shards(args.data_dir, args.subjects_dir, args.output_dir, tuple(args.crop), tuple(args.shape),
+                 args.shard_size, args.workers)
+    print(f"Shards and {INDEX_FILE} saved to {args.output_dir}")